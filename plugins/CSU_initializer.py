@@ -12,15 +12,20 @@ from ginga import GingaPlugin
 from ginga.gw import Widgets
 
 # import any other modules you want here--it's a python world!
-from datetime import datetime as dt
+import os
+import time
 import numpy as np
 from ginga import GingaPlugin, RGBImage, colors
 from ginga.gw import Widgets
 from ginga.misc import ParamSet, Bunch
-from ginga.util import dp
+from ginga.util import dp, paths
 from ginga.gw.GwHelp import FileSelection
 from astropy.io import fits
 
+from plugins import csu_transforms, csu_calibration, csu_edges, csu_bars
+from plugins import instrument, csu_store, csu_control, csu_raster
+from plugins.csu_watch import BarStateWatcher
+
 class CSU_initializer(GingaPlugin.LocalPlugin):
 
     def __init__(self, fv, fitsimage):
@@ -41,6 +46,31 @@ class CSU_initializer(GingaPlugin.LocalPlugin):
         self.settings.setDefaults(bar_num=1,
                                   move_to_open=False,
                                   bar_dist=0.0,
+                                  csu_bar_state=None,
+                                  live_poll_interval=0.1,
+                                  live_max_rate=5.0,
+                                  calibration_store=None,
+                                  calibration_epoch=None,
+                                  analysis_method='fast',
+                                  analysis_workers=0,
+                                  analysis_executor='thread',
+                                  latency_refresh_interval=2.0,
+                                  latency_file=None,
+                                  history_capacity=1000,
+                                  history_fps=10.0,
+                                  history_load_days=1.0,
+                                  record_bar_states=False,
+                                  bar_store=None,
+                                  csu_host=csu_control.default_host,
+                                  csu_port=csu_control.default_port,
+                                  csu_timeout=300.0,
+                                  csu_mock=False,
+                                  csu_mock_speed=5.0,
+                                  lod_scale=0.5,
+                                  lod_raster_step=4,
+                                  lod_raster_alpha=0.5,
+                                  cull_margin=0.1,
+                                  cull_interval=0.1,
                                  )
         self.settings.load(onError='silent')
 
@@ -53,225 +83,58 @@ class CSU_initializer(GingaPlugin.LocalPlugin):
 
         self.colornames = colors.get_colors()
         self.canvas_img = None
+
+        # bar overlay objects, kept alive across updates and keyed by
+        # tag (e.g. 'bar01', 'label01')
+        self.bar_objs = {}
+        self.bar_compound = None
+        self.bar_state = None
+        self.bar_colors = None
+        # below a zoom of lod_scale the overlay is drawn as one raster
+        # image instead of polygons and labels
+        self.lod_mode = 'vector'
+        self.bar_raster = None
+        # bars drawn in vector mode: those in view, or None for all;
+        # updated at most every cull_interval while panning and zooming
+        self.bar_visible = None
+        self.cull_timer = self.fv.get_timer()
+        self.cull_timer.add_callback('expired', self.cull_timer_cb)
+        self.watcher = None
+        # number of the latest overlay job; older jobs are stale
+        self.overlay_job = 0
+        # number of the latest mask image analysis, likewise
+        self.analysis_job = 0
+        self.measured = None
+
+        # bar states seen so far, for scrubbing and playback; the index
+        # of the state shown, or None to follow the newest
+        self.history = csu_bars.BarHistory(
+            capacity=self.settings.get('history_capacity', 1000))
+        self.history_index = None
+        # a copy of the history while it is played back, so that states
+        # appended meanwhile do not shift the frames
+        self.playback = None
+        self.history_timer = self.fv.get_timer()
+        self.history_timer.add_callback('expired', self.history_timer_cb)
+        self._history_updating = False
+        # on-disk record of all bar states, opened on first use
+        self.bar_store = None
+        # CSU controller connection, and the simulated CSU when there is
+        # no hardware; started on the first command
+        self.controller = None
+        self.mock_csu = None
+
+        # refreshes the latency panel while the plugin is open
+        self.latency_timer = self.fv.get_timer()
+        self.latency_timer.add_callback('expired', self.latency_timer_cb)
         
         self.mfilesel = FileSelection(self.fv.w.root.get_widget())
         
-        ## Define dimensions and angles relative to the pixels of the image
-#         self.slit_angle = (4.00-0.22) * np.pi/180.
-#         pixels = np.array([ (721, 2022), # pixels
-#                             (1068, 1934),
-#                             (984, 1804),
-#                             (1112, 40),
-#                           ])
-#         physical = np.array([ (179.155, self.bar_to_slit(2)), # mm, slit number
-#                               (133.901, self.bar_to_slit(6)),
-#                               (144.962, self.bar_to_slit(12)),
-#                               (129.033, self.bar_to_slit(92))
-#                             ])
-
-        pixels = np.array([ (1026.6847023205248, 31.815757489924671),
-                            (1031.1293065907989, 31.815757489924671),
-                            (1100.0527926274958, 76.568051304306408),
-                            (1104.4723170387663, 76.568051304306408),
-                            (869.79921202733158, 119.71402079180322),
-                            (874.17468615739256, 119.71402079180322),
-                            (790.04504261037619, 163.97941699869187),
-                            (794.38269316256697, 163.97941699869187),
-                            (844.76764696920873, 208.45498973235158),
-                            (849.06840834451555, 208.45498973235158),
-                            (918.16119587182891, 253.46863795483193),
-                            (922.57167115281891, 253.46863795483193),
-                            (667.1708458173706, 296.83477802171569),
-                            (671.58750566149126, 296.83477802171569),
-                            (1210.6743343816352, 342.85304935109269),
-                            (1215.1047501727178, 342.85304935109269),
-                            (1037.1504738673596, 386.56200191364559),
-                            (1041.5376839155629, 386.56200191364559),
-                            (1380.9733624348846, 431.75478066748974),
-                            (1385.3923546613969, 431.75478066748974),
-                            (1392.3137244788115, 476.40898670973735),
-                            (1396.5838727543558, 476.40898670973735),
-                            (701.99737614209846, 518.12290417047029),
-                            (706.31972548163674, 518.12290417047029),
-                            (775.43118955263321, 562.76481942553085),
-                            (779.76336695630744, 562.76481942553085),
-                            (695.39446696825667, 606.9386852721824),
-                            (699.68592870194686, 606.9386852721824),
-                            (1225.8966927438423, 652.79237015375304),
-                            (1230.2681865131638, 652.79237015375304),
-                            (1299.3047613957535, 697.52305237026349),
-                            (1303.6542557465727, 697.52305237026349),
-                            (953.60567493512144, 740.39597570556316),
-                            (957.91890612112604, 740.39597570556316),
-                            (1027.0080928255736, 784.70486151318767),
-                            (1031.3650789520013, 784.70486151318767),
-                            (1241.625753053888, 830.10892664282756),
-                            (1245.9181149708163, 830.10892664282756),
-                            (1266.796600696397, 874.17188807394371),
-                            (1271.1082253968038, 874.17188807394371),
-                            (1404.8881828516335, 919.85774261912377),
-                            (1409.9449171925908, 919.85774261912377),
-                            (1325.0207484270156, 963.32163630950686),
-                            (1329.3681702175545, 963.32163630950686),
-                            (1185.9570564396361, 1007.0164717446025),
-                            (1190.2368155733498, 1007.0164717446025),
-                            (1306.6628878384579, 1051.9073888851103),
-                            (1310.9679069215179, 1051.9073888851103),
-                            (1151.3860791138529, 1095.4860726831637),
-                            (1155.7367238283309, 1095.4860726831637),
-                            (1224.7162502034391, 1140.436681012593),
-                            (1229.0598756552718, 1140.436681012593),
-                            (904.70409145100268, 1183.267412335555),
-                            (908.99297982589781, 1183.267412335555),
-                            (978.00762214758913, 1227.9731804278615),
-                            (982.41054057239705, 1227.9731804278615),
-                            (869.65543493075677, 1271.3564678397893),
-                            (873.95299108698168, 1271.3564678397893),
-                            (942.99396243198464, 1316.2391922602001),
-                            (947.36667894787513, 1316.2391922602001),
-                            (1256.7806430753744, 1361.195495916817),
-                            (1261.0847133245632, 1361.195495916817),
-                            (1330.1305637595844, 1406.3795550431571),
-                            (1334.3960288420271, 1406.3795550431571),
-                            (1060.9423305503171, 1449.3586376395574),
-                            (1065.3182032594575, 1449.3586376395574),
-                            (1108.6465868246237, 1493.9756362677167),
-                            (1112.9382994207679, 1493.9756362677167),
-                            (662.84522896384874, 1536.9734554153649),
-                            (667.12956877347722, 1536.9734554153649),
-                            (712.5287834914659, 1581.2712766110319),
-                            (716.80585127180609, 1581.2712766110319),
-                            (956.48762939159371, 1626.1728182002655),
-                            (960.9581522740466, 1626.1728182002655),
-                            (723.23974640617337, 1670.0165354200499),
-                            (727.67208274341931, 1670.0165354200499),
-                            (1172.3594885486252, 1715.8650599984883),
-                            (1176.8341929555718, 1715.8650599984883),
-                            (1015.7329598422145, 1759.5446833817025),
-                            (1020.1920698607528, 1759.5446833817025),
-                            (935.82358262678224, 1803.5644982617907),
-                            (940.3126440130676, 1803.5644982617907),
-                            (989.98752991018682, 1847.9507718487364),
-                            (994.40511955530712, 1847.9507718487364),
-                            (1278.2218422583971, 1892.8072028048214),
-                            (1282.7070969966558, 1892.8072028048214),
-                            (1351.5377751257745, 1938.5923374638328),
-                            (1355.9221844080257, 1938.5923374638328),
-                            (1171.5812780061251, 1981.4914424153424),
-                            (1176.0817255338613, 1981.4914424153424),
-                            ])
-
-        physical = np.array([ (139.917, self.bar_to_slit(92)),
-                              (139.41,  self.bar_to_slit(91)),
-                              (130.322, self.bar_to_slit(90)),
-                              (129.815, self.bar_to_slit(89)),
-                              (160.334, self.bar_to_slit(88)),
-                              (159.827, self.bar_to_slit(87)),
-                              (170.738, self.bar_to_slit(86)),
-                              (170.231, self.bar_to_slit(85)),
-                              (163.579, self.bar_to_slit(84)),
-                              (163.072, self.bar_to_slit(83)),
-                              (153.983, self.bar_to_slit(82)),
-                              (153.476, self.bar_to_slit(81)),
-                              (186.718, self.bar_to_slit(80)),
-                              (186.211, self.bar_to_slit(79)),
-                              (115.773, self.bar_to_slit(78)),
-                              (115.266, self.bar_to_slit(77)),
-                              (138.413, self.bar_to_slit(76)),
-                              (137.906, self.bar_to_slit(75)),
-                              (93.508,  self.bar_to_slit(74)),
-                              (93.001,  self.bar_to_slit(73)),
-                              (92.021,  self.bar_to_slit(72)),
-                              (91.514,  self.bar_to_slit(71)),
-                              (182.097, self.bar_to_slit(70)),
-                              (181.59,  self.bar_to_slit(69)),
-                              (172.502, self.bar_to_slit(68)),
-                              (171.995, self.bar_to_slit(67)),
-                              (182.905, self.bar_to_slit(66)),
-                              (182.398, self.bar_to_slit(65)),
-                              (113.665, self.bar_to_slit(64)),
-                              (113.158, self.bar_to_slit(63)),
-                              (104.069, self.bar_to_slit(62)),
-                              (103.562, self.bar_to_slit(61)),
-                              (149.161, self.bar_to_slit(60)),
-                              (148.654, self.bar_to_slit(59)),
-                              (139.566, self.bar_to_slit(58)),
-                              (139.059, self.bar_to_slit(57)),
-                              (111.528, self.bar_to_slit(56)),
-                              (111.021, self.bar_to_slit(55)),
-                              (108.22,  self.bar_to_slit(54)),
-                              (107.713, self.bar_to_slit(53)),
-                              (90.189,  self.bar_to_slit(52)),
-                              (89.681,  self.bar_to_slit(51)),
-                              (100.593, self.bar_to_slit(50)),
-                              (100.086, self.bar_to_slit(49)),
-                              (118.731, self.bar_to_slit(48)),
-                              (118.223, self.bar_to_slit(47)),
-                              (102.94,  self.bar_to_slit(46)),
-                              (102.432, self.bar_to_slit(45)),
-                              (123.212, self.bar_to_slit(44)),
-                              (122.704, self.bar_to_slit(43)),
-                              (113.615, self.bar_to_slit(42)),
-                              (113.108, self.bar_to_slit(41)),
-                              (155.354, self.bar_to_slit(40)),
-                              (154.847, self.bar_to_slit(39)),
-                              (145.759, self.bar_to_slit(38)),
-                              (145.251, self.bar_to_slit(37)),
-                              (159.887, self.bar_to_slit(36)),
-                              (159.38,  self.bar_to_slit(35)),
-                              (150.292, self.bar_to_slit(34)),
-                              (149.785, self.bar_to_slit(33)),
-                              (109.338, self.bar_to_slit(32)),
-                              (108.83,  self.bar_to_slit(31)),
-                              (99.742,  self.bar_to_slit(30)),
-                              (99.235,  self.bar_to_slit(29)),
-                              (134.842, self.bar_to_slit(28)),
-                              (134.335, self.bar_to_slit(27)),
-                              (128.616, self.bar_to_slit(26)),
-                              (128.109, self.bar_to_slit(25)),
-                              (186.778, self.bar_to_slit(24)),
-                              (186.271, self.bar_to_slit(23)),
-                              (180.272, self.bar_to_slit(22)),
-                              (179.765, self.bar_to_slit(21)),
-                              (148.417, self.bar_to_slit(20)),
-                              (147.91,  self.bar_to_slit(19)),
-                              (178.822, self.bar_to_slit(18)),
-                              (178.314, self.bar_to_slit(17)),
-                              (120.197, self.bar_to_slit(16)),
-                              (119.689, self.bar_to_slit(15)),
-                              (140.601, self.bar_to_slit(14)),
-                              (140.094, self.bar_to_slit(13)),
-                              (151.005, self.bar_to_slit(12)),
-                              (150.498, self.bar_to_slit(11)),
-                              (143.947, self.bar_to_slit(10)),
-                              (143.44,  self.bar_to_slit(9)),
-                              (106.313, self.bar_to_slit(8)),
-                              (105.806, self.bar_to_slit(7)),
-                              (96.717,  self.bar_to_slit(6)),
-                              (96.21,   self.bar_to_slit(5)),
-                              (120.202, self.bar_to_slit(4)),
-                              (119.695, self.bar_to_slit(3)),
-                              ])
-
-        tick = dt.now()
-        self.fit_transforms(pixels, physical)
-        tock = dt.now()
-        elapsed = (tock-tick).total_seconds()
-        print('  Fitted transforms in {:.3f} s'.format(elapsed))
-
-        ## Determine slit angle and bar center to center distance in pixels
-        ## from the transformation and the known longslit positions
-        ##   in longslit, bar 02 is at 145.472
-        ##   in longslit, bar 92 is at 129.480
-        physical = [ [145.472, self.bar_to_slit(2)],
-                     [129.480, self.bar_to_slit(92)] ]
-        pixels = self.physical_to_pixel(physical)
-        dx = pixels[1][0] - pixels[0][0]
-        dy = pixels[0][1] - pixels[1][1]
-        self.slit_angle_pix = np.arctan(dx/dy)
-        print("Slit Angle on CCD = {:.3f} deg".format(self.slit_angle_pix * 180./np.pi))
-        self.slit_height_pix = dy / (self.bar_to_slit(92) - self.bar_to_slit(2))
-        print("Slit Height on CCD = {:.3f} pix".format(self.slit_height_pix))
+        # fitted pixel <-> physical transforms for the calibration epoch
+        # in use, loaded on first use
+        self.calibrations = csu_calibration.get_store(
+            self.settings.get('calibration_store', None), logger=self.logger)
+        self.transforms = None
 
 
     def build_gui(self, container):
@@ -393,10 +256,10 @@ class CSU_initializer(GingaPlugin.LocalPlugin):
         self.w.update(b)
 
         bar_num = self.settings.get('bar_num', 1)
-        b.bar_num.set_text('{:2d}'.format(bar_num))
+        b.bar_num.set_text(str(bar_num))
         b.set_bar_num.set_text(str(bar_num))
         b.set_bar_num.add_callback('activated', self.set_bar_num_cb)
-        b.set_bar_num.set_tooltip("Set bar number")
+        b.set_bar_num.set_tooltip("Set bar number, or bars (e.g. 1-10,15 or all)")
 
         bar_dist = self.settings.get('bar_dist', 0.0)
         b.bar_dist.set_text('{:+.1f}'.format(bar_dist))
@@ -424,11 +287,20 @@ class CSU_initializer(GingaPlugin.LocalPlugin):
 
         captions = (('Overlay bar positions from csu_bar_state file', 'button'),
                     ('Overlay bar positions from FITS header', 'button'),
+                    ('State file: ', 'label', 'set_state_file', 'entry'),
+                    ('Live update', 'checkbutton'),
                     ('Clear', 'button'))
     
         w, b = Widgets.build_info(captions, orientation=orientation)
         self.w.update(b)
 
+        b.set_state_file.set_text(self.settings.get('csu_bar_state') or '')
+        b.set_state_file.add_callback('activated', self.set_state_file_cb)
+        b.set_state_file.set_tooltip("csu_bar_state file, or a directory of them")
+        b.live_update.set_tooltip("Follow the state file as it changes")
+        b.live_update.set_state(False)
+        b.live_update.add_callback('activated', self.live_update_cb)
+
         b.overlay_bar_positions_from_csu_bar_state_file.add_callback('activated',
                    lambda w: self.overlaybars_from_file())
         b.overlay_bar_positions_from_fits_header.add_callback('activated',
@@ -439,6 +311,59 @@ class CSU_initializer(GingaPlugin.LocalPlugin):
         vbox.add_widget(fr5, stretch=0)
 
 
+        ## -----------------------------------------------------
+        ## History
+        ## -----------------------------------------------------
+        fr7 = Widgets.Frame("History")
+
+        captions = (('History:', 'label', 'history', 'hscale'),
+                    ('State:', 'label', 'history_state', 'llabel'),
+                    ('Play', 'button', 'Pause', 'button', 'Latest', 'button',
+                     'Load Stored', 'button'))
+        w, b = Widgets.build_info(captions, orientation=orientation)
+        self.w.update(b)
+
+        b.history.set_limits(0, 0, incr_value=1)
+        b.history.set_tracking(True)
+        b.history.set_tooltip("Scrub through the bar states seen so far")
+        b.history.add_callback('value-changed', self.history_scrub_cb)
+        b.play.add_callback('activated', lambda w: self.play_history())
+        b.pause.add_callback('activated', lambda w: self.pause_history())
+        b.latest.add_callback('activated', lambda w: self.follow_latest())
+        b.latest.set_tooltip("Show the newest state and follow updates")
+        b.load_stored.add_callback('activated',
+                                   lambda w: self.load_history_from_store())
+        b.load_stored.set_tooltip("Load the recent states kept on disk")
+        fr7.set_widget(w)
+        vbox.add_widget(fr7, stretch=0)
+        self.update_history_gui()
+
+
+        ## -----------------------------------------------------
+        ## Latency
+        ## -----------------------------------------------------
+        fr6 = Widgets.Expander("Latency")
+
+        vbox6 = Widgets.VBox()
+        tw_latency = Widgets.TextArea(wrap=False, editable=False)
+        tw_latency.set_font(self.fv.get_font("fixed", 10))
+        self.w.tw_latency = tw_latency
+        vbox6.add_widget(tw_latency, stretch=1)
+
+        captions = (('Refresh', 'button', 'Reset', 'button',
+                     'Save', 'button'),)
+        w, b = Widgets.build_info(captions, orientation=orientation)
+        self.w.update(b)
+        b.refresh.add_callback('activated', lambda w: self.update_latency())
+        b.reset.add_callback('activated', lambda w: self.reset_latency())
+        b.save.add_callback('activated', lambda w: self.save_latency())
+        b.save.set_tooltip("Append the latency stats to the latency file")
+        vbox6.add_widget(w, stretch=0)
+
+        fr6.set_widget(vbox6)
+        vbox.add_widget(fr6, stretch=0)
+
+
         ## -----------------------------------------------------
         ## Spacer
         ## -----------------------------------------------------
@@ -502,6 +427,14 @@ class CSU_initializer(GingaPlugin.LocalPlugin):
             # Add ruler layer
             p_canvas.add(self.canvas, tag=self.layertag)
 
+        t_ = self.fitsimage.get_settings()
+        t_.get_setting('scale').add_callback('set', self.zoom_cb)
+        t_.get_setting('pan').add_callback('set', self.view_changed_cb)
+        self.set_lod(self.lod_for_scale(self.fitsimage.get_scale()))
+
+        self.update_latency()
+        self.latency_timer.set(self.settings.get('latency_refresh_interval',
+                                                 2.0))
         self.resume()
 
     def pause(self):
@@ -537,7 +470,14 @@ class CSU_initializer(GingaPlugin.LocalPlugin):
         closed for modal operations, and may be omitted if there is no
         special cleanup required when stopping.
         """
-        pass
+        self.latency_timer.cancel()
+        self.history_timer.cancel()
+        self.stop_live()
+        self.stop_controller()
+        self.cull_timer.cancel()
+        t_ = self.fitsimage.get_settings()
+        t_.get_setting('scale').remove_callback('set', self.zoom_cb)
+        t_.get_setting('pan').remove_callback('set', self.view_changed_cb)
 
     def redo(self):
         """
@@ -561,150 +501,784 @@ class CSU_initializer(GingaPlugin.LocalPlugin):
     ##  Coordinate Transformation Utilities
     ## ------------------------------------------------------------------
     def slit_to_bars(self, slit):
-        return (slit*2-1, slit*2)
+        return csu_transforms.slit_to_bars(slit)
 
     def bar_to_slit(self, bar):
-        return int((bar+1)/2)
-
-    def pad(self, x):
-        return np.hstack([x, np.ones((x.shape[0], 1))])
-
-    def unpad(self, x):
-        return x[:,:-1]
-
-    def fit_transforms(self, pixels, physical):
-        assert pixels.shape[1] == 2
-        assert physical.shape[1] == 2
-        assert pixels.shape[0] == physical.shape[0]
-
-        # Pad the data with ones, so that our transformation can do translations too
-        n = pixels.shape[0]
-        pad = lambda x: np.hstack([x, np.ones((x.shape[0], 1))])
-        unpad = lambda x: x[:,:-1]
-        X = pad(pixels)
-        Y = pad(physical)
-
-        # Solve the least squares problem X * A = Y
-        # to find our transformation matrix A
-        A, res, rank, s = np.linalg.lstsq(X, Y)
-        Ainv, res, rank, s = np.linalg.lstsq(Y, X)
-        A[np.abs(A) < 1e-10] = 0
-        Ainv[np.abs(A) < 1e-10] = 0
-        self.Apixel_to_physical = A
-        self.Aphysical_to_pixel = Ainv
+        return csu_transforms.bar_to_slit(bar)
+
+    def get_transforms(self):
+        """
+        Return the transforms in use, loading those of the latest
+        calibration epoch (or of the calibration_epoch setting) if none
+        have been selected yet.
+        """
+        if self.transforms is None:
+            self.transforms = self.transforms_for_header(None)
+        return self.transforms
+
+    def transforms_for_header(self, header):
+        """
+        Return the transforms of the epoch named by the calibration_epoch
+        setting, else of the epoch valid for an image header.
+        """
+        name = self.settings.get('calibration_epoch', None)
+        if name is not None:
+            return self.calibrations.get_transforms(name)
+        return self.calibrations.transforms_for_header(header)
+
+    def select_calibration(self, header):
+        """
+        Switch to the calibration epoch valid for an image header.  If the
+        epoch changes, any existing overlay is cleared since its geometry
+        no longer applies.
+        """
+        self.set_transforms(self.transforms_for_header(header))
+
+    def set_transforms(self, transforms):
+        if self.transforms is not None and transforms is not self.transforms:
+            self.clear_canvas()
+        self.transforms = transforms
 
     def pixel_to_physical(self, x):
-        x = np.array(x)
-        result = self.unpad(np.dot(self.pad(x), self.Apixel_to_physical))
-        return result
+        return csu_transforms.apply_transform(
+            self.get_transforms().Apixel_to_physical, x)
 
     def physical_to_pixel(self, x):
-        x = np.array(x)
-        result =  self.unpad(np.dot(self.pad(x), self.Aphysical_to_pixel))
-        return result
+        return csu_transforms.apply_transform(
+            self.get_transforms().Aphysical_to_pixel, x)
 
     ## ------------------------------------------------------------------
     ##  Read Bar Positions and Overlay
     ## ------------------------------------------------------------------
     def read_csu_bar_state(self, filename):
-        with open(filename, 'r') as FO:
-            lines = FO.readlines()
-        bars = {}
-        state = {}
-        state_trans = {0: 'OK', 1: 'SETUP', 2: 'MOVING', -3: 'ERROR'}
-        for line in lines:
-            barno, pos, statestr = line.strip('\n').split(',')
-            bars[int(barno)] = float(pos)
-            state[int(barno)] = state_trans[int(statestr)]
-        return bars, state
+        return csu_bars.load_bar_state(filename, kind='csu_bar_state')
 
     def read_bars_from_header(self, header):
-        bars = {}
-        for i in range(1,93):
-            bars[i] = float(header['B{:02d}POS'.format(i)])
-        return bars
-
-    def overlaybars(self, bars, state=None):
-        colormap = {'OK': 'green', 'ERROR': 'red'}
-        draw_height = 0.45
-        for j in range(1, 47):
-            b1, b2 = self.slit_to_bars(j)
-
-            physical1 = [ [8.0, j-draw_height],
-                          [8.0, j+draw_height],
-                          [bars[b1], j+draw_height],
-                          [bars[b1], j-draw_height] ]
-            physical1 = np.array(physical1)
-            pixels1 = self.physical_to_pixel(physical1)
-            pixels1[2][0] += draw_height * self.slit_height_pix * np.sin(self.slit_angle_pix)
-            pixels1[3][0] -= draw_height * self.slit_height_pix * np.sin(self.slit_angle_pix)
-
-            physical2 = [ [270.4+2.0, j-draw_height],
-                          [270.4+2.0, j+draw_height],
-                          [bars[b2], j+draw_height],
-                          [bars[b2], j-draw_height] ]
-            physical2 = np.array(physical2)
-            pixels2 = self.physical_to_pixel(physical2)
-            pixels2[2][0] += draw_height * self.slit_height_pix * np.sin(self.slit_angle_pix)
-            pixels2[3][0] -= draw_height * self.slit_height_pix * np.sin(self.slit_angle_pix)
-
-            try:
-                b1color = colormap[state[b1]]
-            except:
-                b1color = 'blue'
-            try:
-                b2color = colormap[state[b2]]
-            except:
-                b2color = 'blue'
-
-            self.canvas.add(self.dc.Polygon(pixels1, color=b1color))
-            self.canvas.add(self.dc.Polygon(pixels2, color=b2color))
-            x1, y1 = self.physical_to_pixel([[14.0, j+0.3]])[0]
-            self.canvas.add(self.dc.Text(x1, y1, '{:d}'.format(b1),
-                                         fontsize=10, color='white'))
-            x2, y2 = self.physical_to_pixel([[270.4-2.0, j+0.3]])[0]
-            self.canvas.add(self.dc.Text(x2, y2, '{:d}'.format(b2),
-                                         fontsize=10, color='white'))
+        return csu_bars.load_bar_state(header, kind='header')
+
+    def bar_geometry(self, bars, barnos=None, draw_height=0.45):
+        """
+        Compute the outline of each bar and the anchor of its label in
+        pixel coordinates; see `csu_transforms.bar_geometry`.  The
+        geometry of all the bars is shared with the other channels
+        through `csu_transforms.cached_bar_geometry`.
+        """
+        if barnos is None:
+            return csu_transforms.cached_bar_geometry(
+                self.get_transforms(), bars, draw_height=draw_height)
+        return csu_transforms.bar_geometry(self.get_transforms(), bars,
+                                           barnos=barnos,
+                                           draw_height=draw_height)
+
+    def bar_mask(self, by='bar'):
+        """
+        Return the mask of the pixels of the image covered by each bar
+        (or slit, with ``by='slit'``) of the bar state shown; see
+        `csu_raster.coverage_mask`.
+        """
+        if self.bar_state is None:
+            raise ValueError("No bar state shown")
+        image = self.fitsimage.get_image()
+        shape = csu_raster.detector_shape if image is None else \
+                (image.height, image.width)
+        return csu_raster.coverage_mask(self.get_transforms(), self.bar_state,
+                                        shape=shape, by=by)
+
+    def bar_color_array(self, bar_state):
+        return bar_state.colors({'OK': 'green', 'ERROR': 'red'}, 'blue')
+
+    def overlaybars(self, bars, state=None, prepared=None):
+        """
+        Draw the bars, or bring an existing overlay up to date.  ``bars``
+        is a `csu_bars.BarState` (or a dict of positions, with ``state`` a
+        dict of status strings).  When the overlay is already on the
+        canvas only the bars whose position or status changed are
+        touched, followed by a single redraw.  ``prepared`` is the result
+        of `prepare_overlay` for ``bars``, if it was called beforehand.
+        """
+        with instrument.span('draw.overlay'):
+            bar_state = csu_bars.as_bar_state(bars, state=state)
+            bar_colors = self.bar_color_array(bar_state)
+
+            if self.lod_mode == 'raster':
+                self._draw_raster_overlay(bar_state, bar_colors)
+                self.bar_state = bar_state
+                self.bar_colors = bar_colors
+                return
+
+            if self.bar_compound is not None and \
+                   not np.array_equal(bar_state.bar, self.bar_state.bar):
+                # a different set of bars; start over
+                self.canvas.delete_object_by_tag('bars', redraw=False)
+                self.bar_objs = {}
+                self.bar_compound = None
+                self.bar_visible = None
+
+            if self.bar_compound is None:
+                if prepared is None or prepared.bar_state is not bar_state or \
+                       prepared.bar_objs is None:
+                    prepared = self.prepare_overlay(bar_state,
+                                                    build_objects=True)
+                self._add_bar_overlay(prepared)
+            else:
+                moved, status_changed = bar_state.diff(self.bar_state)
+                recolored = bar_colors != self.bar_colors
+                if not np.any(moved | recolored):
+                    instrument.count('draw.overlay_unchanged')
+                    return
+                if np.any(moved):
+                    moved_barnos, polygons, labels = self.bar_geometry(
+                        bar_state, barnos=bar_state.bar[moved])
+                    for b, points in zip(moved_barnos, polygons):
+                        self.bar_objs['bar{:02d}'.format(b)].points = points
+                for b, color in zip(bar_state.bar[recolored],
+                                    bar_colors[recolored]):
+                    self.bar_objs['bar{:02d}'.format(b)].color = color
+                instrument.count('draw.bars_moved', int(np.sum(moved)))
+                if np.any(moved):
+                    self.cull_bars(bar_state)
+                with instrument.span('redraw.overlay'):
+                    self.canvas.update_canvas(whence=3)
+
+        self.bar_state = bar_state
+        self.bar_colors = bar_colors
+
+    def prepare_overlay(self, bar_state, transforms=None,
+                        build_objects=False):
+        """
+        Do the work of an overlay that does not touch the canvas: bar
+        colors, geometry and, with ``build_objects``, the canvas objects
+        of a complete overlay.  Safe to call off the GUI thread.
+        """
+        if transforms is None:
+            transforms = self.get_transforms()
+        barnos, polygons, labels = csu_transforms.cached_bar_geometry(
+            transforms, bar_state)
+        prepared = Bunch.Bunch(bar_state=bar_state,
+                               bar_colors=self.bar_color_array(bar_state),
+                               bar_objs=None, compound=None)
+        if build_objects:
+            bar_objs, objs = {}, []
+            for b, color, points, (x, y) in zip(
+                    barnos.tolist(), prepared.bar_colors, polygons, labels):
+                polygon = self.dc.Polygon(points, color=color)
+                label = self.dc.Text(x, y, '{:d}'.format(b),
+                                     fontsize=10, color='white')
+                bar_objs['bar{:02d}'.format(b)] = polygon
+                bar_objs['label{:02d}'.format(b)] = label
+                objs.extend([polygon, label])
+            prepared.bar_objs = bar_objs
+            # everything as one object so the canvas is redrawn only once
+            prepared.compound = self.dc.CompoundObject(*objs)
+        return prepared
+
+    def _draw_raster_overlay(self, bar_state, bar_colors):
+        if self.bar_raster is not None and self.bar_state is not None:
+            moved, status_changed = bar_state.diff(self.bar_state)
+            if not np.any(moved | (bar_colors != self.bar_colors)):
+                instrument.count('draw.overlay_unchanged')
+                return
+        image = self.fitsimage.get_image()
+        shape = csu_raster.detector_shape if image is None else \
+                (image.height, image.width)
+        step = self.settings.get('lod_raster_step', 4)
+        rgba = csu_raster.coverage_image(
+            self.get_transforms(), bar_state, bar_colors, shape, step=step,
+            alpha=self.settings.get('lod_raster_alpha', 0.5))
+        rgbimage = RGBImage.RGBImage(data_np=rgba, logger=self.logger)
+        if self.bar_raster is None:
+            self.bar_raster = self.dc.Image(0, 0, rgbimage, scale_x=step,
+                                            scale_y=step)
+            with instrument.span('redraw.overlay_full'):
+                self.canvas.add(self.bar_raster, tag='bars-raster',
+                                redraw=True)
+        else:
+            self.bar_raster.set_image(rgbimage)
+            with instrument.span('redraw.overlay'):
+                self.canvas.update_canvas(whence=0)
+
+    def lod_for_scale(self, scale):
+        if max(np.atleast_1d(scale)) < self.settings.get('lod_scale', 0.5):
+            return 'raster'
+        return 'vector'
+
+    def set_lod(self, mode):
+        """
+        Switch the overlay between 'vector' (polygons and labels) and
+        'raster' (one coverage image) and redraw it in the new form.
+        """
+        if mode == self.lod_mode:
+            return
+        self.lod_mode = mode
+        if self.bar_state is None:
+            return
+        bar_state = self.bar_state
+        self.canvas.delete_objects_by_tag(['bars', 'bars-raster'],
+                                          redraw=False)
+        self.bar_objs = {}
+        self.bar_compound = None
+        self.bar_visible = None
+        self.bar_raster = None
+        self.bar_state = None
+        self.overlaybars(bar_state)
+
+    def cull_bars(self, bar_state):
+        """
+        Keep in the overlay only the bars, and their labels, whose
+        bounding box meets the region in view, enlarged on each side by
+        cull_margin of its size.  Returns True if the bars drawn changed.
+        """
+        x1, y1, x2, y2 = self.fitsimage.get_datarect()
+        margin = self.settings.get('cull_margin', 0.1) * max(x2 - x1,
+                                                              y2 - y1)
+        index = csu_transforms.cached_bar_index(self.get_transforms(),
+                                                bar_state)
+        visible = index.query(x1 - margin, y1 - margin,
+                              x2 + margin, y2 + margin)
+        if self.bar_visible is not None and \
+               np.array_equal(visible, self.bar_visible):
+            return False
+        self.bar_visible = visible
+        objs = []
+        for b in bar_state.bar[visible]:
+            objs.extend([self.bar_objs['bar{:02d}'.format(b)],
+                         self.bar_objs['label{:02d}'.format(b)]])
+        self.bar_compound.objects = objs
+        instrument.count('draw.bars_culled', int(np.sum(~visible)))
+        return True
+
+    def _add_bar_overlay(self, prepared):
+        self.bar_objs = prepared.bar_objs
+        self.bar_compound = prepared.compound
+        self.bar_visible = None
+        with instrument.span('redraw.overlay_full'):
+            # added whole, so that every object is set up for the
+            # viewer, then culled before the one redraw
+            self.canvas.add(self.bar_compound, tag='bars', redraw=False)
+            self.cull_bars(prepared.bar_state)
+            self.canvas.update_canvas(whence=3)
+
+    def get_state_file(self):
+        """
+        Return the csu_bar_state file (or directory) to read, or None
+        after telling the user that none is set.
+        """
+        filename = self.settings.get('csu_bar_state', None)
+        if not filename:
+            self.fv.show_error("No csu_bar_state file set")
+            return None
+        return filename
 
     def overlaybars_from_file(self):
-        bars, state = self.read_csu_bar_state('/Users/jwalawender/MOSFIRE_Test_Data/20170414/csu_bar_state')
-        self.overlaybars(bars, state=state)
+        filename = self.get_state_file()
+        if filename is not None:
+            self.start_overlay_job(self.load_overlay_from_file, filename)
+
+    def read_live_bar_state(self, filename):
+        bar_state = self.read_csu_bar_state(filename)
+        # the controller may be midway through rewriting the file
+        if not bar_state.is_complete():
+            raise ValueError("incomplete bar state ({:d} bars)".format(
+                len(bar_state)))
+        return bar_state
+
+    def start_live(self):
+        self.stop_live()
+        filename = self.get_state_file()
+        if filename is None:
+            self.w.live_update.set_state(False)
+            return
+        self.watcher = BarStateWatcher(
+            filename, self.read_live_bar_state,
+            lambda bar_state: self.fv.gui_do(self.record_bar_state,
+                                             bar_state),
+            poll_interval=self.settings.get('live_poll_interval', 0.1),
+            max_rate=self.settings.get('live_max_rate', 5.0),
+            logger=self.logger)
+        self.watcher.start()
+
+    def stop_live(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
 
     def overlaybars_from_header(self):
         ## Get header
         channel = self.fv.get_channel(self.chname)
         image = channel.get_current_image()
-        header = image.get_header()
-        bars = self.read_bars_from_header(header)
-        self.overlaybars(bars)
+        if image is None:
+            self.fv.show_error("No image in channel '{}'".format(self.chname))
+            return
+        self.start_overlay_job(self.load_overlay_from_header,
+                               image.get_header())
+
+    ## ------------------------------------------------------------------
+    ##  Overlay Pipeline
+    ## ------------------------------------------------------------------
+    def start_overlay_job(self, loader, source):
+        """
+        Load and prepare an overlay on a worker thread, then draw it on
+        the GUI thread.  ``loader(source)`` returns a Bunch with the
+        ``bar_state``, the ``transforms`` to switch to (or None) and the
+        ``obstime`` of the state.  Starting a job makes any job still in
+        flight stale: it stops at its next stage and is never drawn.
+        """
+        self.overlay_job += 1
+        self.fv.nongui_do(self._run_overlay_job, self.overlay_job, loader,
+                          source)
+
+    def load_overlay_from_file(self, filename):
+        return Bunch.Bunch(bar_state=self.read_csu_bar_state(filename),
+                           transforms=None, obstime=None)
+
+    def load_overlay_from_header(self, header):
+        return Bunch.Bunch(bar_state=self.read_bars_from_header(header),
+                           transforms=self.transforms_for_header(header),
+                           obstime=csu_store.header_time(header))
+
+    def _run_overlay_job(self, job, loader, source):
+        # worker thread
+        try:
+            with instrument.span('load.overlay_job'):
+                result = loader(source)
+            if job != self.overlay_job:
+                instrument.count('load.overlay_jobs_stale')
+                return
+            transforms = result.transforms
+            if transforms is None:
+                transforms = self.get_transforms()
+            # canvas objects are only needed if the overlay is built anew
+            build = self.lod_mode == 'vector' and \
+                    (self.bar_compound is None or
+                     transforms is not self.transforms)
+            with instrument.span('transform.overlay_job'):
+                prepared = self.prepare_overlay(result.bar_state,
+                                                transforms=transforms,
+                                                build_objects=build)
+        except Exception as e:
+            if job == self.overlay_job:
+                msg = "missing keyword {}".format(str(e)) \
+                      if isinstance(e, KeyError) else str(e)
+                self.fv.gui_do(self.fv.show_error,
+                               "Could not load the bar overlay: " + msg)
+            return
+        self.fv.gui_do(self._apply_overlay_job, job, result, prepared)
+
+    def _apply_overlay_job(self, job, result, prepared):
+        # GUI thread
+        if job != self.overlay_job:
+            instrument.count('load.overlay_jobs_stale')
+            return
+        if result.transforms is not None:
+            self.set_transforms(result.transforms)
+        self.record_bar_state(result.bar_state, follow=True,
+                              obstime=result.obstime, prepared=prepared)
+
+    ## ------------------------------------------------------------------
+    ##  Bar State History
+    ## ------------------------------------------------------------------
+    def record_bar_state(self, bar_state, follow=False, obstime=None,
+                         prepared=None):
+        """
+        Add a bar state to the history and the bar store and show it,
+        unless an older state is being viewed.  ``follow`` goes back to
+        following the newest state first.  ``obstime`` is the time the
+        state was recorded, if the state does not say, and ``prepared``
+        is passed on to `overlaybars`.
+        """
+        if follow:
+            self.pause_history()
+            self.history_index = None
+        if bar_state.is_complete():
+            if self.history.append(bar_state):
+                self.store_bar_state(bar_state, obstime=obstime)
+        if self.history_index is None:
+            self.overlaybars(bar_state, prepared=prepared)
+        self.update_history_gui()
+
+    def get_bar_store(self):
+        if self.bar_store is None:
+            path = self.settings.get('bar_store', None)
+            if path is None:
+                path = os.path.join(paths.ginga_home, 'csu_store')
+            self.bar_store = csu_store.get_store(path, logger=self.logger)
+        return self.bar_store
+
+    def store_bar_state(self, bar_state, obstime=None):
+        """
+        With the record_bar_states setting, append a settled bar state
+        to the bar store: the directory given by the bar_store setting,
+        or ``csu_store`` in the Ginga home directory.  States with bars
+        still moving are only kept in the history.
+        """
+        if not self.settings.get('record_bar_states', False):
+            return
+        if np.any(bar_state.with_status('MOVING')):
+            return
+        # the disk write is kept off the GUI thread
+        self.fv.nongui_do(self._append_to_store, self.get_bar_store(),
+                          bar_state, obstime)
+
+    def _append_to_store(self, store, bar_state, obstime):
+        try:
+            store.append(bar_state, obstime=obstime)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.error("Could not record bar state in '{}': {}".format(
+                store.path, str(e)))
+
+    def load_history_from_store(self):
+        """
+        Replace the history with the newest states in the bar store from
+        the last ``history_load_days`` days.
+        """
+        store = self.get_bar_store()
+        days = self.settings.get('history_load_days', 1.0)
+        try:
+            res = store.query(start=time.time() - days * 86400.0)
+        except (IOError, OSError, ValueError) as e:
+            self.fv.show_error("Could not read '{}': {}".format(
+                store.path, str(e)))
+            return
+        self.pause_history()
+        self.history.clear()
+        first = max(len(res.time) - self.history.capacity, 0)
+        for t, pos, status in zip(res.time[first:], res.pos[first:],
+                                  res.status[first:]):
+            self.history.append(csu_bars.BarState.from_arrays(
+                pos, status=status, time=t, kind='store', source=store.path))
+        self.fv.show_status("Loaded {:d} bar states from {}".format(
+            len(self.history), store.path))
+        if len(self.history) > 0:
+            self.show_history(len(self.history) - 1)
+        else:
+            self.history_index = None
+            self.update_history_gui()
+
+    def viewed_history(self):
+        """Return the history being played back, else the live one."""
+        if self.playback is not None:
+            return self.playback
+        return self.history
+
+    def show_history(self, index):
+        """Overlay the state at ``index`` in the viewed history."""
+        self.history_index = index
+        self.overlaybars(self.viewed_history()[index])
+        self.update_history_gui()
+
+    def play_history(self):
+        if len(self.history) == 0:
+            return
+        self.pause_history()
+        self.playback = self.history.copy()
+        if self.history_index is None or \
+               self.history_index >= len(self.playback) - 1:
+            self.show_history(0)
+        self.history_timer.set(1.0 / self.settings.get('history_fps', 10.0))
+
+    def pause_history(self):
+        self.history_timer.cancel()
+        if self.playback is None:
+            return
+        if self.history_index is not None:
+            # the same state in the live history, or the oldest if it
+            # has been dropped since
+            self.history_index = max(self.history_index +
+                                     self.playback.dropped -
+                                     self.history.dropped, 0)
+        self.playback = None
+        self.update_history_gui()
+
+    def follow_latest(self):
+        self.pause_history()
+        self.history_index = None
+        if len(self.history) > 0:
+            self.overlaybars(self.history[-1])
+        self.update_history_gui()
+
+    def update_history_gui(self):
+        if 'history' not in self.w:
+            return
+        history = self.viewed_history()
+        n = len(history)
+        index = n - 1 if self.history_index is None else self.history_index
+        self._history_updating = True
+        try:
+            self.w.history.set_limits(0, max(n - 1, 0), incr_value=1)
+            self.w.history.set_value(max(index, 0))
+        finally:
+            self._history_updating = False
+        if n == 0:
+            text = 'none'
+        else:
+            text = '{:d} of {:d}'.format(index + 1, n)
+            t = history.times()[index]
+            if np.isfinite(t):
+                text += '  ' + time.strftime('%H:%M:%S', time.localtime(t))
+            if self.history_index is None:
+                text += '  (latest)'
+        self.w.history_state.set_text(text)
+
+    ## ------------------------------------------------------------------
+    ##  CSU Control
+    ## ------------------------------------------------------------------
+    def get_controller(self):
+        """
+        Return the running `csu_control.CSUController`, starting it (and,
+        with the csu_mock setting, a simulated CSU writing the state file)
+        if needed.  The controller speaks the provisional protocol of
+        `csu_control`, which so far only the simulated CSU implements.
+        """
+        if self.controller is not None:
+            return self.controller
+        host = self.settings.get('csu_host', csu_control.default_host)
+        port = self.settings.get('csu_port', csu_control.default_port)
+        if self.settings.get('csu_mock', False):
+            self.mock_csu = csu_control.MockCSUServer(
+                host=host, port=0,
+                state_file=self.settings.get('csu_bar_state'),
+                speed=self.settings.get('csu_mock_speed', 5.0),
+                logger=self.logger)
+            self.mock_csu.start()
+            port = self.mock_csu.port
+            self.fv.show_status("Simulated CSU on {}:{:d}".format(host, port))
+        self.controller = csu_control.CSUController(
+            host=host, port=port,
+            timeout=self.settings.get('csu_timeout', 300.0),
+            logger=self.logger)
+        self.controller.start()
+        return self.controller
+
+    def stop_controller(self):
+        if self.controller is not None:
+            self.controller.stop()
+            self.controller = None
+        if self.mock_csu is not None:
+            self.mock_csu.stop()
+            self.mock_csu = None
+
+    def send_csu_command(self, desc, method, *args, **kwargs):
+        """
+        Send a command to the CSU without waiting for it; ``method`` is
+        that of `csu_control.CSUController`.  The outcome is reported
+        on the GUI thread by `csu_command_done`.  Returns the future.
+        """
+        try:
+            future = getattr(self.get_controller(), method)(*args, **kwargs)
+        except csu_control.CSUError as e:
+            self.fv.show_error("{} failed: {}".format(desc, str(e)))
+            return None
+        self.fv.show_status("{} sent to the CSU".format(desc))
+        future.add_done_callback(
+            lambda f: self.fv.gui_do(self.csu_command_done, desc, f))
+        return future
+
+    def csu_command_done(self, desc, future):
+        try:
+            bar_state = future.result()
+        except Exception as e:
+            self.fv.show_error("{} failed: {}".format(desc, str(e)))
+            return
+        text = ', '.join(['{:d}: {:.2f}'.format(b, p) for b, p in
+                          zip(bar_state.bar[:8], bar_state.pos[:8])])
+        if len(bar_state) > 8:
+            text += ', ...'
+        self.fv.show_status("{} done ({})".format(desc, text))
+
+    ## ------------------------------------------------------------------
+    ##  Analyze Mask Image
+    ## ------------------------------------------------------------------
+    def analyze_mask_image(self):
+        """
+        Measure the bar edges in the displayed mask image on a worker
+        thread, then overlay them next to the expected bars.  As with
+        the overlay jobs, a newer analysis makes an older one stale.
+        """
+        channel = self.fv.get_channel(self.chname)
+        image = channel.get_current_image()
+        if image is None:
+            self.fv.show_error("No image in channel '{}'".format(self.chname))
+            return
+        self.select_calibration(image.get_header())
+        instrument.count('analyze.mask_images')
+        self.analysis_job += 1
+        self.fv.show_status("Measuring bar edges...")
+        self.fv.nongui_do(self._run_analysis, self.analysis_job,
+                          image.get_data(), self.get_transforms())
+
+    def _run_analysis(self, job, data, transforms):
+        # worker thread
+        try:
+            edges = csu_edges.measure_edges(
+                data, method=self.settings.get('analysis_method', 'fast'),
+                workers=self.settings.get('analysis_workers', 0),
+                executor=self.settings.get('analysis_executor', 'thread'))
+            measured = csu_edges.edges_to_bars(edges, transforms)
+        except Exception as e:
+            if job == self.analysis_job:
+                self.fv.gui_do(self.fv.show_error,
+                               "Could not measure the bar edges: " + str(e))
+            return
+        self.fv.gui_do(self._apply_analysis, job, measured)
+
+    def _apply_analysis(self, job, measured):
+        # GUI thread
+        if job != self.analysis_job:
+            return
+        self.measured = measured
+        self.overlay_measured(measured)
+        self.fv.show_status("Measured {:d} of 92 bar edges".format(
+            int(np.sum(measured.valid))))
+
+    def overlay_measured(self, measured, draw_height=0.45):
+        """Draw a marker along the slit at each measured bar edge."""
+        barnos = np.arange(1, 93)[measured.valid]
+        mm = measured.mm[measured.valid]
+        slits = np.array([self.bar_to_slit(b) for b in barnos], dtype=float)
+        physical = np.empty((len(barnos), 2, 2))
+        physical[:,0] = np.column_stack([mm, slits-draw_height])
+        physical[:,1] = np.column_stack([mm, slits+draw_height])
+        pixels = self.physical_to_pixel(physical.reshape(-1, 2))
+        pixels = pixels.reshape(len(barnos), 2, 2)
+
+        objs = [self.dc.Line(x1, y1, x2, y2, color='yellow', linewidth=2)
+                for (x1, y1), (x2, y2) in pixels]
+        if self.canvas.has_tag('measured-edges'):
+            self.canvas.delete_object_by_tag('measured-edges', redraw=False)
+        with instrument.span('redraw.measured'):
+            self.canvas.add(self.dc.CompoundObject(*objs),
+                            tag='measured-edges', redraw=True)
+
+    ## ------------------------------------------------------------------
+    ##  Latency
+    ## ------------------------------------------------------------------
+    def update_latency(self):
+        if 'tw_latency' in self.w:
+            self.w.tw_latency.set_text(instrument.report())
+
+    def reset_latency(self):
+        instrument.reset()
+        self.update_latency()
+
+    def get_latency_file(self):
+        filename = self.settings.get('latency_file', None)
+        if filename is None:
+            filename = os.path.join(paths.ginga_home, 'csu_latency.jsonl')
+        return filename
+
+    def save_latency(self):
+        filename = self.get_latency_file()
+        try:
+            instrument.dump(filename, channel=self.chname)
+        except (IOError, OSError) as e:
+            self.fv.show_error("Could not write '{}': {}".format(
+                filename, str(e)))
+            return
+        self.fv.show_status("Latency stats appended to {}".format(filename))
 
     def clear_canvas(self):
         self.canvas.delete_all_objects()
+        self.bar_objs = {}
+        self.bar_compound = None
+        self.bar_visible = None
+        self.bar_raster = None
+        self.bar_state = None
+        self.bar_colors = None
+        self.measured = None
 
     ## ------------------------------------------------------------------
     ##  Button Callbacks
     ## ------------------------------------------------------------------
     def set_bar_num_cb(self, w):
-        bar_num = int(w.get_text())
+        text = w.get_text().strip()
+        try:
+            bars = csu_control.parse_bars(text)
+        except ValueError as e:
+            self.fv.show_error(str(e))
+            return
+        bar_num = bars[0] if len(bars) == 1 else text
         self.settings.set(bar_num=bar_num)
-        self.w.bar_num.set_text('{:2d}'.format(bar_num))
+        self.w.bar_num.set_text(str(bar_num))
 
     def initialize_bar_cb(self):
-        if self.settings.get('move_to_open'):
-            pass
-        else:
-            pass
+        bars = csu_control.parse_bars(self.settings.get('bar_num', 1))
+        move_to_open = self.settings.get('move_to_open', False)
+        self.send_csu_command('Initialize', 'initialize', bars,
+                              move_to_open=move_to_open)
 
     def move_to_open_cb(self, widget, tf):
-        self.settings.set(move_to_open_cb=tf)
+        self.settings.set(move_to_open=tf)
 
     def set_bar_dist_cb(self, w):
-        bar_dist = float(w.get_text())
+        try:
+            bar_dist = float(w.get_text())
+        except ValueError:
+            bar_dist = np.nan
+        if not np.isfinite(bar_dist):
+            self.fv.show_error("Distance must be a number of mm: '{}'".format(
+                w.get_text()))
+            return
         self.settings.set(bar_dist=bar_dist)
         self.w.bar_dist.set_text('{:+.1f}'.format(bar_dist))
 
     def move_bar_cb(self):
-        pass
+        bars = csu_control.parse_bars(self.settings.get('bar_num', 1))
+        bar_dist = self.settings.get('bar_dist', 0.0)
+        self.send_csu_command('Move', 'step',
+                              dict([(bar, bar_dist) for bar in bars]))
+
+    def set_state_file_cb(self, w):
+        self.settings.set(csu_bar_state=w.get_text().strip() or None)
+        if self.watcher is not None:
+            self.start_live()
+
+    def live_update_cb(self, widget, tf):
+        if tf:
+            self.start_live()
+        else:
+            self.stop_live()
+
+    def zoom_cb(self, setting, value):
+        self.set_lod(self.lod_for_scale(value))
+        self.view_changed_cb(setting, value)
+
+    def view_changed_cb(self, setting, value):
+        # pan and zoom come in bursts while dragging; cull the bars at
+        # most once per cull_interval
+        if not self.cull_timer.is_set():
+            self.cull_timer.set(self.settings.get('cull_interval', 0.1))
+
+    def cull_timer_cb(self, timer):
+        if self.lod_mode != 'vector' or self.bar_compound is None:
+            return
+        if self.cull_bars(self.bar_state):
+            with instrument.span('redraw.cull'):
+                self.canvas.update_canvas(whence=3)
+
+    def latency_timer_cb(self, timer):
+        self.update_latency()
+        timer.set(self.settings.get('latency_refresh_interval', 2.0))
+
+    def history_scrub_cb(self, w, val):
+        if self._history_updating or len(self.viewed_history()) == 0:
+            return
+        # the value is an index in the viewed history; pausing moves it
+        # to the live one
+        self.history_index = int(val)
+        self.pause_history()
+        self.show_history(self.history_index)
+
+    def history_timer_cb(self, timer):
+        playback = self.playback
+        if playback is None or self.history_index is None:
+            return
+        index = self.history_index + 1
+        if index < len(playback):
+            self.show_history(index)
+        if index < len(playback) - 1:
+            timer.set(1.0 / self.settings.get('history_fps', 10.0))
+        else:
+            self.pause_history()
 
     def load_cb(self):
         self.mfilesel.popup('Load bar file', self.overlaybars,
@@ -2,15 +2,14 @@
 # MultiBars.py -- Overlay expected bar positions over image
 #
 #
-import re
-import os
-import numpy as np
 from ginga import GingaPlugin, RGBImage, colors
 from ginga.gw import Widgets
 from ginga.misc import ParamSet, Bunch
 from ginga.util import dp
 from ginga.gw.GwHelp import FileSelection
 
+from plugins import csu_bars, csu_multibars, instrument
+
 class MultiBars(GingaPlugin.LocalPlugin):
     """
     MultiBars
@@ -116,7 +115,6 @@ class MultiBars(GingaPlugin.LocalPlugin):
 
     def stop(self):
         self.arrsize = None
-        self.rgbobj.set_data(self.rgbarr)
 
         # remove the canvas from the image
         p_canvas = self.fitsimage.get_canvas()
@@ -132,19 +130,14 @@ class MultiBars(GingaPlugin.LocalPlugin):
 
 ####Main function#####
     def overlaybars(self, filename):
-        bf = open(filename)
-        lines = bf.readlines()
-        for j in range(0, 46):
-            start = 12
-            height = (2044-8)/46
-            y1 = start + height*j + 0.11/0.1798
-            y2 = start + height*(j+1) - 0.11/0.1798
-            cols1 = lines[(6*j)].split()
-            cols2 = lines[(6*j)+3].split()
-            x1 = (float(cols2[2])-8.34)/0.124
-            x2 = (float(cols1[2])-8.34)/0.124
-            self.canvas.add(self.dc.Rectangle(2044, int(np.floor(y2)), x1, int(np.ceil(y1))))
-            self.canvas.add(self.dc.Rectangle(0, int(np.floor(y2)), x2, int(np.ceil(y1))))    
+        result = csu_bars.load_bar_state(filename, kind='multibars')
+        extents = csu_multibars.rectangle_extents(
+            result.pos.reshape(-1, 2))
+        with instrument.span('draw.multibars'):
+            rects = [self.dc.Rectangle(x1, y1, x2, y2)
+                     for x1, y1, x2, y2 in extents.tolist()]
+            # one compound per file, so the canvas is redrawn once
+            self.canvas.add(self.dc.CompoundObject(*rects), redraw=True)
    
 #####For loading file with popup#########
     def load_cb(self):
@@ -5,12 +5,24 @@ To enable it, run ginga with the command
     $ ginga --modules=MyLocalPlugin
 
 it should become active in the right panel.
+
+With "Auto overlay" checked, the CSU bars are drawn on every new image
+that has bar keywords.  The bar positions are read and the overlay
+computed on a worker thread, and only the drawing is done on the GUI
+thread.  New images are debounced by ``auto_overlay_debounce`` seconds,
+and when they arrive faster than the overlay is computed (readout
+bursts) the intermediate ones are dropped: each channel has at most one
+overlay in the works and always goes on to the newest image.
 """
 
 from ginga import GingaPlugin
 from ginga.gw import Widgets
 
 # import any other modules you want here--it's a python world!
+import numpy as np
+from ginga.misc import Bunch
+
+from plugins import csu_bars, csu_calibration, csu_transforms, instrument
 
 class MyGlobalPlugin(GingaPlugin.GlobalPlugin):
 
@@ -32,6 +44,21 @@ class MyGlobalPlugin(GingaPlugin.GlobalPlugin):
         self.gui_up = False
         self.tw = None
 
+        prefs = self.fv.get_preferences()
+        self.settings = prefs.createCategory('plugin_MyGlobalPlugin')
+        self.settings.setDefaults(auto_overlay=False,
+                                  auto_overlay_debounce=0.2,
+                                  calibration_store=None,
+                                  draw_height=0.45)
+        self.settings.load(onError='silent')
+
+        # auto overlay state of each channel, keyed by channel name
+        self.overlays = {}
+        self.overlay_stats = Bunch.Bunch(drawn=0, dropped=0, skipped=0)
+        self.layertag = 'csu-auto-overlay'
+        self.dc = fv.get_draw_classes()
+        self.w = Bunch.Bunch()
+
         # Subscribe to some interesting callbacks that will inform us
         # of channel events.  You may not need these depending on what
         # your plugin does
@@ -74,6 +101,20 @@ class MyGlobalPlugin(GingaPlugin.GlobalPlugin):
         fr.set_widget(tw)
         vbox.add_widget(fr, stretch=0)
 
+        fr = Widgets.Frame("Auto Overlay")
+        captions = (('Overlay CSU bars on new images', 'checkbutton'),
+                    ('Overlays:', 'label', 'overlay_stats', 'llabel'))
+        w, b = Widgets.build_info(captions, orientation=orientation)
+        self.w.update(b)
+        b.overlay_csu_bars_on_new_images.set_state(
+            self.settings.get('auto_overlay', False))
+        b.overlay_csu_bars_on_new_images.set_tooltip(
+            "Draw the bar positions from the header of each new image")
+        b.overlay_csu_bars_on_new_images.add_callback(
+            'activated', self.auto_overlay_cb)
+        fr.set_widget(w)
+        vbox.add_widget(fr, stretch=0)
+
         # Add a spacer to stretch the rest of the way to the end of the
         # plugin space
         spacer = Widgets.Label('')
@@ -103,6 +144,7 @@ class MyGlobalPlugin(GingaPlugin.GlobalPlugin):
         #cw.addWidget(widget, stretch=1)
 
         self.gui_up = True
+        self.update_overlay_stats()
 
     def get_channel_info(self, fitsimage):
         chname = self.fv.get_channel_name(fitsimage)
@@ -130,6 +172,9 @@ class MyGlobalPlugin(GingaPlugin.GlobalPlugin):
         """
         self.set_info("Channel '%s' has been deleted" % (
                 channel.name))
+        st = self.overlays.pop(channel.name, None)
+        if st is not None:
+            st.timer.cancel()
         return True
 
     def focus_cb(self, viewer, channel):
@@ -160,8 +205,164 @@ class MyGlobalPlugin(GingaPlugin.GlobalPlugin):
             imname = image.get('name', 'NONAME')
             self.set_info("A new image '%s' has been added to channel %s" % (
                 imname, chname))
+
+        if self.settings.get('auto_overlay', False):
+            self.queue_overlay(channel, image)
         return True
 
+    # AUTO OVERLAY
+
+    def get_overlay_state(self, channel):
+        st = self.overlays.get(channel.name, None)
+        if st is None:
+            canvas = self.dc.DrawingCanvas()
+            canvas.enable_draw(False)
+            canvas.set_surface(channel.fitsimage)
+            timer = self.fv.get_timer()
+            st = Bunch.Bunch(chname=channel.name, channel=channel,
+                             canvas=canvas, timer=timer, pending=None,
+                             busy=False, image=None, compound=None,
+                             polygons=None, barnos=None)
+            timer.add_callback('expired', lambda t: self.dispatch_overlay(st))
+            self.overlays[channel.name] = st
+        return st
+
+    def queue_overlay(self, channel, image):
+        """
+        Note ``image`` as the one to overlay next in its channel and
+        (re)start the debounce timer.  An image still waiting is dropped.
+        """
+        st = self.get_overlay_state(channel)
+        if st.pending is not None:
+            self.overlay_stats.dropped += 1
+            instrument.count('auto.dropped')
+        st.pending = image
+        debounce = self.settings.get('auto_overlay_debounce', 0.2)
+        if debounce > 0:
+            st.timer.set(debounce)
+        else:
+            self.dispatch_overlay(st)
+
+    def dispatch_overlay(self, st):
+        # while an overlay is being computed the newest image waits in
+        # ``pending``; it is sent when the computation comes back
+        if st.busy or st.pending is None:
+            return
+        image, st.pending = st.pending, None
+        st.busy = True
+        self.fv.nongui_do(self.compute_overlay, st, image)
+
+    def compute_overlay(self, st, image):
+        """Worker thread: read the bars and compute the overlay geometry."""
+        result = None
+        try:
+            with instrument.span('transform.auto_overlay'):
+                header = image.get_header()
+                bar_state = csu_bars.load_bar_state(header, kind='header')
+                store = csu_calibration.get_store(
+                    self.settings.get('calibration_store', None),
+                    logger=self.logger)
+                transforms = store.transforms_for_header(header)
+                barnos, polygons, labels = csu_transforms.cached_bar_geometry(
+                    transforms, bar_state,
+                    draw_height=self.settings.get('draw_height', 0.45))
+                result = Bunch.Bunch(barnos=barnos, polygons=polygons,
+                                     labels=labels,
+                                     colors=bar_state.colors(
+                                         {'OK': 'green', 'ERROR': 'red'},
+                                         'blue'))
+        except KeyError:
+            # no bar keywords: not a CSU image
+            pass
+        except Exception as e:
+            self.logger.error("Error computing the bar overlay: %s" % (
+                str(e)))
+        self.fv.gui_do(self.draw_overlay, st, image, result)
+
+    def draw_overlay(self, st, image, result):
+        """GUI thread: draw a computed overlay, unless it is stale."""
+        st.busy = False
+        if st.pending is not None:
+            # a newer image came in meanwhile; skip drawing this one
+            self.overlay_stats.dropped += 1
+            instrument.count('auto.dropped')
+            if not st.timer.is_set():
+                self.dispatch_overlay(st)
+            self.update_overlay_stats()
+            return
+        if self.overlays.get(st.chname, None) is not st or \
+               not self.settings.get('auto_overlay', False):
+            return
+
+        with instrument.span('draw.auto_overlay'):
+            canvas = st.canvas
+            if result is None:
+                self.overlay_stats.skipped += 1
+                if st.compound is not None:
+                    canvas.delete_object_by_tag('bars', redraw=True)
+                    st.compound = st.polygons = st.barnos = None
+            elif st.compound is not None and \
+                     np.array_equal(result.barnos, st.barnos):
+                # same bars: move the polygons already on the canvas
+                for polygon, points, color in zip(st.polygons,
+                                                  result.polygons,
+                                                  result.colors):
+                    polygon.points = points
+                    polygon.color = color
+                canvas.update_canvas(whence=3)
+                self.overlay_stats.drawn += 1
+            else:
+                if st.compound is not None:
+                    canvas.delete_object_by_tag('bars', redraw=False)
+                objs, polygons = [], []
+                for b, color, points, (x, y) in zip(
+                        result.barnos.tolist(), result.colors,
+                        result.polygons, result.labels):
+                    polygon = self.dc.Polygon(points, color=color)
+                    polygons.append(polygon)
+                    objs.extend([polygon,
+                                 self.dc.Text(x, y, '{:d}'.format(b),
+                                              fontsize=10, color='white')])
+                st.compound = self.dc.CompoundObject(*objs)
+                st.polygons = polygons
+                st.barnos = result.barnos
+                self.show_overlay_canvas(st)
+                canvas.add(st.compound, tag='bars', redraw=True)
+                self.overlay_stats.drawn += 1
+        st.image = image
+        self.update_overlay_stats()
+
+    def show_overlay_canvas(self, st):
+        p_canvas = st.channel.fitsimage.get_canvas()
+        try:
+            p_canvas.get_object_by_tag(self.layertag)
+        except KeyError:
+            p_canvas.add(st.canvas, tag=self.layertag, redraw=False)
+
+    def clear_overlays(self):
+        for st in self.overlays.values():
+            st.timer.cancel()
+            st.pending = None
+            p_canvas = st.channel.fitsimage.get_canvas()
+            try:
+                p_canvas.delete_object_by_tag(self.layertag)
+            except Exception:
+                pass
+        self.overlays = {}
+
+    def update_overlay_stats(self):
+        if not self.gui_up:
+            return
+        self.w.overlay_stats.set_text(
+            "{:d} drawn, {:d} dropped, {:d} without bars".format(
+                self.overlay_stats.drawn, self.overlay_stats.dropped,
+                self.overlay_stats.skipped))
+
+    def auto_overlay_cb(self, widget, tf):
+        self.settings.set(auto_overlay=tf)
+        if not tf:
+            self.clear_overlays()
+
     def start(self):
         """
         This method is called just after ``build_gui()`` when the plugin
@@ -179,6 +380,7 @@ class MyGlobalPlugin(GingaPlugin.GlobalPlugin):
         the plugin is opened and closed, and may be omitted if there is no
         special cleanup required when stopping.
         """
+        self.clear_overlays()
         self.gui_up = False
 
     def close(self):
@@ -0,0 +1,445 @@
+#
+# csu_bars.py -- Read CSU bar positions
+#
+"""
+Readers for CSU bar positions.
+
+Bar positions used to be passed around as a dict mapping bar number (1-92)
+to position in mm, and bar status, where available, as a dict mapping bar
+number to one of the strings in `state_trans`; `BarState.from_dicts` and
+`BarState.as_dicts` convert from and to those.
+
+Everything downstream works on `BarState`, a structured array with one
+record per bar, rather than on dicts.  `load_bar_state` is the one entry
+point the plugins use.  It takes a csu_bar_state file, a MultiBars bar file
+(see `plugins.csu_multibars`) or an image header, works out which it is,
+and returns a `BarState` for all three.  Results are kept in a
+size-bounded LRU `cache`, keyed by path, mtime and size for files and by
+a digest of the bar keywords for headers, so flipping between
+configurations or opening the plugins on several channels does not parse
+anything twice.  The cached states are shared
+between callers and are read only.
+"""
+import os
+import hashlib
+import threading
+import collections
+
+import numpy as np
+
+from plugins import csu_multibars, instrument
+
+# status codes written by the CSU controller in csu_bar_state
+state_trans = {0: 'OK', 1: 'SETUP', 2: 'MOVING', -3: 'ERROR'}
+# status of bars read from a source that has none (headers, bar files)
+status_unknown = 127
+status_codes = dict([(name, code) for code, name in state_trans.items()])
+status_codes['UNKNOWN'] = status_unknown
+
+nbars = 92
+
+# one record per bar, 18 bytes, fixed byte order so `BarState.to_bytes`
+# is portable
+bar_dtype = np.dtype([('bar', 'u1'), ('pos', '<f8'), ('status', 'i1'),
+                      ('time', '<f8')])
+
+
+class BarState(object):
+    """
+    The positions and status of a set of bars (normally all 92), backed
+    by a structured array of `bar_dtype` sorted by bar number: ``bar``,
+    ``pos`` in mm, ``status`` (a code of `state_trans`, or
+    `status_unknown`) and ``time``, the Unix time the position was
+    recorded (NaN if not known).
+
+    The per-bar fields are available as arrays (``bar``, ``pos``,
+    ``status``, ``time``).  ``kind`` and ``source`` say where the state
+    was read from.
+    """
+    __slots__ = ('data', 'kind', 'source')
+
+    def __init__(self, data, kind=None, source=None):
+        data = np.asarray(data, dtype=bar_dtype)
+        if len(data) > 1 and np.any(np.diff(data['bar'].astype(int)) <= 0):
+            data = np.sort(data, order='bar')
+            if np.any(np.diff(data['bar'].astype(int)) == 0):
+                raise ValueError("Duplicate bar numbers")
+        self.data = data
+        self.kind = kind
+        self.source = source
+
+    @classmethod
+    def from_arrays(cls, pos, status=None, bar=None, time=np.nan, **kwargs):
+        """
+        Make a BarState from positions in mm, with status codes (default
+        unknown) and bar numbers (default 1..n).
+        """
+        pos = np.asarray(pos, dtype=float)
+        data = np.empty(len(pos), dtype=bar_dtype)
+        data['bar'] = np.arange(1, len(pos)+1) if bar is None else bar
+        data['pos'] = pos
+        data['status'] = status_unknown if status is None else status
+        data['time'] = time
+        return cls(data, **kwargs)
+
+    @classmethod
+    def from_dicts(cls, bars, state=None, time=np.nan, **kwargs):
+        """
+        Make a BarState from a dict of bar positions and optionally a dict
+        of status strings, as returned by `as_dicts`.
+        """
+        barnos = np.array(sorted(bars.keys()), dtype=int)
+        status = None
+        if state is not None:
+            status = [status_codes.get(state.get(b), status_unknown)
+                      for b in barnos]
+        return cls.from_arrays([bars[b] for b in barnos], status=status,
+                               bar=barnos, time=time, **kwargs)
+
+    @classmethod
+    def from_bytes(cls, buf, **kwargs):
+        """Inverse of `to_bytes`; the result is a read-only view of ``buf``."""
+        return cls(np.frombuffer(buf, dtype=bar_dtype), **kwargs)
+
+    def to_bytes(self):
+        return self.data.tobytes()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return 'BarState({:d} bars, kind={!r}, source={!r})'.format(
+            len(self.data), self.kind, self.source)
+
+    @property
+    def bar(self):
+        return self.data['bar']
+
+    @property
+    def pos(self):
+        return self.data['pos']
+
+    @property
+    def status(self):
+        return self.data['status']
+
+    @property
+    def time(self):
+        return self.data['time']
+
+    def is_complete(self):
+        """True if all 92 bars are present."""
+        return len(self.data) == nbars
+
+    def set_readonly(self):
+        self.data.flags.writeable = False
+        return self
+
+    def index_of(self, barnos):
+        """
+        Return the indices of bar numbers ``barnos`` in the arrays; raises
+        KeyError for a bar that is not present.
+        """
+        barnos = np.asarray(barnos)
+        idx = np.searchsorted(self.data['bar'], barnos)
+        idx = np.clip(idx, 0, max(len(self.data)-1, 0))
+        if len(self.data) == 0 or np.any(self.data['bar'][idx] != barnos):
+            missing = np.setdiff1d(barnos, self.data['bar'])
+            raise KeyError("Bars not present: {}".format(missing.tolist()))
+        return idx
+
+    def positions_of(self, barnos):
+        return self.data['pos'][self.index_of(barnos)]
+
+    def with_status(self, *names):
+        """Boolean mask of the bars whose status is one of ``names``."""
+        codes = [status_codes[name] for name in names]
+        return np.isin(self.data['status'], codes)
+
+    def status_names(self):
+        names = np.array([state_trans.get(code, 'UNKNOWN')
+                          for code in range(-128, 128)], dtype=object)
+        return names[self.data['status'].astype(int) + 128]
+
+    def colors(self, colormap, default):
+        """
+        Map the status of each bar to a color: ``colormap`` maps status
+        names to colors, other states get ``default``.
+        """
+        table = np.full(256, default, dtype=object)
+        for name, color in colormap.items():
+            table[status_codes[name] + 128] = color
+        return table[self.data['status'].astype(int) + 128]
+
+    def diff(self, other):
+        """
+        Compare with an earlier state of the same bars.  Returns boolean
+        masks ``(moved, status_changed)``; everything counts as changed if
+        ``other`` is None or has different bars.
+        """
+        if other is None or len(other.data) != len(self.data) or \
+               np.any(other.data['bar'] != self.data['bar']):
+            changed = np.ones(len(self.data), dtype=bool)
+            return changed, changed
+        return (self.data['pos'] != other.data['pos'],
+                self.data['status'] != other.data['status'])
+
+    def position_digest(self):
+        """
+        Return a hex digest of the bar numbers and positions, which is
+        all the overlay geometry depends on.
+        """
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(self.data['bar']).tobytes())
+        h.update(np.ascontiguousarray(self.data['pos']).tobytes())
+        return h.hexdigest()
+
+    def as_dicts(self):
+        """Return ``(bars, state)`` dicts; ``state`` is None if unknown."""
+        barnos = self.data['bar'].tolist()
+        bars = dict(zip(barnos, self.data['pos'].tolist()))
+        state = None
+        if np.any(self.data['status'] != status_unknown):
+            state = dict(zip(barnos, self.status_names().tolist()))
+        return bars, state
+
+
+class BarHistory(object):
+    """
+    A ring buffer of the last ``capacity`` complete bar states, stored in
+    one preallocated (capacity, 92) array of `bar_dtype`.  Index 0 is
+    the oldest state kept and -1 the newest; indexing returns a read-only
+    copy of the state as a `BarState`.  Since the indices shift as old
+    states are dropped, `dropped` counts the states that were: the state
+    at ``index`` is at ``index + a.dropped - b.dropped`` in a later copy.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self._data = np.empty((capacity, nbars), dtype=bar_dtype)
+        self._kinds = [None] * capacity
+        self._start = 0
+        self._len = 0
+        self._appended = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def dropped(self):
+        """The number of states dropped (or cleared) from the front."""
+        return self._appended - self._len
+
+    def clear(self):
+        with self.lock:
+            self._start = 0
+            self._len = 0
+
+    def copy(self):
+        """Return a copy that does not change as states are appended."""
+        with self.lock:
+            result = BarHistory(capacity=self.capacity)
+            result._data[:] = self._data
+            result._kinds = list(self._kinds)
+            result._start = self._start
+            result._len = self._len
+            result._appended = self._appended
+        return result
+
+    def append(self, bar_state, skip_unchanged=True):
+        """
+        Add a complete `BarState`.  With ``skip_unchanged`` a state with
+        the same positions and status as the newest one is not added.
+        Returns True if the state was added.
+        """
+        if not bar_state.is_complete():
+            raise ValueError("Only complete bar states can be kept in the history")
+        with self.lock:
+            if skip_unchanged and self._len > 0:
+                last = self._data[(self._start + self._len - 1) % self.capacity]
+                if np.array_equal(last['pos'], bar_state.pos) and \
+                       np.array_equal(last['status'], bar_state.status):
+                    return False
+            if self._len < self.capacity:
+                i = (self._start + self._len) % self.capacity
+                self._len += 1
+            else:
+                i = self._start
+                self._start = (self._start + 1) % self.capacity
+            self._data[i] = bar_state.data
+            self._kinds[i] = bar_state.kind
+            self._appended += 1
+        return True
+
+    def _slot(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("history index out of range")
+        return (self._start + index) % self.capacity
+
+    def __getitem__(self, index):
+        with self.lock:
+            i = self._slot(index)
+            data = self._data[i].copy()
+            data.flags.writeable = False
+            return BarState(data, kind=self._kinds[i], source='history')
+
+    def times(self):
+        """Return the time of each state, oldest first."""
+        with self.lock:
+            idx = (self._start + np.arange(self._len)) % self.capacity
+            return self._data['time'][idx, 0]
+
+
+def as_bar_state(bars, state=None):
+    """Return ``bars`` as a `BarState`, converting from dicts if needed."""
+    if isinstance(bars, BarState):
+        return bars
+    return BarState.from_dicts(bars, state=state)
+
+@instrument.timed('parse.csu_bar_state')
+def parse_csu_bar_state(filename):
+    """Read a csu_bar_state file into a `BarState`."""
+    with open(filename, 'r') as FO:
+        text = FO.read()
+        mtime = os.fstat(FO.fileno()).st_mtime
+    if not text.strip():
+        raise ValueError("'{}' is empty".format(filename))
+    arr = np.loadtxt(text.splitlines(), delimiter=',', ndmin=1,
+                     dtype=[('bar', 'u1'), ('pos', 'f8'), ('status', 'i1')])
+    unknown = np.setdiff1d(arr['status'], list(state_trans.keys()))
+    if len(unknown) > 0:
+        raise ValueError("Unknown status code {:d} in '{}'".format(
+            int(unknown[0]), filename))
+    return BarState.from_arrays(arr['pos'], status=arr['status'],
+                                bar=arr['bar'], time=mtime,
+                                kind='csu_bar_state', source=filename)
+
+@instrument.timed('parse.header')
+def parse_header(header):
+    """Read the B01POS ... B92POS keywords of a FITS header into a `BarState`."""
+    pos = np.fromiter((float(header['B{:02d}POS'.format(i)])
+                       for i in range(1, nbars+1)), dtype=float, count=nbars)
+    return BarState.from_arrays(pos, kind='header')
+
+@instrument.timed('parse.multibars')
+def parse_multibars_file(filename):
+    """
+    Read a MultiBars bar file into a `BarState`.  The first line of each
+    slit holds its odd bar and the fourth line its even bar.
+    """
+    positions = csu_multibars.read_bar_file(filename).ravel()
+    return BarState.from_arrays(positions, time=os.stat(filename).st_mtime,
+                                kind='multibars', source=filename)
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded LRU mapping, used for the loaded bar
+    states here, for the overlay geometry in `csu_transforms` and for
+    the coverage masks in `csu_raster`.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            except KeyError:
+                return None
+
+    def put(self, key, value):
+        with self.lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+cache = LRUCache()
+
+def detect_format(filename):
+    """
+    Return 'csu_bar_state' for a comma-separated state file, else
+    'multibars'.
+    """
+    with open(filename, 'r') as in_f:
+        for line in in_f:
+            if line.strip():
+                return 'csu_bar_state' if ',' in line else 'multibars'
+    raise ValueError("'{}' is empty".format(filename))
+
+def file_key(filename):
+    st = os.stat(filename)
+    return ('file', os.path.realpath(filename), st.st_mtime_ns, st.st_size)
+
+def header_values(header):
+    """
+    Return the raw bar keywords of a header, to key the cache: the card
+    images of an astropy header (parsing card values is what makes its
+    lookups slow), or the values of a Ginga header.
+    """
+    keys = ['B{:02d}POS'.format(b) for b in range(1, nbars+1)]
+    cards = getattr(header, 'cards', None)
+    if cards is not None:
+        return [cards[key].image for key in keys]
+    return [header[key] for key in keys]
+
+def header_key(values):
+    h = hashlib.sha1()
+    h.update(repr(values).encode())
+    return ('header', h.hexdigest())
+
+def load_bar_state(source, kind=None, use_cache=True):
+    """
+    Load bar positions from ``source``, a csu_bar_state file, a MultiBars
+    bar file or a FITS header.  ``kind`` ('csu_bar_state', 'multibars' or
+    'header') skips the format detection.  Returns a read-only `BarState`;
+    see the module docstring about sharing.
+    """
+    if kind is None and not isinstance(source, str):
+        kind = 'header'
+    if kind == 'header':
+        values = header_values(source)
+        key = header_key(values)
+    else:
+        key = file_key(source)
+
+    if use_cache:
+        result = cache.get(key)
+        if result is not None:
+            instrument.count('load.bar_state_hits')
+            return result
+        instrument.count('load.bar_state_misses')
+
+    if kind == 'header':
+        result = parse_header(source)
+    else:
+        if kind is None:
+            kind = detect_format(source)
+        if kind == 'csu_bar_state':
+            result = parse_csu_bar_state(source)
+        elif kind == 'multibars':
+            result = parse_multibars_file(source)
+        else:
+            raise ValueError("Unknown bar state format '{}'".format(kind))
+    result.set_readonly()
+
+    if use_cache:
+        cache.put(key, result)
+    return result
+
+#END
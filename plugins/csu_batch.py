@@ -0,0 +1,255 @@
+#
+# csu_batch.py -- Headless bar overlay and measurement over FITS frames
+#
+"""
+Command line batch processing of CSU mask images, without a Ginga window.
+
+For every FITS file in the given directories (or given directly) this
+reads the bar positions from the header, picks the calibration epoch for
+the observation date (or the one given with ``--epoch``) and computes the
+expected bar geometry, exactly as the CSU_initializer plugin does for its
+overlay.  With ``--measure`` the
+bar edges are also measured from the slit bands of the image.
+
+For each frame it writes ``<name>_bars.csv`` with one row per bar, and
+optionally a DS9 region file (``--regions``) and an overlay PNG
+(``--png``, needs matplotlib).  Frames are processed in parallel.  With
+``--store`` the header bar positions of each frame processed without
+error are also appended to a bar store (see `plugins.csu_store`) at the
+time the frame was taken.
+
+    $ csu_batch --measure --regions -j 8 -o qa/ /data/MOSFIRE/20170502
+"""
+import os
+import sys
+import glob
+import logging
+import argparse
+import concurrent.futures
+
+import numpy as np
+from astropy.io import fits
+
+from plugins import csu_bars, csu_calibration, csu_edges, csu_fitsio
+from plugins import csu_store, csu_transforms
+
+# overlay colors, as in the plugin
+expected_color = 'green'
+measured_color = 'yellow'
+
+
+def find_frames(paths, pattern='*.fits'):
+    """Expand directories in ``paths`` to the sorted FITS files in them."""
+    frames = []
+    for path in paths:
+        if os.path.isdir(path):
+            frames.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            frames.append(path)
+    return frames
+
+def frame_table(bars, barnos, polygons, measured=None):
+    """
+    Build the per-bar table of a frame as a dict of (92,) columns: bar,
+    slit, header position in mm (from the `csu_bars.BarState` ``bars``)
+    and the expected pixel position of the bar end (from the
+    `csu_transforms.bar_geometry` polygons), plus the measured edge when
+    ``measured`` (from `csu_edges.edges_to_bars`) is given.
+    """
+    tips = polygons[:,2:4].mean(axis=1)
+    table = dict(bar=barnos, slit=(barnos + 1) // 2,
+                 pos_mm=bars.positions_of(barnos),
+                 x_pix=tips[:,0], y_pix=tips[:,1])
+    if measured is not None:
+        valid = measured.valid
+        table.update(meas_x_pix=np.where(valid, measured.x, np.nan),
+                     meas_x_err=np.where(valid, measured.x_err, np.nan),
+                     meas_mm=np.where(valid, measured.mm, np.nan),
+                     delta_mm=np.where(valid, measured.mm - table['pos_mm'],
+                                       np.nan))
+    return table
+
+def write_table(filename, table):
+    columns = list(table.keys())
+    with open(filename, 'w') as out_f:
+        out_f.write(','.join(columns) + '\n')
+        for row in zip(*[table[col] for col in columns]):
+            out_f.write(','.join(['{:d}'.format(int(v))
+                                  if col in ('bar', 'slit')
+                                  else '{:.4f}'.format(v)
+                                  for col, v in zip(columns, row)]) + '\n')
+
+def write_regions(filename, polygons, barnos, measured=None):
+    """Write a DS9 region file (1-based image coordinates)."""
+    with open(filename, 'w') as out_f:
+        out_f.write('# Region file format: DS9\n')
+        out_f.write('global color={}\n'.format(expected_color))
+        out_f.write('image\n')
+        for b, points in zip(barnos, polygons + 1):
+            out_f.write('polygon({}) # text={{{:d}}}\n'.format(
+                ','.join(['{:.2f}'.format(v) for v in points.ravel()]), b))
+        if measured is not None:
+            for b in np.arange(1, 93)[measured.valid]:
+                out_f.write('point({:.2f},{:.2f}) # point=x color={}\n'.format(
+                    measured.x[b-1] + 1, measured.y[b-1] + 1,
+                    measured_color))
+
+def write_png(filename, fitsfile, polygons, measured=None):
+    from matplotlib import pyplot as plt
+    from matplotlib.patches import Polygon
+
+    data = fits.getdata(fitsfile)
+    fig = plt.figure(figsize=(10, 10))
+    ax = fig.add_subplot(1, 1, 1)
+    lo, hi = np.percentile(data, [1, 99])
+    ax.imshow(data, origin='lower', cmap='gray', vmin=lo, vmax=hi)
+    for points in polygons:
+        ax.add_patch(Polygon(points, closed=True, fill=False,
+                             color=expected_color, linewidth=0.5))
+    if measured is not None:
+        ax.plot(measured.x[measured.valid], measured.y[measured.valid],
+                'x', color=measured_color, markersize=3)
+    ax.set_title(os.path.basename(fitsfile))
+    fig.savefig(filename, dpi=100)
+    plt.close(fig)
+
+def process_frame(fitsfile, options):
+    """
+    Process one frame; ``options`` is a dict of the command line options.
+    Returns a dict summarizing the result.
+    """
+    summary = dict(filename=fitsfile, status='OK', measured=0,
+                   rms_mm=np.nan)
+    try:
+        store = csu_calibration.get_store(options['calibration_store'])
+        header = fits.getheader(fitsfile, ext=options['ext'])
+        bars = csu_bars.parse_header(header)
+        if options['epoch'] is not None:
+            transforms = store.get_transforms(options['epoch'])
+        else:
+            transforms = store.transforms_for_header(header)
+        if options['store'] is not None:
+            # appended by the main process, so that one process writes
+            summary['obstime'] = csu_store.header_time(header)
+            summary['pos'] = np.array(bars.pos)
+
+        measured = None
+        if options['measure']:
+            edges, header = csu_fitsio.measure_file(
+                fitsfile, ext=options['ext'], method=options['method'])
+            measured = csu_edges.edges_to_bars(edges, transforms)
+            summary['measured'] = int(np.sum(measured.valid))
+
+        barnos, polygons, labels = csu_transforms.bar_geometry(transforms,
+                                                               bars)
+        table = frame_table(bars, barnos, polygons, measured=measured)
+        if measured is not None and summary['measured'] > 0:
+            delta = table['delta_mm'][measured.valid]
+            summary['rms_mm'] = float(np.sqrt(np.mean(delta**2)))
+
+        base = os.path.splitext(os.path.basename(fitsfile))[0]
+        outbase = os.path.join(options['outdir'], base)
+        write_table(outbase + '_bars.csv', table)
+
+        if options['regions']:
+            write_regions(outbase + '_bars.reg', polygons, barnos,
+                          measured=measured)
+        if options['png']:
+            write_png(outbase + '_bars.png', fitsfile, polygons,
+                      measured=measured)
+    except KeyError as e:
+        summary['status'] = 'SKIPPED (missing keyword {})'.format(str(e))
+    except Exception as e:
+        summary['status'] = 'ERROR ({})'.format(str(e))
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Overlay and measure CSU bar positions on FITS frames")
+    parser.add_argument("paths", nargs='+', metavar="PATH",
+                        help="FITS files or directories of them")
+    parser.add_argument("--pattern", default='*.fits',
+                        help="File pattern within directories (default %(default)s)")
+    parser.add_argument("-o", "--outdir", default='.',
+                        help="Output directory (default %(default)s)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                        help="Number of frames processed in parallel")
+    parser.add_argument("--ext", type=int, default=0,
+                        help="HDU holding the image (default %(default)s)")
+    parser.add_argument("--measure", action='store_true', default=False,
+                        help="Measure bar edges from the image")
+    parser.add_argument("--method", default='fast',
+                        choices=sorted(csu_edges.methods.keys()),
+                        help="Edge estimator (default %(default)s)")
+    parser.add_argument("--regions", action='store_true', default=False,
+                        help="Write DS9 region files")
+    parser.add_argument("--png", action='store_true', default=False,
+                        help="Write overlay PNGs (needs matplotlib)")
+    parser.add_argument("--calibration-store", default=None,
+                        help="Calibration store directory")
+    parser.add_argument("--epoch", default=None,
+                        help="Calibration epoch to use for every frame, "
+                        "instead of the one for its date")
+    parser.add_argument("--store", default=None, metavar="DIR",
+                        help="Append the header bar positions to the bar store DIR")
+    parser.add_argument("--loglevel", type=int, default=logging.INFO,
+                        help="Logging level")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.loglevel, format='%(message)s')
+    logger = logging.getLogger('csu_batch')
+
+    if args.png:
+        try:
+            import matplotlib
+            matplotlib.use('Agg')
+        except ImportError:
+            logger.error("--png needs matplotlib")
+            return 1
+
+    frames = find_frames(args.paths, pattern=args.pattern)
+    if len(frames) == 0:
+        logger.error("No FITS files found")
+        return 1
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    options = dict(vars(args))
+    nerrors = 0
+    nstored = 0
+    bar_store = None
+    if args.store is not None:
+        bar_store = csu_store.get_store(args.store, logger=logger)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(args.workers, 1)) as executor:
+        summaries = executor.map(process_frame, frames,
+                                 [options] * len(frames))
+        for summary in summaries:
+            if summary['status'].startswith('ERROR'):
+                nerrors += 1
+            msg = "{}: {}".format(os.path.basename(summary['filename']),
+                                  summary['status'])
+            if args.measure and summary['status'] == 'OK':
+                msg += ", {:d}/92 bars measured, rms {:.3f} mm".format(
+                    summary['measured'], summary['rms_mm'])
+            logger.info(msg)
+
+            # a frame that failed later on is not stored, even if its
+            # header was read
+            if bar_store is not None and summary['status'] == 'OK':
+                if summary['obstime'] is None:
+                    logger.warning("{}: no observation time, not stored".format(
+                        os.path.basename(summary['filename'])))
+                else:
+                    nstored += bar_store.extend([summary['obstime']],
+                                                summary['pos'])
+    if bar_store is not None:
+        logger.info("{:d} bar states added to {}".format(nstored,
+                                                         bar_store.path))
+    return 1 if nerrors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#END
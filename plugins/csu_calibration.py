@@ -0,0 +1,239 @@
+#
+# csu_calibration.py -- Versioned store of CSU calibration epochs
+#
+"""
+Calibration epochs for the pixel <-> physical CSU transforms.
+
+A calibration store is a directory holding an ``epochs.json`` index and,
+for each epoch, two ``.npy`` files:
+
+``<name>_points.npy``
+    (n, 4) float64 array of calibration points: pixel x, pixel y,
+    bar position in mm, slit number.
+
+``<name>_transform.npy``
+    (7, 3) float64 array of the precomputed fit: rows 0-2 are
+    ``Apixel_to_physical``, rows 3-5 ``Aphysical_to_pixel`` and row 6
+    holds ``slit_angle_pix`` and ``slit_height_pix``.
+
+Each index entry gives the epoch ``name``, the first day it is valid
+(``start``, inclusive) and the first day it no longer is (``end``,
+exclusive) as ISO dates; either may be null for an open range.  An epoch
+marked ``opt_in`` is never chosen by date, nor as the latest epoch; it
+is only used when asked for by name (the plugin's calibration_epoch
+setting, ``csu_batch --epoch``).  Arrays are memory-mapped and only read
+when an epoch is first used.  An epoch without
+a transform file is fitted through `csu_transforms.load_transforms`.
+
+The store that ships with the package lives in ``data/csu_calibration``.
+"""
+import os
+import json
+import bisect
+import datetime
+import threading
+
+import numpy as np
+
+from ginga.misc import Bunch
+
+from plugins import csu_transforms, instrument
+
+default_path = os.path.join(os.path.split(__file__)[0], 'data',
+                            'csu_calibration')
+
+# sort key for an epoch without a start date
+_min_date = '0000-00-00'
+
+
+def header_date(header):
+    """
+    Return the observation date of a FITS header as an ISO date string,
+    or None if the header does not say.
+    """
+    for kwd in ('DATE-OBS', 'DATE'):
+        value = header.get(kwd, None)
+        if value:
+            return str(value).strip()[:10]
+    mjd = header.get('MJD-OBS', None)
+    if mjd is not None:
+        date = datetime.date(1858, 11, 17) + datetime.timedelta(days=float(mjd))
+        return date.isoformat()
+    return None
+
+
+class CalibrationStore(object):
+
+    def __init__(self, path=None, logger=None):
+        if path is None:
+            path = default_path
+        self.path = path
+        self.logger = logger
+
+        self.lock = threading.RLock()
+        self.epochs = None
+        self._starts = None
+        self._arrays = {}
+        self._transforms = {}
+
+    def load_index(self):
+        with self.lock:
+            if self.epochs is not None:
+                return
+            with open(os.path.join(self.path, 'epochs.json'), 'r') as in_f:
+                index = json.load(in_f)
+            epochs = [Bunch.Bunch(entry) for entry in index['epochs']]
+            epochs.sort(key=lambda epoch: epoch.start or _min_date)
+            # the epochs chosen by date
+            self._dated = [epoch for epoch in epochs
+                           if not epoch.get('opt_in', False)]
+            self._starts = [epoch.start or _min_date
+                            for epoch in self._dated]
+            self.epochs = epochs
+
+    def get_names(self):
+        self.load_index()
+        return [epoch.name for epoch in self.epochs]
+
+    def get_epoch(self, name):
+        self.load_index()
+        for epoch in self.epochs:
+            if epoch.name == name:
+                return epoch
+        raise KeyError("No calibration epoch '{}'".format(name))
+
+    def latest_epoch(self):
+        """Return the latest epoch that is not opt-in."""
+        self.load_index()
+        return self._dated[-1]
+
+    def epoch_for_date(self, date):
+        """
+        Return the epoch valid on ``date`` (an ISO date string), or None
+        if there isn't one.  Opt-in epochs are left out.
+        """
+        self.load_index()
+        i = bisect.bisect_right(self._starts, date) - 1
+        if i < 0:
+            return None
+        epoch = self._dated[i]
+        if epoch.end is not None and date >= epoch.end:
+            return None
+        return epoch
+
+    def epoch_for_header(self, header):
+        """
+        Return the epoch valid when the image with this header was taken.
+        Falls back to the latest epoch if the header has no date or the
+        date is not covered by the store.
+        """
+        date = None
+        if header is not None:
+            date = header_date(header)
+        if date is None:
+            return self.latest_epoch()
+        epoch = self.epoch_for_date(date)
+        if epoch is None:
+            epoch = self.latest_epoch()
+            if self.logger is not None:
+                self.logger.warning(
+                    "No CSU calibration for {}, using '{}'".format(
+                        date, epoch.name))
+        return epoch
+
+    def get_points(self, name):
+        """Return the memory-mapped (n, 4) calibration points of an epoch."""
+        with self.lock:
+            if name not in self._arrays:
+                epoch = self.get_epoch(name)
+                self._arrays[name] = np.load(
+                    os.path.join(self.path, epoch.points), mmap_mode='r')
+            return self._arrays[name]
+
+    def get_transforms(self, name):
+        """
+        Return the transforms of an epoch as a Bunch (see
+        `csu_transforms.load_transforms`), with an extra ``epoch`` item.
+        """
+        with self.lock:
+            if name in self._transforms:
+                return self._transforms[name]
+
+            instrument.count('load.calibration_epochs')
+            epoch = self.get_epoch(name)
+            filename = None
+            if epoch.get('transform', None) is not None:
+                filename = os.path.join(self.path, epoch.transform)
+            if filename is not None and os.path.exists(filename):
+                arr = np.load(filename, mmap_mode='r')
+                result = Bunch.Bunch(Apixel_to_physical=np.array(arr[0:3]),
+                                     Aphysical_to_pixel=np.array(arr[3:6]),
+                                     slit_angle_pix=float(arr[6, 0]),
+                                     slit_height_pix=float(arr[6, 1]))
+            else:
+                points = self.get_points(name)
+                result = csu_transforms.load_transforms(
+                    np.array(points[:, 0:2]), np.array(points[:, 2:4]),
+                    logger=self.logger)
+            result.epoch = name
+            # shared by every channel; nobody gets to change them
+            for arr in (result.Apixel_to_physical, result.Aphysical_to_pixel):
+                arr.flags.writeable = False
+            self._transforms[name] = result
+            return result
+
+    def transforms_for_header(self, header):
+        return self.get_transforms(self.epoch_for_header(header).name)
+
+    def add_epoch(self, name, pixels, physical, start=None, end=None,
+                  comment='', opt_in=False):
+        """
+        Write a new epoch, with its precomputed transforms, into the store
+        and update the index.
+        """
+        with self.lock:
+            self.load_index()
+            if name in self.get_names():
+                raise ValueError("Calibration epoch '{}' exists".format(name))
+
+            pixels = np.asarray(pixels, dtype=np.float64)
+            physical = np.asarray(physical, dtype=np.float64)
+            points = np.hstack([pixels, physical])
+            np.save(os.path.join(self.path, name + '_points.npy'), points)
+
+            t = csu_transforms.fit_all(pixels, physical)
+            arr = np.zeros((7, 3))
+            arr[0:3] = t.Apixel_to_physical
+            arr[3:6] = t.Aphysical_to_pixel
+            arr[6, 0] = t.slit_angle_pix
+            arr[6, 1] = t.slit_height_pix
+            np.save(os.path.join(self.path, name + '_transform.npy'), arr)
+
+            entries = [dict(epoch) for epoch in self.epochs]
+            entries.append(dict(name=name, start=start, end=end,
+                                points=name + '_points.npy',
+                                transform=name + '_transform.npy',
+                                digest=csu_transforms.calibration_digest(
+                                    pixels, physical),
+                                opt_in=opt_in, comment=comment))
+            entries.sort(key=lambda entry: entry['start'] or _min_date)
+            with open(os.path.join(self.path, 'epochs.json'), 'w') as out_f:
+                json.dump(dict(version=1, epochs=entries), out_f, indent=2)
+                out_f.write('\n')
+            self.epochs = None
+            self.load_index()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(path=None, logger=None):
+    """Return the process-wide `CalibrationStore` for ``path``."""
+    if path is None:
+        path = default_path
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = CalibrationStore(path, logger=logger)
+        return _stores[path]
+
+#END
@@ -0,0 +1,663 @@
+#
+# csu_control.py -- Asyncio client for the CSU controller, and a mock CSU
+#
+"""
+Commanding the CSU bars.
+
+The protocol below is provisional: it is the one `MockCSU` implements,
+not a documented interface of the CSU controller, and the client will
+need adapting (or a translating server in front of the controller)
+before it can drive real hardware.  Until then `CSUClient` and the
+plugin's Initialize and Move buttons only talk to the mock.
+
+It is a line protocol over TCP.  Each request is tagged with an id
+chosen by the client, and the reply carrying the same id is sent when
+the command has completed, so any number of commands can be in flight
+on one connection and replies may come back out of order::
+
+    <id> MOVE <bar> <pos> [<bar> <pos> ...]    move bars to positions in mm
+    <id> STEP <bar> <dist> [<bar> <dist> ...]  move bars by distances in mm
+    <id> INIT <bar> [<bar> ...] [OPEN]         initialize bars, leaving them
+                                               open with OPEN
+    <id> STATUS                                report all bars
+    <id> STOP                                  halt all motion
+
+    <id> OK <bar> <pos> <status> [...]         positions and status codes
+    <id> ERROR <message>                       of the bars commanded
+
+`CSUClient` is the asyncio client; if the server hangs up, the requests
+in flight fail and the next one connects again.  Moving or initializing
+many bars is a single request (`CSUClient.move` takes a dict of bar ->
+position), and independent requests can be pipelined with
+``asyncio.gather``.
+`CSUController` runs a client on an event loop in a background thread
+for a GUI: its methods return a `concurrent.futures.Future` straight
+away, so the viewer is never blocked while bars move.
+
+`MockCSU` is a local stand-in for the controller.  It simulates the bars
+moving at ``speed`` mm/s and rewrites a csu_bar_state file (see
+`csu_bars.parse_csu_bar_state`) as they go, so the plugin overlay can
+follow a move with live update on a machine with no hardware.
+
+    $ python -m plugins.csu_control mock --state-file /tmp/csu/csu_bar_state
+    $ python -m plugins.csu_control move 5=120.5 6=121.2
+    $ python -m plugins.csu_control init --open 1-92
+"""
+import os
+import sys
+import asyncio
+import logging
+import argparse
+import itertools
+import threading
+
+import numpy as np
+
+from plugins import csu_bars, instrument
+
+nbars = csu_bars.nbars
+default_host = '127.0.0.1'
+default_port = 7180
+
+# bar travel in mm; odd bars open at the low end, even bars at the high end
+travel_min = 4.0
+travel_max = 270.4
+
+code_ok = csu_bars.status_codes['OK']
+code_setup = csu_bars.status_codes['SETUP']
+code_moving = csu_bars.status_codes['MOVING']
+
+
+class CSUError(Exception):
+    """A command was refused or failed, or the controller went away."""
+    pass
+
+
+def open_position(bar):
+    return travel_min if bar % 2 == 1 else travel_max
+
+def parse_bars(text):
+    """
+    Parse a list of bar numbers such as ``'5'``, ``'5,6,9'``, ``'1-10'``
+    or ``'all'`` into a sorted list of ints.
+    """
+    text = str(text).strip()
+    if text.lower() == 'all':
+        return list(range(1, nbars+1))
+    bars = set()
+    for item in text.replace(' ', '').split(','):
+        if '-' in item:
+            lo, hi = item.split('-', 1)
+            bars.update(range(int(lo), int(hi) + 1))
+        elif item:
+            bars.add(int(item))
+    bars = sorted(bars)
+    if len(bars) == 0 or bars[0] < 1 or bars[-1] > nbars:
+        raise ValueError("Bar numbers must be 1-{:d}: '{}'".format(nbars,
+                                                                   text))
+    return bars
+
+def check_finite(values, what):
+    """
+    Return ``values`` as a float array, raising `CSUError` if any is not
+    a finite number (a NaN target would never be reached).
+    """
+    values = np.asarray(values, dtype=float)
+    if not np.all(np.isfinite(values)):
+        raise CSUError("{} must be a finite number of mm".format(what))
+    return values
+
+def format_reply(bars, pos, status):
+    return ' '.join(['{:d} {:.3f} {:d}'.format(b, p, s)
+                     for b, p, s in zip(bars, pos, status)])
+
+def parse_reply(tokens):
+    """Turn the tokens of an OK reply into a `csu_bars.BarState`."""
+    if len(tokens) % 3 != 0:
+        raise CSUError("Malformed reply: {}".format(' '.join(tokens)))
+    arr = np.array(tokens, dtype=float).reshape(-1, 3)
+    return csu_bars.BarState.from_arrays(arr[:,1], status=arr[:,2],
+                                         bar=arr[:,0], kind='controller')
+
+
+## ------------------------------------------------------------------
+##  Client
+## ------------------------------------------------------------------
+
+class CSUClient(object):
+    """
+    Asyncio client for the (provisional, see above) CSU protocol.  Each
+    command coroutine returns a `csu_bars.BarState` of the bars it
+    concerned, or raises `CSUError`.
+    """
+
+    def __init__(self, host=default_host, port=default_port, timeout=300.0,
+                 logger=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.logger = logger
+
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connect_lock = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+
+    def is_connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        # requests pipelined before the connection is up share it
+        async with self._connect_lock:
+            if self.is_connected():
+                return
+            try:
+                self._reader, self._writer = await asyncio.open_connection(
+                    self.host, self.port)
+            except OSError as e:
+                raise CSUError("Cannot connect to the CSU at {}:{}: {}".format(
+                    self.host, self.port, str(e)))
+            self._read_task = asyncio.ensure_future(self._read_replies())
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        if self._read_task is not None:
+            await self._read_task
+        self._writer = self._reader = self._read_task = None
+
+    async def _read_replies(self):
+        reader, writer = self._reader, self._writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tokens = line.decode().split()
+                if len(tokens) < 2:
+                    continue
+                future = self._pending.pop(tokens[0], None)
+                if future is None or future.done():
+                    continue
+                if tokens[1] == 'OK':
+                    future.set_result(tokens[2:])
+                else:
+                    future.set_exception(CSUError(' '.join(tokens[2:])))
+        except OSError as e:
+            if self.logger is not None:
+                self.logger.error("CSU connection lost: {}".format(str(e)))
+        finally:
+            # drop the dead connection, so that the next request makes a
+            # new one instead of waiting out its timeout on this one
+            writer.close()
+            if self._writer is writer:
+                self._reader = self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(CSUError("CSU connection closed"))
+            self._pending.clear()
+
+    async def request(self, op, *args):
+        """
+        Send one command and wait for its reply; returns the tokens after
+        ``OK``.  Many requests may be outstanding at once.
+        """
+        await self.connect()
+        req_id = str(next(self._ids))
+        future = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = future
+        line = ' '.join([req_id, op] + [str(arg) for arg in args]) + '\n'
+        with instrument.span('control.' + op.lower()):
+            self._writer.write(line.encode())
+            await self._writer.drain()
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self._pending.pop(req_id, None)
+                raise CSUError("{} timed out after {:.0f} s".format(
+                    op, self.timeout))
+
+    async def move(self, targets):
+        """Move bars to positions in mm, given as a dict bar -> position."""
+        check_finite(list(targets.values()), "Position")
+        args = []
+        for bar, pos in sorted(targets.items()):
+            args.extend(['{:d}'.format(bar), '{:.3f}'.format(pos)])
+        return parse_reply(await self.request('MOVE', *args))
+
+    async def step(self, offsets):
+        """Move bars by distances in mm, given as a dict bar -> distance."""
+        check_finite(list(offsets.values()), "Distance")
+        args = []
+        for bar, dist in sorted(offsets.items()):
+            args.extend(['{:d}'.format(bar), '{:.3f}'.format(dist)])
+        return parse_reply(await self.request('STEP', *args))
+
+    async def initialize(self, bars, move_to_open=False):
+        args = ['{:d}'.format(bar) for bar in sorted(bars)]
+        if move_to_open:
+            args.append('OPEN')
+        return parse_reply(await self.request('INIT', *args))
+
+    async def status(self):
+        return parse_reply(await self.request('STATUS'))
+
+    async def halt(self):
+        await self.request('STOP')
+
+
+class _LoopThread(object):
+    """An asyncio event loop running in a daemon thread."""
+
+    def __init__(self, name):
+        self.name = name
+        self.loop = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, coro):
+        """Schedule ``coro`` on the loop; returns a concurrent Future."""
+        if self._thread is None:
+            raise CSUError("{} is not running".format(self.name))
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self._thread = self.loop = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+
+class CSUController(object):
+    """
+    A `CSUClient` on its own event loop thread, for callers that must
+    not block (the plugin).  The command methods return a
+    `concurrent.futures.Future` of the result; add a done callback and,
+    from a GUI, hand the result back with ``fv.gui_do``.
+    """
+
+    def __init__(self, host=default_host, port=default_port, timeout=300.0,
+                 logger=None):
+        self.client = CSUClient(host=host, port=port, timeout=timeout,
+                                logger=logger)
+        self.logger = logger
+        self._loop_thread = _LoopThread('CSUController')
+
+    def start(self):
+        self._loop_thread.start()
+
+    def stop(self):
+        if self._loop_thread.is_running():
+            try:
+                self._loop_thread.run(self.client.close()).result(5.0)
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.warning("Error closing CSU connection: {}".format(
+                        str(e)))
+        self._loop_thread.stop()
+
+    def is_running(self):
+        return self._loop_thread.is_running()
+
+    def move(self, targets):
+        return self._loop_thread.run(self.client.move(dict(targets)))
+
+    def step(self, offsets):
+        return self._loop_thread.run(self.client.step(dict(offsets)))
+
+    def initialize(self, bars, move_to_open=False):
+        return self._loop_thread.run(self.client.initialize(
+            list(bars), move_to_open=move_to_open))
+
+    def status(self):
+        return self._loop_thread.run(self.client.status())
+
+    def halt(self):
+        return self._loop_thread.run(self.client.halt())
+
+
+## ------------------------------------------------------------------
+##  Mock controller
+## ------------------------------------------------------------------
+
+class MockCSU(object):
+    """
+    A simulated CSU serving the controller protocol.  All bars move in
+    one loop, ``tick`` seconds per step at ``speed`` mm/s, and the state
+    is written to ``state_file`` (if given) at each step while anything
+    moves.  ``positions`` are the starting positions (default all bars
+    open).
+    """
+
+    def __init__(self, state_file=None, positions=None, speed=5.0,
+                 tick=0.05, logger=None):
+        self.state_file = state_file
+        self.speed = speed
+        self.tick = tick
+        self.logger = logger
+
+        if positions is None:
+            positions = [open_position(b) for b in range(1, nbars+1)]
+        self.pos = np.array(positions, dtype=float)
+        self.status = np.full(nbars, code_ok, dtype=int)
+        self.target = np.full(nbars, np.nan)
+        self._waiters = {}
+        self._moved = None
+        self._server = None
+        self.port = None
+
+    async def start(self, host=default_host, port=0):
+        """Start serving; port 0 picks a free port, kept in ``port``."""
+        self._moved = asyncio.Event()
+        self._motion_task = asyncio.ensure_future(self._motion_loop())
+        self._server = await asyncio.start_server(self._serve_client,
+                                                  host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.write_state()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self._motion_task.cancel()
+        self._fail_waiters(np.arange(nbars), "CSU shut down")
+
+    def write_state(self):
+        if self.state_file is None:
+            return
+        text = ''.join(['{:d},{:.3f},{:d}\n'.format(b, p, s) for b, p, s in
+                        zip(range(1, nbars+1), self.pos, self.status)])
+        tmpfile = self.state_file + '.tmp'
+        try:
+            with open(tmpfile, 'w') as out_f:
+                out_f.write(text)
+            os.replace(tmpfile, self.state_file)
+        except OSError as e:
+            if self.logger is not None:
+                self.logger.error("Cannot write '{}': {}".format(
+                    self.state_file, str(e)))
+
+    def _fail_waiters(self, idx, message):
+        for i in idx:
+            for future in self._waiters.pop(int(i), []):
+                if not future.done():
+                    future.set_exception(CSUError(message))
+
+    async def _motion_loop(self):
+        loop = asyncio.get_running_loop()
+        last = loop.time()
+        while True:
+            moving = np.isfinite(self.target)
+            if not np.any(moving):
+                self._moved.clear()
+                await self._moved.wait()
+                last = loop.time()
+                continue
+            await asyncio.sleep(self.tick)
+            now = loop.time()
+            step = self.speed * (now - last)
+            last = now
+
+            moving = np.isfinite(self.target)
+            delta = self.target[moving] - self.pos[moving]
+            self.pos[moving] += np.clip(delta, -step, step)
+            self.write_state()
+            arrived = np.flatnonzero(moving)[np.abs(delta) <= step]
+            self.target[arrived] = np.nan
+            for i in arrived:
+                for future in self._waiters.pop(int(i), []):
+                    if not future.done():
+                        future.set_result(None)
+
+    async def drive(self, bars, targets, status=code_moving):
+        """Move ``bars`` to ``targets`` and wait for them all to arrive."""
+        idx = np.asarray(bars, dtype=int) - 1
+        targets = check_finite(targets, "Position")
+        if np.any(np.isfinite(self.target[idx])):
+            busy = np.asarray(bars)[np.isfinite(self.target[idx])]
+            raise CSUError("Bar {:d} is busy".format(int(busy[0])))
+        if np.any((targets < travel_min) | (targets > travel_max)):
+            raise CSUError("Position outside {:.1f}-{:.1f} mm".format(
+                travel_min, travel_max))
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for i in idx:
+            future = loop.create_future()
+            self._waiters.setdefault(int(i), []).append(future)
+            futures.append(future)
+        self.target[idx] = targets
+        self.status[idx] = status
+        self._moved.set()
+        try:
+            await asyncio.gather(*futures)
+        finally:
+            self.status[idx] = code_ok
+            self.write_state()
+
+    def halt(self):
+        moving = np.flatnonzero(np.isfinite(self.target))
+        self.target[moving] = np.nan
+        self._fail_waiters(moving, "stopped")
+
+    def _reply(self, bars):
+        idx = np.asarray(bars, dtype=int) - 1
+        return format_reply(bars, self.pos[idx], self.status[idx])
+
+    async def execute(self, op, args):
+        """Run one command; returns the text after ``OK``."""
+        if op == 'STATUS':
+            return self._reply(range(1, nbars+1))
+        if op == 'STOP':
+            self.halt()
+            return ''
+        if op == 'INIT':
+            move_to_open = 'OPEN' in args
+            bars = [int(arg) for arg in args if arg != 'OPEN']
+            self._check_bars(bars)
+            start = self.pos[np.asarray(bars) - 1].copy()
+            # find the limit at the open end, then come back unless the
+            # bars are to be left open
+            await self.drive(bars, [open_position(b) for b in bars],
+                             status=code_setup)
+            if not move_to_open:
+                await self.drive(bars, start, status=code_setup)
+            return self._reply(bars)
+        if op in ('MOVE', 'STEP'):
+            if len(args) == 0 or len(args) % 2 != 0:
+                raise CSUError("{} takes pairs of bar and value".format(op))
+            bars = [int(arg) for arg in args[0::2]]
+            values = check_finite(np.array(args[1::2], dtype=float),
+                                  "Position" if op == 'MOVE' else "Distance")
+            self._check_bars(bars)
+            if op == 'STEP':
+                values = self.pos[np.asarray(bars) - 1] + values
+            await self.drive(bars, values)
+            return self._reply(bars)
+        raise CSUError("Unknown command '{}'".format(op))
+
+    def _check_bars(self, bars):
+        if len(bars) == 0:
+            raise CSUError("No bars given")
+        if len(set(bars)) != len(bars):
+            raise CSUError("Bar given twice")
+        for bar in bars:
+            if not 1 <= bar <= nbars:
+                raise CSUError("No bar {:d}".format(bar))
+
+    async def _serve_client(self, reader, writer):
+        tasks = set()
+
+        async def run(req_id, op, args):
+            try:
+                reply = 'OK ' + await self.execute(op, args)
+            except (CSUError, ValueError) as e:
+                reply = 'ERROR ' + str(e)
+            if not writer.is_closing():
+                writer.write('{} {}\n'.format(req_id, reply).encode())
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tokens = line.decode().split()
+                if len(tokens) < 2:
+                    continue
+                # every command runs as its own task, so that a long move
+                # does not hold up the commands behind it
+                task = asyncio.ensure_future(run(tokens[0], tokens[1].upper(),
+                                                 tokens[2:]))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+
+class MockCSUServer(object):
+    """A `MockCSU` serving from its own event loop thread."""
+
+    def __init__(self, host=default_host, port=0, **kwargs):
+        self.host = host
+        self._port = port
+        self.csu = MockCSU(**kwargs)
+        self._loop_thread = _LoopThread('MockCSU')
+
+    @property
+    def port(self):
+        return self.csu.port
+
+    def start(self):
+        self._loop_thread.start()
+        self._loop_thread.run(self.csu.start(self.host, self._port)).result()
+
+    def stop(self):
+        if self._loop_thread.is_running():
+            self._loop_thread.run(self.csu.close()).result()
+        self._loop_thread.stop()
+
+
+## ------------------------------------------------------------------
+##  Command line
+## ------------------------------------------------------------------
+
+def _parse_pairs(items):
+    pairs = {}
+    for item in items:
+        bars, value = item.split('=', 1)
+        value = float(check_finite(float(value), "'{}'".format(item)))
+        for bar in parse_bars(bars):
+            pairs[bar] = value
+    return pairs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Command the CSU bars, or run a mock CSU")
+    parser.add_argument("--host", default=default_host,
+                        help="Controller host (default %(default)s)")
+    parser.add_argument("--port", type=int, default=default_port,
+                        help="Controller port (default %(default)s)")
+    parser.add_argument("--timeout", type=float, default=300.0,
+                        help="Command timeout in seconds (default %(default)s)")
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('mock', help="Run a mock CSU")
+    p.add_argument("--state-file", default=None,
+                   help="csu_bar_state file to keep up to date")
+    p.add_argument("--speed", type=float, default=5.0,
+                   help="Bar speed in mm/s (default %(default)s)")
+    p = sub.add_parser('move', help="Move bars, e.g. 5=120.5 1-10=130")
+    p.add_argument("targets", nargs='+', metavar="BARS=MM")
+    p = sub.add_parser('step', help="Move bars by a distance, e.g. 5=-1.5")
+    p.add_argument("offsets", nargs='+', metavar="BARS=MM")
+    p = sub.add_parser('init', help="Initialize bars, e.g. 1-92")
+    p.add_argument("bars", metavar="BARS")
+    p.add_argument("--open", action='store_true', default=False,
+                   help="Leave the bars at their open position")
+    sub.add_parser('status', help="Show the bar positions")
+    sub.add_parser('stop', help="Halt all motion")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logger = logging.getLogger('csu_control')
+
+    if args.command is None:
+        parser.print_usage()
+        return 1
+    if args.command == 'mock':
+        return _run_mock(args, logger)
+
+    async def run():
+        client = CSUClient(args.host, args.port, timeout=args.timeout,
+                           logger=logger)
+        try:
+            if args.command == 'move':
+                return await client.move(_parse_pairs(args.targets))
+            elif args.command == 'step':
+                return await client.step(_parse_pairs(args.offsets))
+            elif args.command == 'init':
+                return await client.initialize(parse_bars(args.bars),
+                                               move_to_open=args.open)
+            elif args.command == 'status':
+                return await client.status()
+            await client.halt()
+        finally:
+            await client.close()
+
+    try:
+        bar_state = asyncio.run(run())
+    except (CSUError, ValueError) as e:
+        logger.error(str(e))
+        return 1
+    if bar_state is not None:
+        for b, p, s in zip(bar_state.bar, bar_state.pos, bar_state.status):
+            logger.info("{:2d} {:8.3f} {}".format(
+                b, p, csu_bars.state_trans.get(int(s), s)))
+    return 0
+
+def _run_mock(args, logger):
+    async def run():
+        csu = MockCSU(state_file=args.state_file, speed=args.speed,
+                      logger=logger)
+        await csu.start(args.host, args.port)
+        logger.info("Mock CSU listening on {}:{:d}".format(args.host,
+                                                           csu.port))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await csu.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#END
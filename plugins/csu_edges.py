@@ -0,0 +1,382 @@
+#
+# csu_edges.py -- Measure CSU bar edge positions in a mask image
+#
+"""
+Bar edge detection for MOSFIRE CSU mask images.
+
+This is the ``analyze_slit`` procedure from the ``MOSFIRE CSU`` notebook,
+run on all 46 slits at once.  The image is cut into the 46 horizontal slit
+bands given by `slit_ypos` and stacked into a single (46, height, width)
+array.  One median filter, one gradient and one median over rows of that
+stack give the gradient profile of every slit.  The rising edge (end of the
+left bar) and falling edge (start of the right bar) are then located around
+the profile extrema, either with a Gaussian fit to each (``'accurate'``,
+as in the notebook) or with a closed-form parabolic interpolation of the
+three samples around each extremum, done for all slits at once
+(``'fast'``).  Both give subpixel positions and 1-sigma uncertainties;
+those of the fast method include the error of the interpolation itself,
+calibrated on synthetic frames with ``util/bench_edges.py``.
+
+`edges_to_bars` uses the fitted pixel -> physical transform to decide
+which bar each edge belongs to and converts the edges to mm.
+
+With ``workers`` set, `measure_edges` splits the slits into chunks that
+are analyzed on a thread or process pool.  Process workers read the image
+from a `multiprocessing.shared_memory` block, so the frame is copied once
+rather than pickled for every task.
+"""
+import contextlib
+import concurrent.futures
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import ndimage
+from astropy.modeling import models, fitting
+
+from ginga.misc import Bunch
+
+from plugins import csu_transforms, instrument
+
+nslits = 46
+
+
+def slit_ypos(j):
+    """Return the (first, last) detector rows of slit band ``j`` (0-45)."""
+    start = 12
+    height = (2044.-8.)/46.
+    y1 = start + height*j + 0.11/0.1798
+    y2 = start + height*(j+1) - 0.11/0.1798
+    return(int(np.ceil(y1)), int(np.floor(y2)))
+
+def slit_bands():
+    """Return a (46, 2) array of [y1, y2) row ranges, all the same height."""
+    bands = np.array([slit_ypos(j) for j in range(nslits)])
+    height = np.min(bands[:,1] - bands[:,0])
+    bands[:,1] = bands[:,0] + height
+    return bands
+
+def extract_bands(data, bands):
+    """Stack the row bands of ``data`` into a (nbands, height, width) array."""
+    height = bands[0,1] - bands[0,0]
+    rows = bands[:,0][:,np.newaxis] + np.arange(height)
+    return data[rows]
+
+def band_profiles(stack, filter_shape=(1, 5), return_noise=False):
+    """
+    Return the (nbands, width) gradient profiles of a stack of bands.
+
+    Each band is median filtered with a ``filter_shape`` (rows, columns)
+    kernel, differentiated along the columns and reduced with a median
+    over its rows.  ``(5, 5)`` reproduces the notebook, the default
+    ``(1, 5)`` filters along the columns only, which is much cheaper and
+    loses little since the profile already takes a median over rows.
+
+    With ``return_noise`` also return the (nbands,) estimated noise of
+    each profile, from the robust scatter of the gradient within the band.
+    """
+    stack = np.asarray(stack, dtype=np.float32)
+    mstack = ndimage.median_filter(stack, size=(1,) + tuple(filter_shape))
+    grad = np.gradient(mstack, axis=2)
+    profiles = np.median(grad, axis=1)
+    if not return_noise:
+        return profiles
+    nbands, nrows, width = grad.shape
+    # every 8th column is plenty for a scatter estimate
+    flat = grad[:,:,::8].reshape(nbands, -1)
+    mad = np.median(np.abs(flat - np.median(flat, axis=1)[:,np.newaxis]),
+                    axis=1)
+    # standard error of a median of nrows samples
+    noise = 1.2533 * 1.4826 * mad / np.sqrt(nrows)
+    return profiles, noise
+
+def fit_edges_levmar(profiles, window=10, min_amplitude=100.,
+                     max_stddev=2.):
+    """
+    Locate the rising and falling edge in each profile with a Gaussian
+    fit (`astropy.modeling.fitting.LevMarLSQFitter`) to the profile around
+    its maximum and minimum.
+
+    Returns ``(x1, x2, x1_err, x2_err, valid)``; edges whose fits fail the
+    notebook's validity checks are flagged invalid and set to 0.
+    Uncertainties come from the fit covariance and are NaN if it is not
+    available.
+    """
+    profiles = np.asarray(profiles)
+    nprof, width = profiles.shape
+    x1o = np.argmax(profiles, axis=1)
+    x2o = np.argmin(profiles, axis=1)
+
+    fit_g = fitting.LevMarLSQFitter()
+    x = np.zeros((nprof, 2))
+    x_err = np.full((nprof, 2), np.nan)
+    valid = np.zeros(nprof, dtype=bool)
+    for i in range(nprof):
+        profile = profiles[i]
+        fits_ok = True
+        means = []
+        errs = []
+        for xo, amplitude in ((x1o[i], 200.), (x2o[i], -200.)):
+            lo, hi = max(xo - window, 0), min(xo + window + 1, width)
+            xs = np.arange(lo, hi)
+            g_init = models.Gaussian1D(amplitude=amplitude, mean=xo,
+                                       stddev=2.)
+            g = fit_g(g_init, xs, profile[lo:hi])
+            if (abs(g.stddev.value) >= max_stddev or
+                abs(g.amplitude.value) <= min_amplitude or
+                np.sign(g.amplitude.value) != np.sign(amplitude)):
+                fits_ok = False
+            means.append(g.mean.value)
+            cov = fit_g.fit_info.get('param_cov', None)
+            errs.append(np.sqrt(cov[1][1]) if cov is not None else np.nan)
+        if fits_ok and means[0] < means[1]:
+            x[i] = means
+            x_err[i] = errs
+            valid[i] = True
+    return x[:,0], x[:,1], x_err[:,0], x_err[:,1], valid
+
+def fit_edges_parabolic(profiles, noise=None, min_amplitude=100.,
+                        interp_error=0.1):
+    """
+    Locate the rising and falling edge in each profile by fitting a
+    parabola through the extremum and its two neighbours.  Everything is
+    computed in closed form on the whole (nprofiles, width) array.
+
+    The uncertainty propagates ``noise``, the (nprofiles,) noise of the
+    profile samples (see `band_profiles`), through the vertex formula.
+    If it is not given it is estimated from the median absolute deviation
+    of each profile.  Three-point interpolation of a sampled peak is also
+    biased, by an amount that depends on where the edge falls within the
+    pixel; ``interp_error`` (pixels) is added in quadrature for that.
+    The default is the rms error against the true edges of the synthetic
+    frames of ``util/bench_edges.py``, which is about 30 times the
+    statistical error there.  Returns ``(x1, x2, x1_err, x2_err, valid)``
+    like `fit_edges_levmar`.
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    nprof, width = profiles.shape
+    rows = np.arange(nprof)
+
+    if noise is None:
+        mad = np.median(np.abs(profiles -
+                               np.median(profiles, axis=1)[:,np.newaxis]),
+                        axis=1)
+        noise = 1.4826 * mad
+    sigma = np.asarray(noise, dtype=float)
+
+    result = []
+    valid = np.ones(nprof, dtype=bool)
+    for xo, sign in ((np.argmax(profiles, axis=1), 1.),
+                     (np.argmin(profiles, axis=1), -1.)):
+        inner = (xo > 0) & (xo < width-1)
+        xc = np.clip(xo, 1, width-2)
+        a = profiles[rows, xc-1]
+        b = profiles[rows, xc]
+        c = profiles[rows, xc+1]
+        denom = a - 2*b + c
+        num = a - c
+        # a peak (trough) needs negative (positive) curvature
+        curved = sign * denom < 0
+        safe = np.where(curved, denom, -sign)
+        delta = 0.5 * num / safe
+        # d(delta)/d(a, b, c)
+        da = (safe - num) / (2 * safe**2)
+        db = num / safe**2
+        dc = (-safe - num) / (2 * safe**2)
+        err = np.sqrt(sigma**2 * (da**2 + db**2 + dc**2) +
+                      interp_error**2)
+
+        valid &= inner & curved & (np.abs(delta) <= 1.) & \
+                 (sign * b > min_amplitude)
+        result.append((xc + delta, err))
+
+    (x1, x1_err), (x2, x2_err) = result
+    valid &= x1 < x2
+    x1 = np.where(valid, x1, 0.)
+    x2 = np.where(valid, x2, 0.)
+    x1_err = np.where(valid, x1_err, np.nan)
+    x2_err = np.where(valid, x2_err, np.nan)
+    return x1, x2, x1_err, x2_err, valid
+
+# edge estimators selectable by name in measure_edges
+methods = dict(accurate=fit_edges_levmar, fast=fit_edges_parabolic)
+
+@instrument.timed('analyze.edges')
+def measure_edges(data, bands=None, filter_shape=(1, 5), method='accurate',
+                  workers=None, executor='process', **kwargs):
+    """
+    Measure the bar edges of all slit bands of ``data``.
+
+    ``method`` is 'accurate' (Gaussian fits) or 'fast' (parabolic
+    interpolation); extra keyword arguments go to the estimator.
+
+    If ``workers`` is given the slits are analyzed in that many chunks on
+    a pool; ``executor`` is 'process', 'thread' or an existing
+    `concurrent.futures.Executor` to reuse.  Results are the same as a
+    serial run and come back in slit order.
+
+    Returns a Bunch with the ``bands`` used, the rising (``x1``) and
+    falling (``x2``) edge of each band in pixels, their uncertainties
+    (``x1_err``, ``x2_err``) and a ``valid`` mask.
+    """
+    if bands is None:
+        bands = slit_bands()
+    if workers:
+        return measure_edges_parallel(data, bands, workers,
+                                      executor=executor,
+                                      filter_shape=filter_shape,
+                                      method=method, **kwargs)
+    stack = extract_bands(data, bands)
+    return measure_edges_from_stack(stack, bands, filter_shape=filter_shape,
+                                    method=method, **kwargs)
+
+def measure_edges_from_stack(stack, bands, filter_shape=(1, 5),
+                             method='accurate', **kwargs):
+    return combine_results(bands, [analyze_stack(
+        stack, filter_shape=filter_shape, method=method, **kwargs)])
+
+def analyze_stack(stack, filter_shape=(1, 5), method='accurate', **kwargs):
+    """
+    Fit the edges of a stack of slit bands, as from `extract_bands`.
+    Returns the arrays ``(x1, x2, x1_err, x2_err, valid)``, to be put
+    together with those of the other chunks by `combine_results`.
+    """
+    if method == 'fast':
+        profiles, noise = band_profiles(stack, filter_shape=filter_shape,
+                                        return_noise=True)
+        return fit_edges_parabolic(profiles, noise=noise, **kwargs)
+    profiles = band_profiles(stack, filter_shape=filter_shape)
+    return methods[method](profiles, **kwargs)
+
+def combine_results(bands, results):
+    """
+    Return the edges of ``bands``, as from `measure_edges`, given the
+    `analyze_stack` results of its chunks in order.
+    """
+    x1, x2, x1_err, x2_err, valid = [np.concatenate(arrs)
+                                     for arrs in zip(*results)]
+    return Bunch.Bunch(bands=bands, x1=x1, x2=x2, x1_err=x1_err,
+                       x2_err=x2_err, valid=valid)
+
+def _analyze_chunk(data, bands, filter_shape, method, kwargs):
+    stack = extract_bands(data, bands)
+    return analyze_stack(stack, filter_shape=filter_shape, method=method,
+                         **kwargs)
+
+def _analyze_chunk_shm(shm_name, shape, dtype, bands, filter_shape, method,
+                       kwargs):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = _analyze_chunk(data, bands, filter_shape, method, kwargs)
+        # drop our view of the buffer before closing it
+        del data
+        return result
+    finally:
+        shm.close()
+
+def split_bands(bands, workers):
+    """Split ``bands`` into at most ``workers`` chunks, one per task."""
+    return [chunk for chunk in np.array_split(bands, workers)
+            if len(chunk) > 0]
+
+@contextlib.contextmanager
+def pool_executor(executor, workers):
+    """
+    Context giving the pool to run on: ``executor`` 'process' or
+    'thread' makes a pool of ``workers`` that is shut down on exit, an
+    existing `concurrent.futures.Executor` is used as it is.
+    """
+    if isinstance(executor, concurrent.futures.Executor):
+        yield executor
+        return
+    if executor == 'process':
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    elif executor == 'thread':
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError("Unknown executor '{}'".format(executor))
+    try:
+        yield pool
+    finally:
+        pool.shutdown()
+
+def measure_edges_parallel(data, bands, workers, executor='process',
+                           filter_shape=(1, 5), method='accurate', **kwargs):
+    chunks = split_bands(bands, workers)
+    shm = None
+    with pool_executor(executor, workers) as pool:
+        try:
+            if isinstance(pool, concurrent.futures.ProcessPoolExecutor):
+                data = np.ascontiguousarray(data)
+                shm = shared_memory.SharedMemory(create=True,
+                                                 size=max(data.nbytes, 1))
+                shared = np.ndarray(data.shape, dtype=data.dtype,
+                                    buffer=shm.buf)
+                shared[...] = data
+                del shared
+                futures = [pool.submit(_analyze_chunk_shm, shm.name,
+                                       data.shape, data.dtype.str, chunk,
+                                       filter_shape, method, kwargs)
+                           for chunk in chunks]
+            else:
+                futures = [pool.submit(_analyze_chunk, data, chunk,
+                                       filter_shape, method, kwargs)
+                           for chunk in chunks]
+            results = [future.result() for future in futures]
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    return combine_results(bands, results)
+
+@instrument.timed('transform.edges_to_bars')
+def edges_to_bars(edges, transforms):
+    """
+    Assign measured edges to bars.
+
+    ``transforms`` is a Bunch as returned by
+    `csu_transforms.load_transforms`.  Each band's edges are converted to
+    physical coordinates at the band's center row; the slit number comes
+    from the transform and the edge at the larger mm position belongs to
+    the even bar of the slit.
+
+    Returns a Bunch of (92,) arrays indexed by bar number - 1: pixel
+    ``x`` and ``y`` of the edge, its uncertainty ``x_err``, position
+    ``mm`` and a ``valid`` mask.
+    """
+    A = transforms.Apixel_to_physical
+    yc = edges.bands.mean(axis=1)
+    pix = np.empty((len(yc), 2, 2))
+    pix[:,0] = np.column_stack([edges.x1, yc])
+    pix[:,1] = np.column_stack([edges.x2, yc])
+    phys = csu_transforms.apply_transform(A, pix.reshape(-1, 2))
+    phys = phys.reshape(len(yc), 2, 2)
+
+    slits = np.rint(phys[:,:,1].mean(axis=1)).astype(int)
+    ok = edges.valid & (slits >= 1) & (slits <= nslits)
+    # a slit measured in two bands is ambiguous; drop both
+    counts = np.bincount(slits[ok], minlength=nslits+1)
+    ok &= counts[np.clip(slits, 0, nslits)] == 1
+
+    # column 0/1 of each band: lower/higher mm edge
+    order = np.argsort(phys[:,:,0], axis=1)
+    idx = np.arange(len(yc))[:,np.newaxis]
+    mm = phys[:,:,0][idx, order]
+    xs = pix[:,:,0][idx, order]
+    x_errs = np.column_stack([edges.x1_err, edges.x2_err])[idx, order]
+
+    result = Bunch.Bunch(x=np.zeros(2*nslits), y=np.zeros(2*nslits),
+                         x_err=np.full(2*nslits, np.nan),
+                         mm=np.zeros(2*nslits),
+                         valid=np.zeros(2*nslits, dtype=bool))
+    s = slits[ok]
+    for col, barnos in ((0, 2*s-1), (1, 2*s)):
+        result.x[barnos-1] = xs[ok, col]
+        result.y[barnos-1] = yc[ok]
+        result.x_err[barnos-1] = x_errs[ok, col]
+        result.mm[barnos-1] = mm[ok, col]
+        result.valid[barnos-1] = True
+    return result
+
+#END
@@ -0,0 +1,151 @@
+#
+# csu_fitsio.py -- Read only the slit bands of a CSU mask image
+#
+"""
+Row-band access to FITS mask images for bar analysis.
+
+Bar edge measurement only looks at the 46 slit bands from
+`csu_edges.slit_bands`, so there is no need to read the whole frame.
+`BandReader` opens the file memory-mapped and hands out each band as a
+view of the mapped data (no copy) when the HDU is a plain image with no
+scaling.  Compressed HDUs are read band by band through ``hdu.section`` and
+scaled data is scaled one band at a time.  Either way only the rows of the
+bands are paged in from disk.
+
+`measure_file` feeds the bands straight into the edge detector; in its
+parallel mode each worker maps the file and reads just its own bands, so
+nothing but the file name is sent to the workers.
+"""
+
+import numpy as np
+from astropy.io import fits
+
+from plugins import csu_edges, instrument
+
+
+class BandReader(object):
+
+    def __init__(self, filename, ext=0):
+        self.filename = filename
+        self.ext = ext
+        self.hdul = None
+        self.hdu = None
+
+    def open(self):
+        self.hdul = fits.open(self.filename, memmap=True,
+                              do_not_scale_image_data=True)
+        self.hdu = self.hdul[self.ext]
+
+    def close(self):
+        self.hdu = None
+        if self.hdul is not None:
+            self.hdul.close()
+            self.hdul = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    @property
+    def header(self):
+        return self.hdu.header
+
+    @property
+    def shape(self):
+        if isinstance(self.hdu, fits.CompImageHDU):
+            return self.hdu.shape
+        return (self.hdu.header['NAXIS2'], self.hdu.header['NAXIS1'])
+
+    def _scaling(self):
+        header = self.hdu.header
+        if isinstance(self.hdu, fits.CompImageHDU):
+            # sections of compressed HDUs are already scaled
+            return 1.0, 0.0
+        return header.get('BSCALE', 1.0), header.get('BZERO', 0.0)
+
+    def band(self, y1, y2):
+        """
+        Return rows ``y1:y2`` of the image.  This is a view of the mapped
+        file when the HDU is uncompressed and unscaled.
+        """
+        if isinstance(self.hdu, fits.CompImageHDU):
+            return self.hdu.section[y1:y2, :]
+        data = self.hdu.data[y1:y2]
+        bscale, bzero = self._scaling()
+        if bscale != 1.0 or bzero != 0.0:
+            data = data * np.float32(bscale) + np.float32(bzero)
+        return data
+
+    def views(self, bands):
+        """Return a list with one array per (y1, y2) band."""
+        nrows = self.shape[0]
+        bands = np.asarray(bands)
+        if bands.min() < 0 or bands.max() > nrows:
+            raise ValueError("Bands extend beyond the {:d} rows of '{}'".format(
+                nrows, self.filename))
+        return [self.band(y1, y2) for y1, y2 in bands]
+
+    def stack(self, bands, dtype=np.float32):
+        """
+        Return the bands as a (nbands, height, width) array of ``dtype``,
+        the input expected by `csu_edges.band_profiles`.  This is the
+        only copy made.
+        """
+        views = self.views(bands)
+        out = np.empty((len(views),) + views[0].shape, dtype=dtype)
+        for i, view in enumerate(views):
+            out[i] = view
+        return out
+
+
+@instrument.timed('load.bands')
+def read_bands(filename, bands=None, ext=0):
+    """
+    Return ``(stack, header)`` for the slit ``bands`` (default
+    `csu_edges.slit_bands`) of a FITS file.
+    """
+    if bands is None:
+        bands = csu_edges.slit_bands()
+    with BandReader(filename, ext=ext) as reader:
+        return reader.stack(bands), reader.header.copy()
+
+def _measure_chunk(filename, ext, bands, filter_shape, method, kwargs):
+    with BandReader(filename, ext=ext) as reader:
+        stack = reader.stack(bands)
+    return csu_edges.analyze_stack(stack, filter_shape=filter_shape,
+                                   method=method, **kwargs)
+
+@instrument.timed('analyze.file')
+def measure_file(filename, bands=None, ext=0, filter_shape=(1, 5),
+                 method='accurate', workers=None, executor='process',
+                 **kwargs):
+    """
+    Measure the bar edges in a FITS mask image, reading only the slit
+    bands.  Arguments are as for `csu_edges.measure_edges`.
+
+    Returns ``(edges, header)``.
+    """
+    if bands is None:
+        bands = csu_edges.slit_bands()
+    if not workers:
+        stack, header = read_bands(filename, bands=bands, ext=ext)
+        edges = csu_edges.measure_edges_from_stack(
+            stack, bands, filter_shape=filter_shape, method=method, **kwargs)
+        return edges, header
+
+    with BandReader(filename, ext=ext) as reader:
+        header = reader.header.copy()
+
+    with csu_edges.pool_executor(executor, workers) as pool:
+        futures = [pool.submit(_measure_chunk, filename, ext, chunk,
+                               filter_shape, method, kwargs)
+                   for chunk in csu_edges.split_bands(bands, workers)]
+        results = [future.result() for future in futures]
+
+    return csu_edges.combine_results(bands, results), header
+
+#END
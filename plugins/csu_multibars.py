@@ -0,0 +1,80 @@
+#
+# csu_multibars.py -- Read MultiBars bar files
+#
+"""
+Parser for the bar files overlaid by the MultiBars plugin.
+
+A bar file has six lines per slit, 46 slits in all.  The third
+whitespace-separated column of the first line of a slit is the position
+in mm of the bar closing it from the left, that of the fourth line the
+bar closing it from the right.  The remaining lines are not used.
+
+The file is read in one go and only the 92 lines that matter are parsed,
+by a single `numpy.loadtxt` call, and the extents of all rectangles are
+computed at once in `rectangle_extents`.
+"""
+import numpy as np
+
+from plugins import instrument
+
+nslits = 46
+lines_per_slit = 6
+
+# the nominal mm to pixel scale of the bars, as used by MultiBars
+bar_zero_mm = 8.34
+mm_per_pixel = 0.124
+
+# detector layout of the slits in pixels
+detector_width = 2044
+slit_start = 12
+slit_pitch = (2044 - 8) / 46
+slit_margin = 0.11 / 0.1798
+
+
+@instrument.timed('parse.multibars')
+def read_bar_file(filename, nslits=nslits):
+    """
+    Return the bar positions of a bar file as an ``(nslits, 2)`` array in
+    mm, the first column from the first line of each slit and the second
+    from the fourth line.
+    """
+    with open(filename, 'r') as in_f:
+        lines = in_f.read().splitlines()
+    # the last slit needs only its first four lines
+    nlines = lines_per_slit * (nslits - 1) + 4
+    if len(lines) < nlines:
+        raise ValueError("'{}' has {:d} lines, expected at least {:d} for {:d} slits".format(
+            filename, len(lines), nlines, nslits))
+
+    selected = lines[0:nlines:lines_per_slit] + lines[3:nlines:lines_per_slit]
+    try:
+        positions = np.loadtxt(selected, usecols=(2,), dtype=float, ndmin=1)
+    except (ValueError, IndexError) as e:
+        raise ValueError("Bad bar line in '{}': {}".format(filename, str(e)))
+    return positions.reshape(2, nslits).T
+
+def rectangle_extents(positions):
+    """
+    Compute the two rectangles drawn for each slit from an ``(nslits, 2)``
+    array of bar positions.  Returns an ``(2*nslits, 4)`` array of
+    ``(x1, y1, x2, y2)``: for each slit the rectangle from the right edge
+    of the detector, then the one from the left edge.
+    """
+    positions = np.asarray(positions, dtype=float)
+    j = np.arange(len(positions))
+    y1 = np.ceil(slit_start + slit_pitch*j + slit_margin)
+    y2 = np.floor(slit_start + slit_pitch*(j+1) - slit_margin)
+    x_right = (positions[:,1] - bar_zero_mm) / mm_per_pixel
+    x_left = (positions[:,0] - bar_zero_mm) / mm_per_pixel
+
+    extents = np.empty((len(positions), 2, 4))
+    extents[:,0] = np.column_stack([np.full_like(y1, detector_width), y2,
+                                    x_right, y1])
+    extents[:,1] = np.column_stack([np.zeros_like(y1), y2, x_left, y1])
+    return extents.reshape(-1, 4)
+
+def read_rectangles(filename):
+    """Read a bar file and return its `rectangle_extents`."""
+    return rectangle_extents(read_bar_file(filename))
+
+#END
@@ -0,0 +1,471 @@
+#
+# csu_store.py -- Append-only on-disk time series of CSU bar states
+#
+"""
+A persistent record of bar positions over time.
+
+A bar store is a directory holding a ``meta.json`` description and one
+raw little-endian file per column, each sample being one row:
+
+``time.f8``
+    float64 Unix time of the sample (UTC).
+
+``pos.f8``
+    (n, 92) float64 bar positions in mm, bar 1 first.
+
+``status.i1``
+    (n, 92) int8 bar status codes (see `csu_bars.state_trans`, or
+    `csu_bars.status_unknown`).
+
+Samples are only ever appended.  The columns are memory-mapped when
+queried, so a range query touches the time column and the rows in the
+range, never the whole store: a year of per-exposure samples is a few
+tens of MB on disk and a query for one bar over a month reads a few
+pages.  Samples are normally appended in time order and the time column
+is then its own index, searched with `numpy.searchsorted`.  Should a
+sample be older than the newest one (a batch run over old frames) a
+sort order is built once.  Samples appended after that are sorted among
+themselves and merged into it, and the order is saved to ``order.npy``
+for the next reader whenever enough new samples have been merged.
+
+Each append writes the positions and status before the time, and the
+number of samples is that of the shortest column, so a reader never sees
+a half-written sample and a writer that died midway is cleaned up by the
+next one.  Writers in different processes (the plugin, `csu_batch`) are
+serialized by a lock file where ``fcntl`` is available.
+
+    store = csu_store.get_store('/data/csu_store')
+    store.append(bar_state)
+    t, pos, status = store.bar_series(37, start=time.time() - 30*86400)
+"""
+import os
+import json
+import time
+import datetime
+import threading
+import contextlib
+
+import numpy as np
+
+from ginga.misc import Bunch
+
+from plugins import csu_bars, instrument
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+nbars = csu_bars.nbars
+
+# column name -> (file name, dtype, values per sample)
+columns = dict(time=('time.f8', np.dtype('<f8'), 1),
+               pos=('pos.f8', np.dtype('<f8'), nbars),
+               status=('status.i1', np.dtype('i1'), nbars))
+# the time column is written last, marking the sample as complete
+write_order = ('pos', 'status', 'time')
+
+# fewest merged samples for which the sort order is saved again
+order_save_min = 1000
+
+_version = 1
+
+
+def as_time(value):
+    """
+    Convert ``value`` to a Unix time: a number is taken as is, a
+    `datetime.datetime` or ISO date(time) string without a time zone as
+    UTC.  None is passed through.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.strip())
+    elif isinstance(value, datetime.date) and \
+             not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+def header_time(header):
+    """
+    Return the time an image was taken as a Unix time, from the MJD-OBS
+    keyword or else DATE-OBS (and UTC or UT if DATE-OBS has no time), or
+    None if the header does not say.
+    """
+    mjd = header.get('MJD-OBS', None)
+    if mjd is not None:
+        try:
+            return (float(mjd) - 40587.0) * 86400.0
+        except ValueError:
+            pass
+    date = header.get('DATE-OBS', None)
+    if not date:
+        return None
+    date = str(date).strip()
+    if 'T' not in date:
+        for kwd in ('UTC', 'UT'):
+            value = header.get(kwd, None)
+            if value:
+                date = '{}T{}'.format(date[:10], str(value).strip())
+                break
+    try:
+        return as_time(date)
+    except ValueError:
+        return None
+
+
+class BarStore(object):
+    """
+    The bar store in the directory ``path``.  The directory is created
+    on the first append.
+    """
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger
+
+        self.lock = threading.RLock()
+        self._n = 0
+        self._size = None
+        self._maps = {}
+        # how far the times are known to be in order, and the sort
+        # order once they are not
+        self._checked = 0
+        self._in_order = True
+        self._order = None
+        self._sorted_time = None
+        # samples merged into the order since it was last saved
+        self._unsaved = 0
+
+    def _filename(self, name):
+        return os.path.join(self.path, columns[name][0])
+
+    def _count(self):
+        """Number of complete samples on disk."""
+        counts = []
+        for name in write_order:
+            fname, dtype, width = columns[name]
+            try:
+                size = os.path.getsize(os.path.join(self.path, fname))
+            except OSError:
+                return 0
+            counts.append(size // (dtype.itemsize * width))
+        return min(counts)
+
+    def refresh(self):
+        """Pick up samples appended since the store was last looked at."""
+        with self.lock:
+            try:
+                size = os.path.getsize(self._filename('time'))
+            except OSError:
+                size = 0
+            if size == self._size:
+                return
+            self._size = size
+            n = self._count()
+            if n < self._n:
+                # the store was replaced underneath us
+                self._checked = 0
+                self._in_order = True
+                self._order = None
+            self._n = n
+            self._maps = {}
+
+    def __len__(self):
+        self.refresh()
+        return self._n
+
+    def _column(self, name):
+        with self.lock:
+            arr = self._maps.get(name, None)
+            if arr is None:
+                fname, dtype, width = columns[name]
+                shape = (self._n,) if width == 1 else (self._n, width)
+                if self._n == 0:
+                    arr = np.empty(shape, dtype=dtype)
+                else:
+                    arr = np.memmap(self._filename(name), dtype=dtype,
+                                    mode='r', shape=shape)
+                self._maps[name] = arr
+            return arr
+
+    @property
+    def times(self):
+        """The memory-mapped time column, in the order appended."""
+        self.refresh()
+        return self._column('time')
+
+    ## -- writing --
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.path, 'lock'), 'a') as lock_f:
+            fcntl.flock(lock_f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_f.fileno(), fcntl.LOCK_UN)
+
+    def _prepare(self):
+        """Create the store if needed and drop any half-written sample."""
+        meta_file = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_file):
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            meta = dict(version=_version, nbars=nbars,
+                        columns=dict([(name, [fname, dtype.str, width])
+                                      for name, (fname, dtype, width)
+                                      in columns.items()]))
+            with open(meta_file, 'w') as out_f:
+                json.dump(meta, out_f, indent=2)
+                out_f.write('\n')
+        else:
+            with open(meta_file, 'r') as in_f:
+                meta = json.load(in_f)
+            if meta.get('version') != _version or meta.get('nbars') != nbars:
+                raise ValueError("'{}' is not a version {:d} bar store".format(
+                    self.path, _version))
+
+        n = self._count()
+        for name in write_order:
+            fname, dtype, width = columns[name]
+            filename = os.path.join(self.path, fname)
+            if not os.path.exists(filename):
+                open(filename, 'wb').close()
+            elif os.path.getsize(filename) > n * dtype.itemsize * width:
+                if self.logger is not None:
+                    self.logger.warning(
+                        "Dropping a partly written sample from '{}'".format(
+                            filename))
+                with open(filename, 'r+b') as out_f:
+                    out_f.truncate(n * dtype.itemsize * width)
+
+    def extend(self, times, pos, status=None, unique=True):
+        """
+        Append samples: ``times`` (n,) Unix times, ``pos`` (n, 92)
+        positions in mm and ``status`` (n, 92) status codes (default
+        unknown).  With ``unique`` a sample whose time, positions and
+        status are already in the store is left out.  Returns the number
+        of samples added.
+        """
+        times = np.atleast_1d(np.asarray(times, dtype='<f8'))
+        pos = np.asarray(pos, dtype='<f8').reshape(-1, nbars)
+        if status is None:
+            status = np.full(pos.shape, csu_bars.status_unknown, dtype='i1')
+        status = np.asarray(status, dtype='i1').reshape(-1, nbars)
+        if not len(times) == len(pos) == len(status):
+            raise ValueError("times, pos and status have different lengths")
+        if not np.all(np.isfinite(times)):
+            raise ValueError("Sample times must be finite")
+
+        with instrument.span('store.append'):
+            with self.lock:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                with self._file_lock():
+                    self._prepare()
+                    self.refresh()
+                    if unique and self._n > 0:
+                        keep = np.array([not self._contains(t, p, s)
+                                         for t, p, s in zip(times, pos, status)],
+                                        dtype=bool)
+                        times, pos, status = times[keep], pos[keep], status[keep]
+                    if len(times) == 0:
+                        return 0
+                    values = dict(time=times, pos=pos, status=status)
+                    for name in write_order:
+                        with open(self._filename(name), 'ab') as out_f:
+                            out_f.write(np.ascontiguousarray(
+                                values[name]).tobytes())
+                    self.refresh()
+        instrument.count('store.samples', len(times))
+        return len(times)
+
+    def append(self, bar_state, obstime=None, unique=True):
+        """
+        Append a complete `csu_bars.BarState`.  The sample time is
+        ``obstime`` if given, else the newest time in the state, else now.
+        Returns True if the state was added.
+        """
+        if not bar_state.is_complete():
+            raise ValueError("Only complete bar states can be stored")
+        if obstime is None:
+            times = bar_state.time[np.isfinite(bar_state.time)]
+            obstime = times.max() if len(times) > 0 else time.time()
+        return self.extend([as_time(obstime)], bar_state.pos[np.newaxis],
+                           bar_state.status[np.newaxis], unique=unique) > 0
+
+    def _contains(self, t, pos, status):
+        sorted_time, order = self._time_index()
+        i0 = np.searchsorted(sorted_time, t, side='left')
+        i1 = np.searchsorted(sorted_time, t, side='right')
+        for i in range(i0, i1):
+            j = i if order is None else order[i]
+            if np.array_equal(self._column('pos')[j], pos) and \
+                   np.array_equal(self._column('status')[j], status):
+                return True
+        return False
+
+    ## -- querying --
+
+    def _time_index(self):
+        """
+        Return the times in increasing order and the order of the samples
+        (None if they were appended in time order).
+        """
+        with self.lock:
+            n = self._n
+            times = self._column('time')
+            if self._checked < n:
+                if self._in_order and \
+                       np.any(np.diff(times[max(self._checked - 1, 0):n]) < 0):
+                    self._in_order = False
+                self._checked = n
+            if self._in_order:
+                return times, None
+            if self._order is None:
+                self._order = self._load_order(times)
+                self._sorted_time = np.asarray(times[self._order])
+                self._unsaved = 0
+            if len(self._order) < n:
+                self._merge_order(times, n)
+            return self._sorted_time, self._order
+
+    def _merge_order(self, times, n):
+        """Merge the samples not yet in the sort order into it."""
+        m = len(self._order)
+        with instrument.span('store.sort'):
+            tail = m + np.argsort(times[m:n], kind='stable')
+            tail_time = np.asarray(times[tail])
+            # after the equal times already there, so that equal times
+            # stay in the order appended
+            at = np.searchsorted(self._sorted_time, tail_time, side='right')
+            self._order = np.insert(self._order, at, tail)
+            self._sorted_time = np.insert(self._sorted_time, at, tail_time)
+        self._unsaved += n - m
+        if self._unsaved >= max(order_save_min, n // 8):
+            self._save_order()
+
+    def _load_order(self, times):
+        """
+        Return the saved sort order of the first samples of ``times``, or
+        an empty order if there is none that fits them.
+        """
+        try:
+            order = np.load(os.path.join(self.path, 'order.npy'))
+            m = len(order)
+            if order.ndim == 1 and m <= len(times) and \
+                   (m == 0 or (order.min() >= 0 and order.max() < m and
+                               np.all(np.diff(times[order]) >= 0))):
+                return order.astype(np.intp)
+        except (IOError, OSError, ValueError):
+            pass
+        return np.zeros(0, dtype=np.intp)
+
+    def _save_order(self):
+        filename = os.path.join(self.path, 'order.npy')
+        try:
+            tmpfile = '{}.{:d}.tmp'.format(filename, os.getpid())
+            with open(tmpfile, 'wb') as out_f:
+                np.save(out_f, self._order)
+            os.replace(tmpfile, filename)
+            self._unsaved = 0
+        except (IOError, OSError):
+            pass
+
+    def range_index(self, start=None, end=None):
+        """
+        Return the samples with ``start <= time < end`` (either may be
+        None for an open range) in time order, as a slice or an array of
+        sample indices.
+        """
+        self.refresh()
+        sorted_time, order = self._time_index()
+        i0 = 0 if start is None else \
+             np.searchsorted(sorted_time, as_time(start), side='left')
+        i1 = len(sorted_time) if end is None else \
+             np.searchsorted(sorted_time, as_time(end), side='left')
+        i1 = max(i0, i1)
+        if order is None:
+            return slice(int(i0), int(i1))
+        return order[i0:i1]
+
+    def query(self, start=None, end=None, bars=None):
+        """
+        Return the samples with ``start <= time < end`` in time order as a
+        Bunch of ``time`` (m,), ``bar`` (k,), ``pos`` (m, k) and ``status``
+        (m, k) arrays, for the bar numbers in ``bars`` (default all 92).
+        Only the rows in the range are read.
+        """
+        with instrument.span('store.query'):
+            with self.lock:
+                rows = self.range_index(start, end)
+                barnos = np.arange(1, nbars+1) if bars is None else \
+                         np.atleast_1d(np.asarray(bars, dtype=int))
+                if np.any((barnos < 1) | (barnos > nbars)):
+                    raise ValueError("Bar numbers must be 1-{:d}".format(nbars))
+                cols = barnos - 1
+                pos = self._column('pos')[rows]
+                status = self._column('status')[rows]
+                if bars is not None:
+                    pos, status = pos[:, cols], status[:, cols]
+                return Bunch.Bunch(time=np.array(self._column('time')[rows]),
+                                   bar=barnos, pos=np.array(pos),
+                                   status=np.array(status))
+
+    def bar_series(self, bar, start=None, end=None):
+        """Return ``(time, pos, status)`` arrays of one bar over a range."""
+        res = self.query(start, end, bars=[bar])
+        return res.time, res.pos[:, 0], res.status[:, 0]
+
+    def get_state(self, index):
+        """Return sample ``index`` (in the order appended) as a `BarState`."""
+        with self.lock:
+            self.refresh()
+            if index < 0:
+                index += self._n
+            if not 0 <= index < self._n:
+                raise IndexError("bar store index out of range")
+            return csu_bars.BarState.from_arrays(
+                np.array(self._column('pos')[index]),
+                status=np.array(self._column('status')[index]),
+                time=float(self._column('time')[index]),
+                kind='store', source=self.path)
+
+    def latest(self):
+        """Return the newest sample as a `BarState`, or None if empty."""
+        with self.lock:
+            self.refresh()
+            if self._n == 0:
+                return None
+            sorted_time, order = self._time_index()
+            return self.get_state(self._n - 1 if order is None
+                                  else int(order[-1]))
+
+    def states(self, start=None, end=None):
+        """Return the samples in a range as a list of `BarState`."""
+        res = self.query(start, end)
+        return [csu_bars.BarState.from_arrays(p, status=s, time=t,
+                                              kind='store', source=self.path)
+                for t, p, s in zip(res.time, res.pos, res.status)]
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(path, logger=None):
+    """Return the process-wide `BarStore` for ``path``."""
+    path = os.path.abspath(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = BarStore(path, logger=logger)
+        return _stores[path]
+
+#END
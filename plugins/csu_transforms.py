@@ -0,0 +1,295 @@
+#
+# csu_transforms.py -- Pixel <-> physical coordinate transforms for the CSU
+#
+"""
+Affine transforms between detector pixels and CSU physical coordinates
+(bar position in mm, slit number).
+
+The transforms are fitted by least squares to a set of calibration points
+(see `plugins.csu_calibration` for where those come from).  Fitting is
+cheap but not free, and every channel that opens the CSU_initializer
+plugin needs the same result, so `load_transforms` caches the fitted
+matrices and the derived slit angle and height on disk under the Ginga
+home directory, keyed by a digest of the calibration points.
+
+Channels showing the same bar configuration also need the same overlay,
+so `cached_bar_geometry` keeps the geometry of the last few
+configurations in the process-wide `geometry_cache`, keyed by the
+transforms and the `csu_bars.BarState.position_digest`.  The cached
+arrays are read only.  `cached_bar_index` adds a `BoxIndex` of the bar
+bounding boxes, used to draw only the bars in view.
+"""
+import os
+import hashlib
+
+import numpy as np
+
+from ginga.misc import Bunch
+from ginga.util import paths
+
+from plugins import csu_bars, instrument
+
+# bump this if the contents of the cache files change
+cache_version = 1
+
+
+def slit_to_bars(slit):
+    return (slit*2-1, slit*2)
+
+def bar_to_slit(bar):
+    return int((bar+1)/2)
+
+
+def fit_transforms(pixels, physical):
+    """
+    Fit the affine transforms between ``pixels`` and ``physical``, both
+    arrays of shape (n, 2).  Returns ``(Apixel_to_physical,
+    Aphysical_to_pixel)``, each a 3x3 matrix acting on padded row vectors.
+    """
+    assert pixels.shape[1] == 2
+    assert physical.shape[1] == 2
+    assert pixels.shape[0] == physical.shape[0]
+
+    # Pad the data with ones, so that our transformation can do translations too
+    X = pad(pixels)
+    Y = pad(physical)
+
+    # Solve the least squares problem X * A = Y
+    # to find our transformation matrix A
+    A, res, rank, s = np.linalg.lstsq(X, Y, rcond=None)
+    Ainv, res, rank, s = np.linalg.lstsq(Y, X, rcond=None)
+    A[np.abs(A) < 1e-10] = 0
+    Ainv[np.abs(A) < 1e-10] = 0
+    return A, Ainv
+
+def pad(x):
+    return np.hstack([x, np.ones((x.shape[0], 1))])
+
+def unpad(x):
+    return x[:,:-1]
+
+def apply_transform(A, x):
+    """
+    Apply the padded affine transform ``A`` to the (n, 2) points ``x``.
+    Equivalent to ``unpad(np.dot(pad(x), A))`` without building the padded
+    copy of ``x``.
+    """
+    x = np.asarray(x, dtype=float)
+    return np.dot(x, A[:2,:2]) + A[2,:2]
+
+def slit_geometry(Aphysical_to_pixel):
+    """
+    Determine slit angle and bar center to center distance in pixels
+    from the transformation and the known longslit positions.
+    Returns ``(slit_angle_pix, slit_height_pix)``.
+    """
+    ##   in longslit, bar 02 is at 145.472
+    ##   in longslit, bar 92 is at 129.480
+    physical = [ [145.472, bar_to_slit(2)],
+                 [129.480, bar_to_slit(92)] ]
+    pixels = apply_transform(Aphysical_to_pixel, physical)
+    dx = pixels[1][0] - pixels[0][0]
+    dy = pixels[0][1] - pixels[1][1]
+    slit_angle_pix = np.arctan(dx/dy)
+    slit_height_pix = dy / (bar_to_slit(92) - bar_to_slit(2))
+    return slit_angle_pix, slit_height_pix
+
+@instrument.timed('transform.bar_geometry')
+def bar_geometry(transforms, bars, barnos=None, draw_height=0.45):
+    """
+    Compute the outline of each bar and the anchor of its label in
+    pixel coordinates.  All polygons and labels go through a single
+    call to `apply_transform`.
+
+    ``transforms`` is a Bunch as returned by `load_transforms` and
+    ``bars`` a `csu_bars.BarState` (or a dict mapping bar number to
+    position in mm).  ``barnos`` selects the bars to compute (default all
+    in ``bars``).  Returns ``(barnos, polygons, labels)`` where
+    ``polygons`` has shape (n, 4, 2) and ``labels`` has shape (n, 2).
+    """
+    bars = csu_bars.as_bar_state(bars)
+    if barnos is None:
+        barnos = bars.bar.astype(int)
+        positions = bars.pos
+    else:
+        barnos = np.asarray(barnos)
+        positions = bars.positions_of(barnos)
+    slits = (barnos + 1) // 2
+    odd = (barnos % 2) == 1
+
+    # odd bars are drawn from the low end of the CSU, even bars from
+    # the high end
+    bar_end = np.where(odd, 8.0, 270.4+2.0)
+    label_pos = np.where(odd, 14.0, 270.4-2.0)
+
+    # four polygon corners followed by the label anchor for each bar
+    physical = np.empty((len(barnos), 5, 2))
+    physical[:,0] = np.column_stack([bar_end, slits-draw_height])
+    physical[:,1] = np.column_stack([bar_end, slits+draw_height])
+    physical[:,2] = np.column_stack([positions, slits+draw_height])
+    physical[:,3] = np.column_stack([positions, slits-draw_height])
+    physical[:,4] = np.column_stack([label_pos, slits+0.3])
+
+    pixels = apply_transform(transforms.Aphysical_to_pixel,
+                             physical.reshape(-1, 2))
+    pixels = pixels.reshape(len(barnos), 5, 2)
+    dx = draw_height * transforms.slit_height_pix * \
+         np.sin(transforms.slit_angle_pix)
+    pixels[:,2,0] += dx
+    pixels[:,3,0] -= dx
+    return barnos, pixels[:,:4], pixels[:,4]
+
+geometry_cache = csu_bars.LRUCache(maxsize=32)
+
+def transforms_key(transforms):
+    """
+    Return a digest identifying the pixel transform of ``transforms``,
+    kept in the Bunch as ``key`` once computed.
+    """
+    key = transforms.get('key', None)
+    if key is None:
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(transforms.Aphysical_to_pixel,
+                                      dtype=np.float64).tobytes())
+        h.update(np.array([transforms.slit_angle_pix,
+                           transforms.slit_height_pix]).tobytes())
+        key = transforms.key = h.hexdigest()
+    return key
+
+def cached_bar_geometry(transforms, bars, draw_height=0.45):
+    """
+    `bar_geometry` of all the bars in ``bars``, shared through
+    `geometry_cache` by every caller asking for the same configuration.
+    The arrays returned are read only.
+    """
+    bars = csu_bars.as_bar_state(bars)
+    key = (transforms_key(transforms), bars.position_digest(), draw_height)
+    result = geometry_cache.get(key)
+    if result is not None:
+        instrument.count('transform.geometry_hits')
+        return result
+    instrument.count('transform.geometry_misses')
+    result = bar_geometry(transforms, bars, draw_height=draw_height)
+    for arr in result:
+        arr.flags.writeable = False
+    geometry_cache.put(key, result)
+    return result
+
+class BoxIndex(object):
+    """
+    Index of the bounding boxes of the bars, for finding the bars in
+    view.  The boxes, an (n, 4) array of ``(x1, y1, x2, y2)``, are kept
+    sorted by their lower edge, so a query only tests the boxes in the
+    band of rows it spans.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.order = np.argsort(self.bounds[:,1], kind='stable')
+        self.y1 = self.bounds[self.order,1]
+        self.height = 0.0
+        if len(self.bounds) > 0:
+            self.height = np.max(self.bounds[:,3] - self.bounds[:,1])
+
+    @classmethod
+    def from_geometry(cls, polygons, labels):
+        """Index the boxes around each polygon and its label anchor."""
+        points = np.concatenate([polygons, labels[:,np.newaxis]], axis=1)
+        return cls(np.hstack([points.min(axis=1), points.max(axis=1)]))
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def query(self, x1, y1, x2, y2):
+        """
+        Return a boolean mask of the boxes meeting the rectangle
+        ``(x1, y1, x2, y2)``.
+        """
+        lo = np.searchsorted(self.y1, y1 - self.height, side='left')
+        hi = np.searchsorted(self.y1, y2, side='right')
+        idx = self.order[lo:hi]
+        b = self.bounds[idx]
+        meets = (b[:,0] <= x2) & (b[:,2] >= x1) & (b[:,3] >= y1)
+        mask = np.zeros(len(self.bounds), dtype=bool)
+        mask[idx[meets]] = True
+        return mask
+
+def cached_bar_index(transforms, bars, draw_height=0.45):
+    """
+    `BoxIndex` of the `cached_bar_geometry` of ``bars``, kept in
+    `geometry_cache` along with it.
+    """
+    bars = csu_bars.as_bar_state(bars)
+    key = ('index', transforms_key(transforms), bars.position_digest(),
+           draw_height)
+    index = geometry_cache.get(key)
+    if index is None:
+        barnos, polygons, labels = cached_bar_geometry(
+            transforms, bars, draw_height=draw_height)
+        index = BoxIndex.from_geometry(polygons, labels)
+        geometry_cache.put(key, index)
+    return index
+
+def calibration_digest(pixels, physical):
+    """Return a hex digest identifying a set of calibration points."""
+    h = hashlib.sha1()
+    for arr in (pixels, physical):
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+def get_cache_dir():
+    return os.path.join(paths.ginga_home, 'csu_cache')
+
+@instrument.timed('transform.fit')
+def fit_all(pixels, physical):
+    """Fit the transforms and derived slit geometry; returns a Bunch."""
+    A, Ainv = fit_transforms(pixels, physical)
+    slit_angle_pix, slit_height_pix = slit_geometry(Ainv)
+    return Bunch.Bunch(Apixel_to_physical=A, Aphysical_to_pixel=Ainv,
+                       slit_angle_pix=slit_angle_pix,
+                       slit_height_pix=slit_height_pix)
+
+@instrument.timed('load.transforms')
+def load_transforms(pixels, physical, cache_dir=None, logger=None):
+    """
+    Return the fitted transforms for a set of calibration points as a
+    Bunch with ``Apixel_to_physical``, ``Aphysical_to_pixel``,
+    ``slit_angle_pix`` and ``slit_height_pix``.  The result is read from
+    the on-disk cache if present, otherwise it is fitted and saved there.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    digest = calibration_digest(pixels, physical)
+    filename = os.path.join(cache_dir, 'transform_v{:d}_{}.npz'.format(
+        cache_version, digest))
+
+    try:
+        with np.load(filename) as npz:
+            return Bunch.Bunch(
+                Apixel_to_physical=npz['Apixel_to_physical'],
+                Aphysical_to_pixel=npz['Aphysical_to_pixel'],
+                slit_angle_pix=float(npz['slit_angle_pix']),
+                slit_height_pix=float(npz['slit_height_pix']))
+    except (IOError, OSError, KeyError, ValueError):
+        instrument.count('load.transforms_cache_miss')
+
+    if logger is not None:
+        logger.info("Fitting CSU transforms ({})".format(digest))
+    result = fit_all(pixels, physical)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary file first so that a concurrent reader
+        # never sees a partial cache entry
+        tmpname = '{}.{:d}.tmp.npz'.format(filename[:-4], os.getpid())
+        np.savez(tmpname, **result)
+        os.replace(tmpname, filename)
+    except (IOError, OSError) as e:
+        if logger is not None:
+            logger.warning("Could not write transform cache '{}': {}".format(
+                filename, str(e)))
+    return result
+
+#END
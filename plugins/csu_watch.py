@@ -0,0 +1,127 @@
+#
+# csu_watch.py -- Follow a csu_bar_state file as the CSU rewrites it
+#
+"""
+Background watcher for csu_bar_state files.
+
+The CSU controller rewrites its state file many times a second while bars
+are moving.  `BarStateWatcher` polls the file (or the newest file in a
+directory) with ``os.stat`` from a background thread, re-parses it only
+when its mtime or size changed and hands the result to a callback no more
+than ``max_rate`` times per second.  Intermediate versions of the file that
+arrive faster than that are skipped; the callback always gets the latest.
+
+The callback is invoked on the watcher thread, so a GUI user should pass
+something like ``lambda result: fv.gui_do(update, result)``.
+"""
+import os
+import threading
+import time
+
+from plugins import instrument
+
+
+class BarStateWatcher(object):
+
+    def __init__(self, path, parser, callback, poll_interval=0.1,
+                 max_rate=5.0, logger=None):
+        """
+        ``path`` is a state file or a directory of state files,
+        ``parser`` turns a filename into a result and ``callback`` is
+        called with each result.  A parser that raises is assumed to have
+        seen a partially written file and is retried on the next poll.
+        """
+        self.path = path
+        self.parser = parser
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.max_rate = max_rate
+        self.logger = logger
+
+        self._ev_quit = threading.Event()
+        self._thread = None
+        self._last_key = None
+        self._last_delivery = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._ev_quit.clear()
+        self._last_key = None
+        self._thread = threading.Thread(target=self._run,
+                                        name='BarStateWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._ev_quit.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def current_file(self):
+        """Return the file currently being followed, or None."""
+        if not os.path.isdir(self.path):
+            return self.path
+        newest, newest_mtime = None, None
+        for entry in os.scandir(self.path):
+            if not entry.is_file():
+                continue
+            mtime = entry.stat().st_mtime_ns
+            if newest_mtime is None or mtime > newest_mtime:
+                newest, newest_mtime = entry.path, mtime
+        return newest
+
+    def poll(self):
+        """
+        Check the file once and deliver a new result if it changed and
+        the rate limit allows.  Returns True if the callback was called.
+        """
+        filename = self.current_file()
+        if filename is None:
+            return False
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        key = (filename, st.st_mtime_ns, st.st_size)
+        if key == self._last_key:
+            return False
+
+        min_interval = 1.0 / self.max_rate if self.max_rate else 0.0
+        now = time.monotonic()
+        if now - self._last_delivery < min_interval:
+            # coalesce: leave the change pending until the next slot
+            instrument.count('watch.deferred')
+            return False
+
+        try:
+            with instrument.span('load.state_file'):
+                result = self.parser(filename)
+        except Exception as e:
+            instrument.count('watch.parse_errors')
+            if self.logger is not None:
+                self.logger.debug("Could not parse '%s': %s" % (
+                    filename, str(e)))
+            return False
+
+        self._last_key = key
+        self._last_delivery = now
+        instrument.count('watch.updates')
+        self.callback(result)
+        return True
+
+    def _run(self):
+        while not self._ev_quit.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error("Error watching '%s': %s" % (
+                        self.path, str(e)))
+            self._ev_quit.wait(self.poll_interval)
+
+#END
@@ -0,0 +1,171 @@
+#
+# instrument.py -- Spans, counters and latency histograms for the plugins
+#
+"""
+Lightweight instrumentation shared by the CSU plugins and helpers.
+
+Stages of the overlay pipeline are timed as named spans, by convention
+``<stage>.<what>`` with the stages ``load``, ``parse``, ``transform``,
+``analyze``, ``draw`` and ``redraw``:
+
+    with instrument.span('draw.overlay'):
+        ...
+
+    @instrument.timed('parse.csu_bar_state')
+    def parse_csu_bar_state(filename):
+        ...
+
+Each span name keeps a latency `Histogram` (count, total, min, max and
+log-spaced buckets, so percentiles are available without keeping every
+sample), and `count` keeps plain counters.  The numbers are process
+wide; `report` formats them as a table (shown in the CSU_initializer
+latency panel) and `dump` appends a snapshot as one JSON line to a file.
+
+The cost of a span is two ``perf_counter`` calls and a lock, small next
+to any of the stages timed.  Set ``instrument.enabled = False`` to turn
+it off altogether.
+"""
+import json
+import math
+import time
+import bisect
+import threading
+import functools
+import contextlib
+
+enabled = True
+
+# histogram bucket upper bounds: four per decade from 1 us to 100 s
+bucket_bounds = [1e-6 * 10**(i / 4.) for i in range(33)]
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+class Histogram(object):
+    """Latency histogram of one span name, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+
+    def add(self, dt):
+        self.count += 1
+        self.total += dt
+        self.min = min(self.min, dt)
+        self.max = max(self.max, dt)
+        self.buckets[bisect.bisect_left(bucket_bounds, dt)] += 1
+
+    def percentile(self, q):
+        """
+        Estimate the ``q`` percentile (0-100) from the buckets; accurate
+        to a bucket width (a factor of 1.8).
+        """
+        if self.count == 0:
+            return math.nan
+        rank = q / 100. * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                lo = bucket_bounds[i-1] if i > 0 else self.min
+                hi = bucket_bounds[i] if i < len(bucket_bounds) else self.max
+                return min(max(math.sqrt(lo * hi), self.min), self.max)
+        return self.max
+
+    def as_dict(self):
+        return dict(count=self.count, total=self.total,
+                    mean=self.total / self.count if self.count else math.nan,
+                    min=self.min if self.count else math.nan, max=self.max,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99))
+
+
+def observe(name, dt):
+    """Add a duration ``dt`` in seconds to the histogram of ``name``."""
+    if not enabled:
+        return
+    with _lock:
+        hist = _histograms.get(name, None)
+        if hist is None:
+            hist = _histograms[name] = Histogram()
+        hist.add(dt)
+
+def count(name, n=1):
+    """Add ``n`` to the counter ``name``."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+@contextlib.contextmanager
+def span(name):
+    """Time the body of a ``with`` statement as the span ``name``."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0)
+
+def timed(name):
+    """Decorator timing each call of a function as the span ``name``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+def get_stats():
+    """
+    Return a snapshot ``dict(spans={name: stats}, counters={name: n})``,
+    the span stats being those of `Histogram.as_dict`.
+    """
+    with _lock:
+        spans = dict([(name, hist.as_dict())
+                      for name, hist in _histograms.items()])
+        counters = dict(_counters)
+    return dict(spans=spans, counters=counters)
+
+def report(stats=None):
+    """Format the spans and counters as a fixed-width text table."""
+    if stats is None:
+        stats = get_stats()
+    lines = ["{:28s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s}".format(
+        'span', 'count', 'p50 ms', 'p90 ms', 'max ms', 'total s')]
+    for name in sorted(stats['spans'].keys()):
+        s = stats['spans'][name]
+        lines.append("{:28s} {:7d} {:9.3f} {:9.3f} {:9.3f} {:9.3f}".format(
+            name, s['count'], 1e3*s['p50'], 1e3*s['p90'], 1e3*s['max'],
+            s['total']))
+    if len(stats['counters']) > 0:
+        lines.append('')
+        for name in sorted(stats['counters'].keys()):
+            lines.append("{:28s} {:7d}".format(name, stats['counters'][name]))
+    return '\n'.join(lines)
+
+def dump(filename, **extra):
+    """
+    Append a snapshot of the stats, with the time and any ``extra``
+    items, as one JSON line to ``filename``.
+    """
+    record = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), **extra)
+    record.update(get_stats())
+    with open(filename, 'a') as out_f:
+        out_f.write(json.dumps(record) + '\n')
+    return record
+
+#END
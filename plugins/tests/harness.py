@@ -0,0 +1,783 @@
+#
+# harness.py -- Headless stand-in for the Ginga reference viewer
+#
+"""
+A fake Ginga reference viewer for running the plugins without a GUI.
+
+`Harness` stands in for the ``fv`` shell a plugin is given: preferences,
+draw classes, channels with a viewer (``fitsimage``) each, timers,
+``gui_do``/``nongui_do`` and the channel callbacks.  The plugin modules
+are imported as usual, but their ``Widgets`` and ``FileSelection`` are
+swapped for recording fakes, so ``build_gui`` runs with no widget toolkit
+installed.  The swaps last until `Harness.close`, which puts the real
+ones back; run one harness at a time.
+
+Every canvas handed out (the channel canvases and any ``DrawingCanvas``
+a plugin makes from ``get_draw_classes()``) is a real Ginga canvas that
+also reports each add, delete and redraw to the harness `Recorder`, and
+every plugin lifecycle call made through the harness (``__init__``,
+``build_gui``, ``start``, ``redo``, ``pause``, ``resume``, ``stop``) is
+timed, so draw counts and latencies can be checked:
+
+    >>> h = Harness()
+    >>> h.add_channel('Image')
+    >>> p = h.start_local_plugin('Image', 'CSU_initializer')
+    >>> h.recorder.reset()
+    >>> p.overlaybars(bars)
+    >>> h.recorder.counts['add'], h.recorder.counts['redraw']
+    (1, 1)
+    >>> print(h.report())
+
+Calls a plugin makes to ``fv.gui_do`` from another thread are queued, as
+in Ginga, and run by `Harness.process_events`.
+
+    $ python -m plugins.tests.harness     # run every plugin once, print timings
+"""
+import os
+import sys
+import time
+import shutil
+import queue
+import logging
+import tempfile
+import threading
+import importlib
+import collections
+import contextlib
+import concurrent.futures
+
+import numpy as np
+
+from ginga import AstroImage
+from ginga.misc import Bunch, Callback, Settings
+from ginga.canvas.CanvasObject import get_canvas_types
+from ginga.canvas.types.layer import DrawingCanvas
+
+import ginga.gw.GwHelp as GwHelp
+
+
+class Recorder(object):
+    """
+    Collects the canvas operations and the timed calls of a harness.
+    ``counts`` holds the number of each operation, ``events`` the
+    operations in order as ``(op, canvas name, detail)`` tuples and
+    ``timings`` a list of durations in seconds for each timed name.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = collections.Counter()
+            self.events = []
+            self.timings = collections.defaultdict(list)
+
+    def record(self, op, canvas, detail=None, n=1):
+        with self.lock:
+            self.counts[op] += n
+            self.events.append((op, canvas, detail))
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            with self.lock:
+                self.timings[name].append(dt)
+
+    def report(self):
+        lines = []
+        for name in sorted(self.timings.keys()):
+            times = np.array(self.timings[name])
+            lines.append("{:40s} {:5d} calls {:10.3f} ms median {:10.3f} ms max".format(
+                name, len(times), 1e3*np.median(times), 1e3*np.max(times)))
+        lines.append(' '.join(['{}={:d}'.format(op, self.counts[op])
+                               for op in sorted(self.counts.keys())]))
+        return '\n'.join(lines)
+
+
+class RecordingCanvas(DrawingCanvas):
+    """
+    A `DrawingCanvas` that tells its `Recorder` about every add, delete
+    and redraw.  Redraws requested by ``add`` and the deletes are counted
+    as well as direct ``update_canvas``/``redraw`` calls.
+    """
+    recorder = None
+
+    def _record(self, op, detail=None, n=1):
+        if self.recorder is not None:
+            self.recorder.record(op, self.name, detail, n=n)
+
+    def add(self, obj, tag=None, tagpfx=None, belowThis=None, redraw=True):
+        self._record('add', obj.kind)
+        return super(RecordingCanvas, self).add(obj, tag=tag, tagpfx=tagpfx,
+                                                belowThis=belowThis,
+                                                redraw=redraw)
+
+    def delete_objects_by_tag(self, tags, redraw=True):
+        tags = list(tags)
+        self._record('delete', tags, n=len(tags))
+        super(RecordingCanvas, self).delete_objects_by_tag(tags,
+                                                           redraw=redraw)
+
+    def delete_objects(self, objects, redraw=True):
+        objects = list(objects)
+        self._record('delete', None, n=len(objects))
+        super(RecordingCanvas, self).delete_objects(objects, redraw=redraw)
+
+    def delete_all_objects(self, redraw=True):
+        self._record('delete', 'all', n=len(self.objects))
+        super(RecordingCanvas, self).delete_all_objects(redraw=redraw)
+
+    def update_canvas(self, whence=3):
+        self._record('redraw', whence)
+        super(RecordingCanvas, self).update_canvas(whence=whence)
+
+    def redraw(self, whence=3):
+        self._record('redraw', whence)
+        super(RecordingCanvas, self).redraw(whence=whence)
+
+    def ui_setActive(self, tf):
+        self.ui_set_active(tf)
+
+
+## ------------------------------------------------------------------
+##  Widgets
+## ------------------------------------------------------------------
+
+class FakeWidget(Callback.Callbacks):
+    """
+    Stand-in for every `ginga.gw.Widgets` class.  It keeps its text,
+    state and children and runs its callbacks, so a test can press a
+    button with ``w.activate()``, toggle a check box with
+    ``w.activate(True)`` or enter text with ``w.set_text(s); w.activate()``.
+    Any other widget method is accepted and ignored.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FakeWidget, self).__init__()
+        self.text = args[0] if len(args) > 0 and isinstance(args[0], str) else ''
+        self.state = False
+        self.value = None
+        self.children = []
+        self.widget = None
+
+    def add_callback(self, name, fn, *args, **kwargs):
+        self.enable_callback(name)
+        super(FakeWidget, self).add_callback(name, fn, *args, **kwargs)
+
+    def activate(self, *args):
+        if len(args) > 0 and isinstance(args[0], bool):
+            self.state = args[0]
+        return self.make_callback('activated', *args)
+
+    def set_text(self, text):
+        self.text = text
+
+    def get_text(self):
+        return self.text
+
+    def set_state(self, tf):
+        self.state = tf
+
+    def get_state(self):
+        return self.state
+
+    def set_value(self, value):
+        self.value = value
+
+    def get_value(self):
+        return self.value
+
+    def add_widget(self, child, stretch=0):
+        self.children.append(child)
+
+    def set_widget(self, child):
+        self.children = [child]
+
+    def get_widget(self):
+        return self.widget
+
+    def get_size(self):
+        return (300, 600)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: None
+
+
+class FakeFileSelection(object):
+    """Stand-in for `ginga.gw.GwHelp.FileSelection`; never pops up."""
+
+    def __init__(self, parent_w, **kwargs):
+        self.requests = []
+
+    def popup(self, title, callfn, **kwargs):
+        self.requests.append((title, callfn, kwargs))
+
+
+def name_mangle(name, pfx=''):
+    newname = []
+    for c in name.lower():
+        if not (c.isalpha() or c.isdigit() or (c == '_')):
+            newname.append('_')
+        else:
+            newname.append(c)
+    return pfx + ''.join(newname)
+
+def build_info(captions, orientation='vertical'):
+    """As ``Widgets.build_info``: returns ``(widget, bunch)``."""
+    w = FakeWidget()
+    wb = Bunch.Bunch()
+    for tup in captions:
+        if len(tup) % 2 != 0:
+            raise ValueError("Column spec is not an even number")
+        for idx in range(0, len(tup), 2):
+            title, wtype = tup[idx:idx + 2]
+            if title.startswith('^'):
+                title = title[1:]
+            if not title.endswith(':'):
+                name = name_mangle(title)
+            else:
+                name = name_mangle('lbl_' + title[:-1])
+            wb[name] = FakeWidget(title)
+            w.add_widget(wb[name])
+    return w, wb
+
+def get_oriented_box(container, scrolled=True, fill=False, aspect=2.0,
+                     orientation=None):
+    if orientation is None:
+        orientation = 'vertical'
+    box = FakeWidget()
+    sw = FakeWidget()
+    sw.set_widget(box)
+    return box, sw, orientation
+
+fake_widgets = Bunch.Bunch(build_info=build_info,
+                           get_oriented_box=get_oriented_box,
+                           name_mangle=name_mangle)
+for _name in ('VBox', 'HBox', 'GridBox', 'Frame', 'Expander', 'ScrollArea',
+              'Splitter', 'TabWidget', 'StackWidget', 'Button', 'Label',
+              'TextArea', 'TextEntry', 'TextEntrySet', 'CheckBox',
+              'ToggleButton', 'RadioButton', 'ComboBox', 'SpinBox', 'Slider',
+              'ScrollBar', 'ProgressBar', 'Image', 'Toolbar', 'Menubar'):
+    fake_widgets[_name] = FakeWidget
+
+_missing = object()
+
+@contextlib.contextmanager
+def patched(target, name, value):
+    """Set the attribute ``name`` of ``target`` to ``value`` for a while."""
+    old = getattr(target, name, _missing)
+    setattr(target, name, value)
+    try:
+        yield
+    finally:
+        if old is _missing:
+            delattr(target, name)
+        else:
+            setattr(target, name, old)
+
+def load_plugin(name, patches):
+    """
+    Import the plugin module ``plugins.<name>`` with fake widgets and
+    return its plugin class (of the same name).  A class is returned
+    as given.  The fakes are undone when the `contextlib.ExitStack`
+    ``patches`` is closed.
+    """
+    if not isinstance(name, str):
+        return name
+    modname = 'plugins.' + name
+    if modname not in sys.modules and not hasattr(GwHelp, 'FileSelection'):
+        # without a widget toolkit GwHelp has no FileSelection, and the
+        # plugin modules import it by name; a module imported that way is
+        # forgotten afterwards, so it is imported anew next time
+        patches.enter_context(patched(GwHelp, 'FileSelection',
+                                      FakeFileSelection))
+        patches.callback(sys.modules.pop, modname, None)
+    module = importlib.import_module(modname)
+    for attr, fake in (('Widgets', fake_widgets),
+                       ('FileSelection', FakeFileSelection)):
+        if getattr(module, attr, fake) is not fake:
+            patches.enter_context(patched(module, attr, fake))
+    return getattr(module, name)
+
+
+## ------------------------------------------------------------------
+##  Viewer, channels and timers
+## ------------------------------------------------------------------
+
+class FakeViewer(Callback.Callbacks):
+    """
+    Stand-in for a channel's image viewer (the ``fitsimage`` of a local
+    plugin).  It has a recording canvas, scale and pan settings, and
+    reports the data rectangle in view for a window of ``wd`` x ``ht``.
+    """
+
+    def __init__(self, name, recorder, canvas_class, logger=None,
+                 wd=1024, ht=1024):
+        super(FakeViewer, self).__init__()
+        for name_ in ('image-set', 'redraw'):
+            self.enable_callback(name_)
+        self.name = name
+        self.logger = logger
+        self.recorder = recorder
+        self.window_size = (wd, ht)
+        self.image = None
+        self.canvas = canvas_class()
+        self.canvas.set_surface(self)
+        self.t_ = Settings.SettingGroup(name=name, logger=logger)
+        self.t_.set_defaults(scale=(1.0, 1.0), pan=(0.0, 0.0))
+
+    def get_settings(self):
+        return self.t_
+
+    def get_canvas(self):
+        return self.canvas
+
+    def get_image(self):
+        return self.image
+
+    def set_image(self, image):
+        self.image = image
+        wd, ht = image.get_size()
+        self.t_.set(pan=(wd / 2.0 - 0.5, ht / 2.0 - 0.5))
+        self.make_callback('image-set', image)
+
+    def redraw(self, whence=0):
+        self.recorder.record('viewer-redraw', self.name, whence)
+        self.make_callback('redraw', whence)
+
+    def get_window_size(self):
+        return self.window_size
+
+    def set_window_size(self, wd, ht):
+        self.window_size = (wd, ht)
+
+    def get_scale(self):
+        return max(self.t_['scale'])
+
+    def get_scale_xy(self):
+        return self.t_['scale']
+
+    def scale_to(self, scale_x, scale_y):
+        self.t_.set(scale=(scale_x, scale_y))
+
+    def get_pan(self, coord='data'):
+        return self.t_['pan']
+
+    def set_pan(self, pan_x, pan_y, coord='data'):
+        self.t_.set(pan=(pan_x, pan_y))
+
+    def get_datarect(self):
+        wd, ht = self.window_size
+        scale_x, scale_y = self.t_['scale']
+        pan_x, pan_y = self.t_['pan']
+        hw, hh = wd / scale_x / 2.0, ht / scale_y / 2.0
+        return (pan_x - hw, pan_y - hh, pan_x + hw, pan_y + hh)
+
+
+class FakeChannel(object):
+
+    def __init__(self, name, viewer):
+        self.name = name
+        self.fitsimage = viewer
+        self.viewer = viewer
+        self.images = []
+
+    def get_current_image(self):
+        return self.fitsimage.get_image()
+
+    def add_image(self, image):
+        self.images.append(image)
+        self.fitsimage.set_image(image)
+
+
+class FakeTimer(Callback.Callbacks):
+    """
+    Stand-in for a Ginga timer.  It never fires by itself: the harness
+    fires the timers that are set with `Harness.fire_timers`.
+    """
+
+    def __init__(self):
+        super(FakeTimer, self).__init__()
+        for name in ('expired', 'canceled'):
+            self.enable_callback(name)
+        self.deadline = None
+
+    def set(self, duration):
+        self.deadline = time.time() + duration
+
+    start = set
+
+    def is_set(self):
+        return self.deadline is not None
+
+    def time_left(self):
+        if self.deadline is None:
+            return 0.0
+        return max(0.0, self.deadline - time.time())
+
+    def clear(self):
+        self.deadline = None
+
+    def cancel(self):
+        if self.deadline is not None:
+            self.deadline = None
+            self.make_callback('canceled')
+
+    stop = cancel
+
+    def fire(self):
+        if self.deadline is not None:
+            self.deadline = None
+            self.make_callback('expired')
+
+
+## ------------------------------------------------------------------
+##  Reference viewer
+## ------------------------------------------------------------------
+
+class _SettingGroup(Settings.SettingGroup):
+    # the plugins use the pre-1.0 Ginga names
+    setDefaults = Settings.SettingGroup.set_defaults
+
+    def load(self, onError='raise', buf=None):
+        if self.preffile is None and buf is None:
+            return
+        super(_SettingGroup, self).load(onError=onError, buf=buf)
+
+
+class FakePreferences(object):
+    """In-memory preferences; nothing is read from or saved to disk."""
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.settings = {}
+
+    def create_category(self, category):
+        if category not in self.settings:
+            self.settings[category] = _SettingGroup(name=category,
+                                                    logger=self.logger)
+        return self.settings[category]
+
+    createCategory = create_category
+    get_settings = create_category
+
+
+class Harness(Callback.Callbacks):
+    """
+    The fake reference viewer shell.  Plugins may be given by class or
+    by the name of their module in `plugins`.
+    """
+
+    def __init__(self, logger=None):
+        super(Harness, self).__init__()
+        for name in ('add-channel', 'delete-channel', 'channel-change',
+                     'add-image', 'active-image'):
+            self.enable_callback(name)
+
+        if logger is None:
+            logger = logging.getLogger('harness')
+            logger.addHandler(logging.NullHandler())
+        self.logger = logger
+        self.recorder = Recorder()
+        self.prefs = FakePreferences(logger=logger)
+        self.w = Bunch.Bunch(root=FakeWidget())
+
+        self.canvas_class = type('RecordingCanvas', (RecordingCanvas,),
+                                 dict(recorder=self.recorder))
+        self.dc = Bunch.Bunch(dict(get_canvas_types().items()), caseless=True)
+        self.dc.DrawingCanvas = self.canvas_class
+
+        self.channels = collections.OrderedDict()
+        self.cur_channel = None
+        self.local_plugins = {}
+        self.global_plugins = {}
+        self.active = []
+        self.timers = []
+        self.status = ''
+        self.errors = []
+
+        self.gui_thread = threading.current_thread()
+        self.gui_queue = queue.Queue()
+        self.executor = None
+        self.tasks = []
+        self.patches = contextlib.ExitStack()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    ## -- the parts of the shell API used by the plugins --
+
+    def get_preferences(self):
+        return self.prefs
+
+    def get_draw_classes(self):
+        return self.dc
+
+    def get_channel(self, chname):
+        return self.channels[chname]
+
+    def get_channel_name(self, fitsimage):
+        for channel in self.channels.values():
+            if channel.fitsimage is fitsimage:
+                return channel.name
+        return None
+
+    def get_current_channel(self):
+        return self.cur_channel
+
+    def get_font(self, font_family, point_size):
+        return (font_family, point_size)
+
+    def get_timer(self):
+        timer = FakeTimer()
+        self.timers.append(timer)
+        return timer
+
+    def gui_do(self, method, *args, **kwargs):
+        """Run ``method`` now on the GUI thread, else queue it."""
+        if threading.current_thread() is self.gui_thread:
+            return method(*args, **kwargs)
+        self.gui_queue.put((method, args, kwargs))
+
+    gui_call = gui_do
+
+    def nongui_do(self, method, *args, **kwargs):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=4)
+        future = self.executor.submit(method, *args, **kwargs)
+        self.tasks = [task for task in self.tasks if not task.done()]
+        self.tasks.append(future)
+        return future
+
+    def show_status(self, text):
+        self.status = text
+
+    def show_error(self, text, raisetab=True):
+        self.errors.append(text)
+        self.logger.error(text)
+
+    def help_text(self, name, text, text_kind='plain', trim_pfx=0):
+        pass
+
+    ## -- driving the harness --
+
+    def process_events(self, timeout=0.0):
+        """
+        Run the queued ``gui_do`` calls, waiting up to ``timeout`` seconds
+        for the first one.  Returns the number run.
+        """
+        n = 0
+        try:
+            method, args, kwargs = self.gui_queue.get(timeout=timeout) \
+                if timeout > 0 else self.gui_queue.get_nowait()
+            while True:
+                method(*args, **kwargs)
+                n += 1
+                method, args, kwargs = self.gui_queue.get_nowait()
+        except queue.Empty:
+            pass
+        return n
+
+    def wait_idle(self, timeout=10.0):
+        """
+        Run queued ``gui_do`` calls until every ``nongui_do`` task has
+        finished and nothing is queued.  Returns False on a timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            busy = any([not task.done() for task in self.tasks])
+            if self.process_events(0.005) == 0 and not busy and \
+                   self.gui_queue.empty():
+                return True
+        return False
+
+    def fire_timers(self):
+        """Fire every timer that is set, as if its time had run out."""
+        n = 0
+        for timer in list(self.timers):
+            if timer.is_set():
+                timer.fire()
+                n += 1
+        return n
+
+    def add_channel(self, chname, wd=1024, ht=1024):
+        viewer = FakeViewer(chname, self.recorder, self.canvas_class,
+                            logger=self.logger, wd=wd, ht=ht)
+        channel = FakeChannel(chname, viewer)
+        self.channels[chname] = channel
+        self.make_callback('add-channel', channel)
+        self.change_channel(chname)
+        return channel
+
+    def delete_channel(self, chname):
+        for key in [key for key in self.active if key[0] == chname]:
+            self.stop_local_plugin(chname, key[1])
+        channel = self.channels.pop(chname)
+        self.make_callback('delete-channel', channel)
+
+    def change_channel(self, chname):
+        self.cur_channel = self.channels[chname]
+        self.make_callback('channel-change', self.cur_channel)
+
+    def load_image(self, chname, image, name=None):
+        """
+        Load ``image`` (an `AstroImage`, a numpy array or the name of a FITS
+        file) into a channel and let the open plugins redo.
+        """
+        if isinstance(image, str):
+            filename, image = image, AstroImage.AstroImage(logger=self.logger)
+            image.load_file(filename)
+        elif isinstance(image, np.ndarray):
+            data, image = image, AstroImage.AstroImage(logger=self.logger)
+            image.set_data(data)
+        if name is not None:
+            image.set(name=name)
+        channel = self.channels[chname]
+        with self.recorder.timed('load_image'):
+            channel.add_image(image)
+        self.make_callback('add-image', chname, image, None)
+
+        for key in list(self.active):
+            if key[0] == chname:
+                self._call(self.local_plugins[key], 'redo')
+            elif key[0] is None:
+                self._call(self.global_plugins[key[1]], 'redo', channel,
+                           image)
+        return image
+
+    def _call(self, plugin, method, *args):
+        func = getattr(plugin, method, None)
+        if func is None:
+            return None
+        with self.recorder.timed('{}.{}'.format(type(plugin).__name__,
+                                                method)):
+            return func(*args)
+
+    def _open(self, key, plugin):
+        container = FakeWidget()
+        self._call(plugin, 'build_gui', container)
+        self._call(plugin, 'start')
+        self.active.append(key)
+        return plugin
+
+    def start_local_plugin(self, chname, klass):
+        klass = load_plugin(klass, self.patches)
+        key = (chname, klass.__name__)
+        if key in self.active:
+            return self.local_plugins[key]
+        plugin = self.local_plugins.get(key, None)
+        if plugin is None:
+            fitsimage = self.channels[chname].fitsimage
+            with self.recorder.timed('{}.__init__'.format(klass.__name__)):
+                plugin = klass(self, fitsimage)
+            self.local_plugins[key] = plugin
+        return self._open(key, plugin)
+
+    def stop_local_plugin(self, chname, name):
+        """Stop a local plugin, by class name or by its ``str()``."""
+        for key in list(self.active):
+            if key[0] != chname or key[0] is None:
+                continue
+            plugin = self.local_plugins[key]
+            if name in (key[1], str(plugin)):
+                self.active.remove(key)
+                self._call(plugin, 'stop')
+
+    def start_global_plugin(self, klass):
+        klass = load_plugin(klass, self.patches)
+        key = (None, klass.__name__)
+        if key in self.active:
+            return self.global_plugins[key[1]]
+        plugin = self.global_plugins.get(key[1], None)
+        if plugin is None:
+            with self.recorder.timed('{}.__init__'.format(klass.__name__)):
+                plugin = klass(self)
+            self.global_plugins[key[1]] = plugin
+        return self._open(key, plugin)
+
+    def stop_global_plugin(self, name):
+        for key in list(self.active):
+            if key[0] is not None:
+                continue
+            plugin = self.global_plugins[key[1]]
+            if name in (key[1], str(plugin)):
+                self.active.remove(key)
+                self._call(plugin, 'stop')
+
+    def pause_plugin(self, chname, name):
+        self._call(self.local_plugins[(chname, name)], 'pause')
+
+    def resume_plugin(self, chname, name):
+        self._call(self.local_plugins[(chname, name)], 'resume')
+
+    def close(self):
+        for key in list(self.active):
+            if key[0] is None:
+                self.stop_global_plugin(key[1])
+            else:
+                self.stop_local_plugin(key[0], key[1])
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.patches.close()
+
+    def report(self):
+        return self.recorder.report()
+
+
+def main(argv=None):
+    """Open, exercise and close each plugin once and print the timings."""
+    from astropy.io import fits
+
+    bars = dict(zip(range(1, 93), np.tile([100.0, 110.0], 46)))
+    header = fits.Header()
+    for b in range(1, 93):
+        header['B{:02d}POS'.format(b)] = bars[b]
+    header['DATE-OBS'] = '2017-05-10'
+    data = np.random.default_rng(0).normal(100., 10., (2048, 2048))
+
+    h = Harness()
+    # keep the bar states recorded out of the user's bar store
+    tmpdir = tempfile.mkdtemp(prefix='csu_harness')
+    h.get_preferences().create_category('plugin_CSU_initializer').set(
+        bar_store=os.path.join(tmpdir, 'csu_store'))
+    h.start_global_plugin('MyGlobalPlugin')
+    h.add_channel('Image')
+    for name in ('MyLocalPlugin', 'MultiBars', 'CSU_initializer'):
+        h.start_local_plugin('Image', name)
+    image = AstroImage.AstroImage(data_np=data, logger=h.logger)
+    image.update_keywords(header)
+    h.load_image('Image', image, name='synthetic')
+
+    plugin = h.local_plugins[('Image', 'CSU_initializer')]
+    with h.recorder.timed('CSU_initializer.overlaybars_from_header'):
+        plugin.overlaybars_from_header()
+        h.wait_idle()
+    moved = dict(bars)
+    moved[5] += 1.0
+    with h.recorder.timed('CSU_initializer.overlaybars[1 moved]'):
+        plugin.overlaybars(moved)
+    plugin.w.clear.activate()
+
+    h.close()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    print(h.report())
+    return 1 if h.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#END
@@ -0,0 +1,151 @@
+"""Unit tests for csu_bars.py"""
+import os
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from plugins import csu_bars
+
+
+def make_state(offset=0.0, status=0):
+    pos = 100.0 + offset + np.arange(csu_bars.nbars) * 0.1
+    return csu_bars.BarState.from_arrays(
+        pos, status=np.full(csu_bars.nbars, status))
+
+def write_state_file(path, state):
+    with open(path, 'w') as out_f:
+        for b, pos, status in zip(state.bar, state.pos, state.status):
+            out_f.write('{:d},{:.3f},{:d}\n'.format(b, pos, status))
+
+def test_lru_cache():
+    cache = csu_bars.LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0
+
+def test_load_bar_state(tmp_path):
+    state = make_state()
+    header = fits.Header()
+    for b, pos in zip(state.bar, state.pos):
+        header['B{:02d}POS'.format(b)] = pos
+    loaded = csu_bars.load_bar_state(header)
+    assert loaded.kind == 'header'
+    assert np.array_equal(loaded.pos, state.pos)
+    assert not loaded.data.flags.writeable
+    assert csu_bars.load_bar_state(header) is loaded
+
+    filename = str(tmp_path / 'csu_bar_state')
+    write_state_file(filename, state)
+    loaded = csu_bars.load_bar_state(filename)
+    assert loaded.kind == 'csu_bar_state'
+    assert csu_bars.load_bar_state(filename) is loaded
+    # a rewritten file is read again
+    write_state_file(filename, make_state(offset=1.0))
+    os.utime(filename, ns=(0, os.stat(filename).st_mtime_ns + 1))
+    reloaded = csu_bars.load_bar_state(filename)
+    assert reloaded is not loaded
+    assert np.allclose(reloaded.pos, loaded.pos + 1.0)
+
+def test_from_dicts():
+    bars = {3: 130.0, 1: 110.0, 2: 120.0}
+    state = csu_bars.BarState.from_dicts(bars, state={1: 'OK', 2: 'MOVING'})
+    assert state.bar.tolist() == [1, 2, 3]
+    assert state.pos.tolist() == [110.0, 120.0, 130.0]
+    assert state.status_names().tolist() == ['OK', 'MOVING', 'UNKNOWN']
+    assert not state.is_complete()
+    assert state.as_dicts() == (
+        bars, {1: 'OK', 2: 'MOVING', 3: 'UNKNOWN'})
+    assert csu_bars.as_bar_state(state) is state
+
+def test_bytes_round_trip():
+    state = make_state()
+    copy = csu_bars.BarState.from_bytes(state.to_bytes())
+    assert copy.to_bytes() == state.to_bytes()
+    assert np.array_equal(copy.pos, state.pos)
+    assert not copy.data.flags.writeable
+
+def test_positions_of():
+    state = make_state()
+    assert state.positions_of([1, 92]).tolist() == [100.0, 100.0 + 9.1]
+    partial = csu_bars.BarState.from_dicts({1: 10.0, 3: 30.0})
+    with pytest.raises(KeyError):
+        partial.positions_of([2])
+
+def test_diff_and_digest():
+    state = make_state()
+    other = csu_bars.BarState(state.data.copy())
+    other.data['pos'][4] += 1.0
+    other.data['status'][7] = csu_bars.status_codes['MOVING']
+    moved, status_changed = other.diff(state)
+    assert np.nonzero(moved)[0].tolist() == [4]
+    assert np.nonzero(status_changed)[0].tolist() == [7]
+    assert all(np.all(mask) for mask in other.diff(None))
+
+    # the digest follows the positions only
+    assert other.position_digest() != state.position_digest()
+    other.data['pos'][4] -= 1.0
+    assert other.position_digest() == state.position_digest()
+
+def test_colors():
+    state = make_state()
+    state.data['status'][0] = csu_bars.status_codes['ERROR']
+    state.data['status'][1] = csu_bars.status_unknown
+    colors = state.colors({'OK': 'green', 'ERROR': 'red'}, 'white')
+    assert colors[:3].tolist() == ['red', 'white', 'green']
+
+def test_parse_csu_bar_state(tmp_path):
+    state = make_state()
+    state.data['status'][3] = csu_bars.status_codes['ERROR']
+    filename = str(tmp_path / 'csu_bar_state')
+    write_state_file(filename, state)
+    parsed = csu_bars.parse_csu_bar_state(filename)
+    assert parsed.kind == 'csu_bar_state'
+    assert np.array_equal(parsed.bar, state.bar)
+    assert np.allclose(parsed.pos, state.pos)
+    assert np.array_equal(parsed.status, state.status)
+
+    with open(filename, 'a') as out_f:
+        out_f.write('93,100.0,9\n')
+    with pytest.raises(ValueError):
+        csu_bars.parse_csu_bar_state(filename)
+    open(filename, 'w').close()
+    with pytest.raises(ValueError):
+        csu_bars.parse_csu_bar_state(filename)
+
+def test_history():
+    history = csu_bars.BarHistory(capacity=3)
+    assert history.append(make_state(0.0))
+    assert not history.append(make_state(0.0))
+    assert history.append(make_state(0.0, status=2))
+    for offset in (1.0, 2.0):
+        history.append(make_state(offset))
+    assert len(history) == 3
+    assert history[0].status[0] == 2
+    assert history[-1].pos[0] == 102.0
+    assert not history[-1].data.flags.writeable
+    with pytest.raises(IndexError):
+        history[3]
+    with pytest.raises(ValueError):
+        history.append(csu_bars.BarState.from_dicts({1: 10.0}))
+
+def test_history_copy():
+    history = csu_bars.BarHistory(capacity=3)
+    for offset in (0.0, 1.0):
+        history.append(make_state(offset))
+    assert history.dropped == 0
+    copy = history.copy()
+    for offset in (2.0, 3.0):
+        history.append(make_state(offset))
+    assert history.dropped == 1
+    assert len(copy) == 2 and copy.dropped == 0
+    assert copy[1].pos[0] == 101.0
+    # the same state, at its index in the later history
+    assert history[1 + copy.dropped - history.dropped].pos[0] == 101.0
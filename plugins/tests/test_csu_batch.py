@@ -0,0 +1,88 @@
+"""Unit tests for csu_batch.py"""
+import os
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from plugins import csu_batch, csu_store
+
+
+def write_frame(filename, date='2017-05-10T08:00:00', bars=True):
+    header = fits.Header()
+    if bars:
+        for b in range(1, 93):
+            header['B{:02d}POS'.format(b)] = 100.0 + b * 0.5
+    header['DATE-OBS'] = date
+    fits.PrimaryHDU(np.zeros((16, 16), dtype=np.float32),
+                    header=header).writeto(filename)
+
+@pytest.fixture
+def night(tmp_path):
+    path = tmp_path / 'night'
+    path.mkdir()
+    write_frame(str(path / 'm170510_0001.fits'))
+    write_frame(str(path / 'm170510_0002.fits'), bars=False)
+    return str(path)
+
+def options(outdir, **kwargs):
+    result = dict(calibration_store=None, epoch=None, ext=0, store=None,
+                  measure=False, method='fast', outdir=outdir, regions=False,
+                  png=False)
+    result.update(kwargs)
+    return result
+
+def test_find_frames(night):
+    frames = csu_batch.find_frames([night])
+    assert [os.path.basename(f) for f in frames] == ['m170510_0001.fits',
+                                                     'm170510_0002.fits']
+    assert csu_batch.find_frames([frames[1]]) == frames[1:]
+
+def test_process_frame(night, tmp_path):
+    outdir = str(tmp_path)
+    frames = csu_batch.find_frames([night])
+    summary = csu_batch.process_frame(frames[0],
+                                      options(outdir, regions=True))
+    assert summary['status'] == 'OK'
+    table = np.genfromtxt(os.path.join(outdir, 'm170510_0001_bars.csv'),
+                          delimiter=',', names=True)
+    assert len(table) == 92
+    assert table['bar'].tolist() == list(range(1, 93))
+    assert np.allclose(table['pos_mm'], 100.0 + table['bar'] * 0.5)
+    assert np.all(table['slit'] == (table['bar'] + 1) // 2)
+    assert os.path.exists(os.path.join(outdir, 'm170510_0001_bars.reg'))
+
+    # the opt-in four-point epoch is used when asked for
+    epoch_dir = str(tmp_path / 'epoch')
+    os.mkdir(epoch_dir)
+    summary = csu_batch.process_frame(
+        frames[0], options(epoch_dir, epoch='20170414'))
+    assert summary['status'] == 'OK'
+    other = np.genfromtxt(os.path.join(epoch_dir, 'm170510_0001_bars.csv'),
+                          delimiter=',', names=True)
+    assert not np.allclose(other['x_pix'], table['x_pix'])
+
+    summary = csu_batch.process_frame(frames[1], options(outdir))
+    assert summary['status'].startswith('SKIPPED')
+    summary = csu_batch.process_frame(frames[0],
+                                      options(outdir, method='magic',
+                                              measure=True))
+    assert summary['status'].startswith('ERROR')
+
+def test_main_stores_ok_frames(night, tmp_path):
+    outdir = str(tmp_path / 'qa')
+    store_path = str(tmp_path / 'store')
+    assert csu_batch.main([night, '-o', outdir, '-j', '1',
+                           '--store', store_path]) == 0
+    assert sorted(os.listdir(outdir)) == ['m170510_0001_bars.csv']
+    store = csu_store.get_store(store_path)
+    store.refresh()
+    assert len(store.times) == 1
+    assert np.allclose(store.latest().pos, 100.0 + np.arange(1, 93) * 0.5)
+
+    # the frames are too small to measure: errors, and nothing stored
+    store_path = str(tmp_path / 'store2')
+    assert csu_batch.main([night, '-o', outdir, '-j', '1', '--measure',
+                           '--store', store_path]) == 1
+    assert len(csu_store.get_store(store_path).times) == 0
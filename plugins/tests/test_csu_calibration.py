@@ -0,0 +1,89 @@
+"""Unit tests for csu_calibration.py"""
+import shutil
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from plugins import csu_calibration, csu_transforms
+
+
+@pytest.fixture
+def store(tmp_path):
+    """A private copy of the packaged store, safe to add epochs to."""
+    path = str(tmp_path / 'csu_calibration')
+    shutil.copytree(csu_calibration.default_path, path)
+    return csu_calibration.CalibrationStore(path)
+
+def test_header_date():
+    header = fits.Header()
+    assert csu_calibration.header_date(header) is None
+    header['MJD-OBS'] = 57875.5
+    assert csu_calibration.header_date(header) == '2017-05-02'
+    header['DATE'] = '2017-04-30T10:00:00'
+    assert csu_calibration.header_date(header) == '2017-04-30'
+    header['DATE-OBS'] = '2017-04-20'
+    assert csu_calibration.header_date(header) == '2017-04-20'
+
+def test_epoch_for_date(store):
+    assert store.get_names() == ['20170414', '20170502']
+    # the four-point epoch is opt-in and never chosen by date
+    for date, name in [('2000-01-01', '20170502'),
+                       ('2017-05-01', '20170502'),
+                       ('2017-05-02', '20170502'),
+                       ('2030-01-01', '20170502')]:
+        assert store.epoch_for_date(date).name == name
+
+def test_epoch_for_header(store):
+    assert store.epoch_for_header(None).name == '20170502'
+    header = fits.Header()
+    assert store.epoch_for_header(header).name == '20170502'
+    header['DATE-OBS'] = '2017-04-20'
+    assert store.epoch_for_header(header).name == '20170502'
+    assert store.transforms_for_header(header).epoch == '20170502'
+    # but can still be asked for by name
+    assert store.get_transforms('20170414').epoch == '20170414'
+
+def test_opt_in_epoch(store):
+    points = store.get_points('20170502')
+    store.add_epoch('20180101', points[:,0:2], points[:,2:4],
+                    start='2018-01-01', opt_in=True)
+    assert store.latest_epoch().name == '20170502'
+    assert store.epoch_for_date('2018-03-01').name == '20170502'
+    reread = csu_calibration.CalibrationStore(store.path)
+    assert reread.epoch_for_date('2018-03-01').name == '20170502'
+    assert reread.get_transforms('20180101').epoch == '20180101'
+
+def test_gap_falls_back_to_latest(store):
+    points = store.get_points('20170502')
+    store.add_epoch('20180101', points[:,0:2], points[:,2:4],
+                    start='2018-01-01', end='2018-06-01')
+    assert store.epoch_for_date('2018-03-01').name == '20180101'
+    assert store.epoch_for_date('2018-06-01') is None
+    header = fits.Header()
+    header['DATE-OBS'] = '2018-07-01'
+    assert store.epoch_for_header(header).name == '20180101'
+
+def test_add_epoch(store):
+    points = np.array(store.get_points('20170502'))
+    store.add_epoch('20171001', points[:,0:2], points[:,2:4],
+                    start='2017-10-01', comment='refit')
+    assert store.get_names() == ['20170414', '20170502', '20171001']
+    assert store.epoch_for_date('2017-09-30').name == '20170502'
+    assert store.epoch_for_date('2017-10-01').name == '20171001'
+    with pytest.raises(ValueError):
+        store.add_epoch('20171001', points[:,0:2], points[:,2:4])
+
+    # the index on disk is read back the same by a new store
+    reread = csu_calibration.CalibrationStore(store.path)
+    assert reread.get_names() == store.get_names()
+    expected = csu_transforms.fit_all(points[:,0:2], points[:,2:4])
+    transforms = reread.get_transforms('20171001')
+    assert transforms.epoch == '20171001'
+    assert np.allclose(transforms.Apixel_to_physical,
+                       expected.Apixel_to_physical)
+    assert np.allclose(transforms.Aphysical_to_pixel,
+                       expected.Aphysical_to_pixel)
+    assert not transforms.Apixel_to_physical.flags.writeable
+    assert reread.get_transforms('20171001') is transforms
@@ -0,0 +1,117 @@
+"""Unit tests for csu_control.py"""
+import socket
+import asyncio
+
+import numpy as np
+import pytest
+
+from plugins import csu_control
+
+
+def test_parse_bars():
+    assert csu_control.parse_bars('5') == [5]
+    assert csu_control.parse_bars('1-3, 9') == [1, 2, 3, 9]
+    assert csu_control.parse_bars('all') == list(range(1, 93))
+    for text in ('0', '93', '', 'nan', '1-x'):
+        with pytest.raises(ValueError):
+            csu_control.parse_bars(text)
+
+def test_parse_pairs_rejects_nan():
+    assert csu_control._parse_pairs(['1-2=130']) == {1: 130.0, 2: 130.0}
+    for item in ('5=nan', '5=inf'):
+        with pytest.raises(csu_control.CSUError):
+            csu_control._parse_pairs([item])
+
+@pytest.fixture
+def mock_csu():
+    server = csu_control.MockCSUServer(speed=1000.0)
+    server.start()
+    yield server
+    server.stop()
+
+def send_line(port, line):
+    with socket.create_connection((csu_control.default_host, port),
+                                  timeout=5.0) as sock:
+        sock.sendall((line + '\n').encode())
+        return sock.makefile().readline().split()
+
+def test_mock_rejects_nan_targets(mock_csu):
+    for line in ('1 STEP 5 nan', '2 MOVE 5 nan', '3 MOVE 5 inf',
+                 '4 MOVE 5 300'):
+        reply = send_line(mock_csu.port, line)
+        assert reply[1] == 'ERROR', line
+    # the bar was never set moving
+    reply = send_line(mock_csu.port, '5 MOVE 5 120')
+    assert reply[1] == 'OK'
+    assert float(reply[3]) == pytest.approx(120.0)
+
+def test_controller(mock_csu):
+    controller = csu_control.CSUController(port=mock_csu.port, timeout=10.0)
+    controller.start()
+    try:
+        state = controller.move({3: 100.0, 4: 110.0}).result(10.0)
+        assert np.allclose(state.positions_of([3, 4]), [100.0, 110.0])
+        state = controller.step({3: -1.5}).result(10.0)
+        assert state.positions_of([3])[0] == pytest.approx(98.5)
+        with pytest.raises(csu_control.CSUError):
+            controller.step({3: np.nan}).result(10.0)
+    finally:
+        controller.stop()
+
+async def hangup_server(replies):
+    """A server that answers ``replies`` requests on a connection, then
+    hangs up.  Returns the server and the list of connections made."""
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        for i in range(replies):
+            req_id = (await reader.readline()).split()[0].decode()
+            writer.write('{} OK 5 120.000 0\n'.format(req_id).encode())
+            await writer.drain()
+        if replies == 0:
+            await reader.readline()
+        writer.close()
+
+    server = await asyncio.start_server(handle, csu_control.default_host, 0)
+    return server, connections
+
+async def wait_disconnected(client):
+    for i in range(100):
+        if not client.is_connected():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("client still connected after the hangup")
+
+def test_client_reconnects_after_hangup():
+    async def run():
+        server, connections = await hangup_server(1)
+        port = server.sockets[0].getsockname()[1]
+        client = csu_control.CSUClient(port=port, timeout=30.0)
+        try:
+            for i in range(3):
+                state = await asyncio.wait_for(client.status(), 5.0)
+                assert state.positions_of([5])[0] == pytest.approx(120.0)
+                await wait_disconnected(client)
+            assert len(connections) == 3
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+    asyncio.run(run())
+
+def test_client_fails_requests_on_hangup():
+    async def run():
+        server, connections = await hangup_server(0)
+        port = server.sockets[0].getsockname()[1]
+        client = csu_control.CSUClient(port=port, timeout=30.0)
+        try:
+            # fails when the server hangs up, not at the timeout
+            with pytest.raises(csu_control.CSUError, match='closed'):
+                await asyncio.wait_for(client.status(), 5.0)
+            await wait_disconnected(client)
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+    asyncio.run(run())
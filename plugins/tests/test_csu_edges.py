@@ -0,0 +1,97 @@
+"""Unit tests for csu_edges.py"""
+import concurrent.futures
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from plugins import csu_edges
+
+
+def synthetic_frame(seed, noise=20.):
+    # an open slit in every band, with known edges, blurred and noisy
+    rng = np.random.default_rng(seed)
+    bands = csu_edges.slit_bands()
+    centers = rng.uniform(400, 1648, len(bands))
+    widths = rng.uniform(4, 12, len(bands))
+    truth = np.column_stack([centers - widths/2, centers + widths/2])
+    lo = np.arange(2048)
+    data = np.zeros((2048, 2048))
+    for (y1, y2), (x1, x2) in zip(bands, truth):
+        data[y1:y2] = 2000. * np.clip(np.minimum(lo + 1, x2) -
+                                      np.maximum(lo, x1), 0., 1.)
+    data = ndimage.gaussian_filter(data, (0, 1.2))
+    data += rng.normal(0, noise, data.shape)
+    # pixel i covers [i, i+1), so its center is at i + 0.5
+    return data.astype(np.float32), truth - 0.5
+
+def test_parabolic_errors_cover_truth():
+    resid, err = [], []
+    for seed in (101, 102, 103):
+        data, truth = synthetic_frame(seed)
+        edges = csu_edges.measure_edges(data, method='fast')
+        ok = edges.valid
+        assert np.sum(ok) >= 40
+        resid.append(np.concatenate([edges.x1[ok] - truth[ok,0],
+                                     edges.x2[ok] - truth[ok,1]]))
+        err.append(np.concatenate([edges.x1_err[ok], edges.x2_err[ok]]))
+    resid, err = np.concatenate(resid), np.concatenate(err)
+
+    z = resid / err
+    # 1-sigma errors: residuals of about one sigma rms, and not much
+    # larger either
+    assert 0.6 < np.sqrt(np.mean(z**2)) < 1.4
+    assert np.mean(np.abs(z) <= 1.) >= 0.68
+
+def test_parabolic_statistical_error_only():
+    data, truth = synthetic_frame(101)
+    stack = csu_edges.extract_bands(data, csu_edges.slit_bands())
+    profiles, noise = csu_edges.band_profiles(stack, return_noise=True)
+    x1, x2, x1_err, x2_err, valid = csu_edges.fit_edges_parabolic(
+        profiles, noise=noise, interp_error=0.)
+    full = csu_edges.fit_edges_parabolic(profiles, noise=noise)
+    assert np.array_equal(valid, full[4])
+    assert np.all(x1_err[valid] < full[2][valid])
+    assert np.allclose(full[2][valid], np.hypot(x1_err[valid], 0.1))
+
+def test_parabolic_invalid_profile():
+    profiles = np.zeros((2, 50))
+    profiles[0, 20:23] = [100., 500., 200.]
+    profiles[0, 30:33] = [-100., -500., -200.]
+    x1, x2, x1_err, x2_err, valid = csu_edges.fit_edges_parabolic(profiles)
+    assert valid.tolist() == [True, False]
+    assert 20.5 < x1[0] < 21.5 and 30.5 < x2[0] < 31.5
+    assert np.isnan(x1_err[1]) and x1[1] == 0.
+
+def test_accurate_edges():
+    data, truth = synthetic_frame(101)
+    edges = csu_edges.measure_edges(data, method='accurate')
+    ok = edges.valid
+    assert np.sum(ok) >= 40
+    assert np.all(np.abs(edges.x1[ok] - truth[ok,0]) < 0.75)
+    assert np.all(np.abs(edges.x2[ok] - truth[ok,1]) < 0.75)
+    assert np.all(np.isfinite(edges.x1_err[ok]))
+    assert len(edges.bands) == csu_edges.nslits
+
+def assert_same_edges(a, b):
+    for key in ('x1', 'x2', 'x1_err', 'x2_err', 'valid'):
+        assert np.array_equal(a[key], b[key], equal_nan=True)
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_parallel_edges(executor):
+    data, truth = synthetic_frame(102)
+    serial = csu_edges.measure_edges(data, method='fast')
+    parallel = csu_edges.measure_edges(data, method='fast', workers=3,
+                                       executor=executor)
+    assert_same_edges(parallel, serial)
+
+def test_parallel_edges_existing_pool():
+    data, truth = synthetic_frame(102)
+    serial = csu_edges.measure_edges(data, method='fast')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        assert_same_edges(csu_edges.measure_edges(
+            data, method='fast', workers=5, executor=pool), serial)
+        # still usable afterwards
+        assert pool.submit(int, 1).result() == 1
+    with pytest.raises(ValueError):
+        csu_edges.measure_edges(data, workers=2, executor='cluster')
@@ -0,0 +1,38 @@
+"""Unit tests for csu_fitsio.py"""
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from plugins import csu_edges, csu_fitsio
+from plugins.tests.test_csu_edges import synthetic_frame
+
+
+@pytest.fixture
+def frame(tmp_path):
+    data, truth = synthetic_frame(103)
+    # stored as scaled unsigned integers, as the detector writes them
+    counts = np.clip(np.round(data + 1000.), 0, 65535).astype(np.uint16)
+    filename = str(tmp_path / 'mask.fits')
+    header = fits.Header()
+    header['DATE-OBS'] = '2017-05-02'
+    fits.PrimaryHDU(counts, header=header).writeto(filename)
+    return filename, counts.astype(np.float32)
+
+def test_read_bands(frame):
+    filename, data = frame
+    bands = csu_edges.slit_bands()
+    stack, header = csu_fitsio.read_bands(filename)
+    assert header['DATE-OBS'] == '2017-05-02'
+    assert stack.dtype == np.float32
+    assert np.array_equal(stack, csu_edges.extract_bands(data, bands))
+
+def test_measure_file(frame):
+    filename, data = frame
+    expected = csu_edges.measure_edges(data, method='fast')
+    for workers in (None, 3):
+        edges, header = csu_fitsio.measure_file(
+            filename, method='fast', workers=workers, executor='thread')
+        assert header['DATE-OBS'] == '2017-05-02'
+        for key in ('x1', 'x2', 'x1_err', 'x2_err', 'valid'):
+            assert np.array_equal(edges[key], expected[key], equal_nan=True)
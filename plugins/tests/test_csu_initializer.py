@@ -0,0 +1,220 @@
+"""Tests of the CSU_initializer overlay, run in the plugin harness"""
+import numpy as np
+import pytest
+
+from ginga import AstroImage
+from astropy.io import fits
+
+from plugins import csu_bars, csu_store, csu_transforms
+from plugins.tests.harness import Harness
+from plugins.tests.test_csu_edges import synthetic_frame
+
+
+def make_bars(offset=0.0):
+    return dict(zip(range(1, 93), np.tile([100.0, 110.0], 46) + offset))
+
+@pytest.fixture
+def harness(tmp_path):
+    h = Harness()
+    # keep the bar states recorded out of the user's bar store
+    h.get_preferences().create_category('plugin_CSU_initializer').set(
+        bar_store=str(tmp_path / 'csu_store'))
+    h.add_channel('Image', 1024, 1024)
+    h.load_image('Image', np.zeros((2048, 2048)))
+    yield h
+    h.close()
+    assert h.errors == []
+
+@pytest.fixture
+def plugin(harness):
+    plugin = harness.start_local_plugin('Image', 'CSU_initializer')
+    harness.fire_timers()
+    harness.recorder.reset()
+    return plugin
+
+def test_overlay_is_one_add_and_one_redraw(harness, plugin):
+    plugin.overlaybars(make_bars())
+    assert harness.recorder.counts == {'add': 1, 'redraw': 1}
+    assert plugin.lod_mode == 'vector'
+    assert len(plugin.bar_objs) == 2 * 92
+
+def test_one_bar_move_is_one_update(harness, plugin):
+    plugin.overlaybars(make_bars())
+    polygon = plugin.bar_objs['bar05']
+    before = np.array(polygon.points, dtype=float)
+    harness.recorder.reset()
+
+    bars = make_bars()
+    bars[5] += 1.0
+    plugin.overlaybars(bars)
+    assert harness.recorder.counts == {'redraw': 1}
+    # the same object, moved in place
+    assert plugin.bar_objs['bar05'] is polygon
+    assert not np.allclose(np.array(polygon.points, dtype=float), before)
+
+    # drawing the same bars again does nothing
+    harness.recorder.reset()
+    plugin.overlaybars(bars)
+    assert harness.recorder.counts == {}
+
+def header_image(bars, date='2017-05-10'):
+    header = fits.Header()
+    for b in sorted(bars.keys()):
+        header['B{:02d}POS'.format(b)] = bars[b]
+    header['DATE-OBS'] = date
+    image = AstroImage.AstroImage(data_np=np.zeros((2048, 2048)))
+    image.update_keywords(header)
+    return image
+
+def test_header_overlay_job(harness, plugin):
+    harness.load_image('Image', header_image(make_bars()))
+    harness.recorder.reset()
+    plugin.overlaybars_from_header()
+    # the first job is stale once the second starts, and is not drawn
+    plugin.overlaybars_from_header()
+    assert harness.wait_idle()
+    assert harness.recorder.counts == {'add': 1, 'redraw': 1}
+    assert plugin.transforms.epoch == '20170502'
+    assert np.array_equal(plugin.bar_state.pos, np.tile([100.0, 110.0], 46))
+
+def test_calibration_epoch_setting(harness, plugin):
+    plugin.settings.set(calibration_epoch='20170414')
+    harness.load_image('Image', header_image(make_bars()))
+    plugin.overlaybars_from_header()
+    assert harness.wait_idle()
+    assert plugin.transforms.epoch == '20170414'
+
+def test_header_overlay_job_error(harness, plugin):
+    plugin.overlaybars_from_header()
+    assert harness.wait_idle()
+    assert harness.recorder.counts == {}
+    assert len(harness.errors) == 1
+    assert 'missing keyword' in harness.errors.pop()
+
+def test_lod_switch(harness, plugin):
+    lod_scale = plugin.settings.get('lod_scale', 0.5)
+    assert plugin.lod_for_scale(lod_scale) == 'vector'
+    assert plugin.lod_for_scale(lod_scale * 0.99) == 'raster'
+    assert plugin.lod_for_scale((lod_scale * 0.5, lod_scale)) == 'vector'
+
+    viewer = plugin.fitsimage
+    plugin.overlaybars(make_bars())
+    viewer.scale_to(lod_scale / 2, lod_scale / 2)
+    assert plugin.lod_mode == 'raster'
+    assert plugin.bar_compound is None
+    assert plugin.canvas.has_tag('bars-raster')
+    assert not plugin.canvas.has_tag('bars')
+    assert plugin.bar_raster.get_image().get_data().shape == (512, 512, 4)
+
+    # in raster mode a move redraws the one image
+    harness.recorder.reset()
+    bars = make_bars()
+    bars[5] += 1.0
+    plugin.overlaybars(bars)
+    assert harness.recorder.counts == {'redraw': 1}
+
+    viewer.scale_to(lod_scale, lod_scale)
+    assert plugin.lod_mode == 'vector'
+    assert plugin.bar_raster is None
+    assert plugin.canvas.has_tag('bars')
+    assert not plugin.canvas.has_tag('bars-raster')
+
+def expected_visible(plugin):
+    """The bars the overlay should keep, by brute force over the polygons."""
+    x1, y1, x2, y2 = plugin.fitsimage.get_datarect()
+    margin = plugin.settings.get('cull_margin', 0.1) * max(x2 - x1, y2 - y1)
+    barnos, polygons, labels = csu_transforms.bar_geometry(
+        plugin.get_transforms(), plugin.bar_state)
+    lo, hi = polygons.min(axis=1), polygons.max(axis=1)
+    return ((hi[:,0] >= x1 - margin) & (lo[:,0] <= x2 + margin) &
+            (hi[:,1] >= y1 - margin) & (lo[:,1] <= y2 + margin))
+
+def test_cull_on_pan(harness, plugin):
+    viewer = plugin.fitsimage
+    viewer.scale_to(4.0, 4.0)
+    viewer.set_pan(1024, 1024)
+    harness.fire_timers()
+    plugin.overlaybars(make_bars())
+    visible = plugin.bar_visible.copy()
+    assert 0 < np.sum(visible) < 92
+    assert np.array_equal(visible, expected_visible(plugin))
+    assert len(plugin.bar_compound.objects) == 2 * np.sum(visible)
+
+    # a burst of pans is culled once, when the timer runs out
+    harness.recorder.reset()
+    for i in range(50):
+        viewer.set_pan(1024, 1024 + i * 10)
+    assert harness.recorder.counts == {}
+    assert np.array_equal(plugin.bar_visible, visible)
+    harness.fire_timers()
+    assert harness.recorder.counts == {'redraw': 1}
+    assert not np.array_equal(plugin.bar_visible, visible)
+    assert np.array_equal(plugin.bar_visible, expected_visible(plugin))
+
+    # a pan that shows the same bars does not redraw
+    harness.recorder.reset()
+    viewer.set_pan(1024.5, 1024 + 49 * 10)
+    harness.fire_timers()
+    assert harness.recorder.counts == {}
+
+def test_analysis_runs_off_the_gui_thread(harness, plugin):
+    data, truth = synthetic_frame(101)
+    harness.load_image('Image', data)
+    harness.recorder.reset()
+    plugin.analyze_mask_image()
+    # the first analysis is stale once the second starts
+    plugin.analyze_mask_image()
+    assert plugin.measured is None
+    assert harness.wait_idle()
+    assert harness.recorder.counts == {'add': 1, 'redraw': 1}
+    assert plugin.canvas.has_tag('measured-edges')
+    assert np.sum(plugin.measured.valid) > 0
+
+def test_records_settled_states_when_asked(harness, plugin, tmp_path):
+    pos = np.tile([100.0, 110.0], 46)
+    store = csu_store.get_store(str(tmp_path / 'csu_store'))
+
+    def record(offset, status, obstime):
+        plugin.record_bar_state(csu_bars.BarState.from_arrays(
+            pos + offset, status=np.full(92, status)), obstime=obstime)
+        assert harness.wait_idle()
+        store.refresh()
+
+    # nothing is written unless record_bar_states is set
+    record(1.0, 0, 1.5e9)
+    assert len(store.times) == 0
+
+    # and then only states with no bar moving
+    plugin.settings.set(record_bar_states=True)
+    record(2.0, csu_bars.status_codes['MOVING'], 1.5e9 + 1)
+    record(3.0, csu_bars.status_codes['OK'], 1.5e9 + 2)
+    assert store.times.tolist() == [1.5e9 + 2]
+    assert len(plugin.history) == 3
+
+def test_playback_is_not_shifted_by_new_states(harness, plugin):
+    plugin.history = csu_bars.BarHistory(capacity=3)
+    states = [csu_bars.BarState.from_arrays(np.tile([100.0, 110.0], 46) + i)
+              for i in range(5)]
+    for state in states[:3]:
+        plugin.record_bar_state(state)
+    plugin.play_history()
+    assert plugin.bar_state.pos[0] == states[0].pos[0]
+
+    # a state recorded while playing drops the oldest from the history,
+    # but playback goes on through the states it started with
+    plugin.record_bar_state(states[3])
+    harness.fire_timers()
+    assert plugin.bar_state.pos[0] == states[1].pos[0]
+    plugin.pause_history()
+    assert plugin.history[plugin.history_index].pos[0] == states[1].pos[0]
+
+    # a timer that fires after playback stopped does nothing
+    plugin.follow_latest()
+    plugin.history_timer_cb(plugin.history_timer)
+    plugin.play_history()
+    plugin.record_bar_state(states[4])
+    while plugin.history_timer.is_set():
+        harness.fire_timers()
+    assert plugin.bar_state.pos[0] == states[3].pos[0]
+    assert plugin.history_index == 1
+    assert plugin.playback is None
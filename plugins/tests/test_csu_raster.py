@@ -0,0 +1,75 @@
+"""Unit tests for csu_raster.py"""
+import numpy as np
+import pytest
+
+from plugins import csu_bars, csu_calibration, csu_raster
+
+
+def random_quads(rng, n, shape):
+    """Rotated rectangles, half of them wound each way, some off the edge."""
+    center = rng.uniform(-20, max(shape) + 20, (n, 1, 2))
+    half = rng.uniform(1, 30, (n, 1, 2))
+    angle = rng.uniform(0, np.pi, (n, 1))
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * half
+    c, s = np.cos(angle), np.sin(angle)
+    quads = center + np.stack([c * corners[:,:,0] - s * corners[:,:,1],
+                               s * corners[:,:,0] + c * corners[:,:,1]],
+                              axis=-1)
+    quads[::2] = quads[::2, ::-1]
+    return quads
+
+def brute_force_labels(polygons, shape, step):
+    """Test every cell center against the edges of every polygon."""
+    rows, cols = csu_raster.raster_shape(shape, step)
+    y, x = np.meshgrid(csu_raster.cell_centers(rows, step),
+                       csu_raster.cell_centers(cols, step), indexing='ij')
+    labels = np.zeros((rows, cols), dtype=np.uint8)
+    for i, poly in enumerate(polygons):
+        cross = []
+        for (x0, y0), (x1, y1) in zip(poly, np.roll(poly, -1, axis=0)):
+            cross.append((x1 - x0) * (y - y0) - (y1 - y0) * (x - x0))
+        cross = np.array(cross)
+        inside = np.all(cross >= 0, axis=0) | np.all(cross <= 0, axis=0)
+        labels[inside] = i + 1
+    return labels
+
+@pytest.mark.parametrize('step', [1, 3, 4])
+def test_coverage_labels(step):
+    rng = np.random.default_rng(step)
+    shape = (200, 150)
+    polygons = random_quads(rng, 60, shape)
+    labels = csu_raster.coverage_labels(polygons, shape, step=step)
+    assert labels.shape == csu_raster.raster_shape(shape, step)
+    assert np.array_equal(labels, brute_force_labels(polygons, shape, step))
+
+def test_coverage_labels_overlap():
+    square = np.array([[0., 0.], [10., 0.], [10., 10.], [0., 10.]])
+    polygons = np.array([square, square + 5, square + [20., 0.]])
+    labels = csu_raster.coverage_labels(polygons, (20, 40), step=1)
+    assert labels[2, 2] == 1
+    assert labels[7, 7] == 2
+    assert labels[12, 12] == 2
+    assert labels[5, 25] == 3
+    assert labels[18, 2] == 0
+    # the later polygon wins whichever of them starts its run first
+    labels = csu_raster.coverage_labels(polygons[::-1], (20, 40), step=1)
+    assert labels[7, 7] == 3
+    assert labels[12, 12] == 2
+
+def test_coverage_mask():
+    transforms = csu_calibration.get_store().get_transforms('20170502')
+    bars = csu_bars.BarState.from_arrays(np.tile([100.0, 110.0], 46))
+    csu_raster.coverage_cache.clear()
+    mask = csu_raster.coverage_mask(transforms, bars, step=4)
+    assert mask.shape == (512, 512)
+    assert not mask.flags.writeable
+    assert set(np.unique(mask)) == set(range(0, 93))
+    assert csu_raster.coverage_mask(transforms, bars, step=4) is mask
+
+    slits = csu_raster.coverage_mask(transforms, bars, step=4, by='slit')
+    covered = mask > 0
+    assert np.array_equal(slits[covered], (mask[covered] + 1) // 2)
+    assert np.all(slits[~covered] == 0)
+
+    with pytest.raises(ValueError):
+        csu_raster.coverage_mask(transforms, bars, by='pixel')
@@ -0,0 +1,110 @@
+"""Unit tests for csu_store.py"""
+import os
+import datetime
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from plugins import csu_bars, csu_store
+
+
+def make_state(offset=0.0, t=None):
+    pos = 100.0 + offset + np.arange(csu_bars.nbars) * 0.1
+    return csu_bars.BarState.from_arrays(pos, status=np.zeros(csu_bars.nbars),
+                                         time=t)
+
+def test_as_time():
+    assert csu_store.as_time(1.5e9) == 1.5e9
+    t = datetime.datetime(2017, 5, 2, 12, 0, 0)
+    expected = 1493726400.0
+    assert csu_store.as_time(t) == expected
+    assert csu_store.as_time('2017-05-02T12:00:00') == expected
+    assert csu_store.as_time(datetime.date(2017, 5, 2)) == expected - 43200.
+
+def test_header_time():
+    header = fits.Header()
+    assert csu_store.header_time(header) is None
+    header['DATE-OBS'] = '2017-05-02'
+    header['UTC'] = '12:00:00.0'
+    assert csu_store.header_time(header) == pytest.approx(1493726400.0)
+    header['MJD-OBS'] = 57875.5
+    assert csu_store.header_time(header) == pytest.approx(1493726400.0)
+
+def test_append_and_query(tmp_path):
+    store = csu_store.BarStore(str(tmp_path / 'store'))
+    assert len(store) == 0 and store.latest() is None
+    for i in range(5):
+        assert store.append(make_state(i), obstime=1000.0 + i)
+    # the same state at the same time is only stored once
+    assert not store.append(make_state(4), obstime=1004.0)
+    assert len(store) == 5
+
+    res = store.query(1001.0, 1003.0, bars=[1, 92])
+    assert res.time.tolist() == [1001.0, 1002.0]
+    assert res.pos.shape == (2, 2)
+    assert res.pos[:,0].tolist() == [101.0, 102.0]
+
+    t, pos, status = store.bar_series(2, start=1003.0)
+    assert t.tolist() == [1003.0, 1004.0]
+    assert np.allclose(pos, [103.1, 104.1])
+    assert store.latest().pos[0] == 104.0
+
+    # another reader sees the same samples
+    other = csu_store.BarStore(store.path)
+    assert len(other) == 5
+    assert np.array_equal(other.get_state(2).pos, make_state(2).pos)
+
+def test_out_of_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(csu_store, 'order_save_min', 10)
+    path = str(tmp_path / 'store')
+    store = csu_store.BarStore(path)
+    rng = np.random.default_rng(0)
+    times = 1000.0 + np.arange(50.)
+    times[10] = 5.0
+    store.extend(times, np.zeros((50, csu_bars.nbars)), unique=False)
+    assert store.query(end=100.0).time.tolist() == [5.0]
+
+    # later samples are merged into the sort order
+    more = rng.uniform(0, 2000, 30)
+    more[3] = more[4]
+    for t in more:
+        store.extend([t], np.ones((1, csu_bars.nbars)), unique=False)
+        res = store.query()
+        assert np.all(np.diff(res.time) >= 0)
+    all_times = np.asarray(store.times)
+    sorted_time, order = store._time_index()
+    assert np.array_equal(order, np.argsort(all_times, kind='stable'))
+    assert store.latest().time.max() == all_times.max()
+
+    # a new reader starts from the saved order and merges the rest
+    assert os.path.exists(os.path.join(path, 'order.npy'))
+    other = csu_store.BarStore(path)
+    other.refresh()
+    assert np.array_equal(other._time_index()[1], order)
+    start, end = 500.0, 1500.0
+    sel = (all_times >= start) & (all_times < end)
+    assert np.array_equal(other.query(start, end).time,
+                          np.sort(all_times[sel]))
+
+def test_torn_write(tmp_path):
+    path = str(tmp_path / 'store')
+    store = csu_store.BarStore(path)
+    store.append(make_state(0), obstime=1.0)
+    # a writer that died after the positions, before the time
+    with open(os.path.join(path, 'pos.f8'), 'ab') as out_f:
+        out_f.write(np.zeros(csu_bars.nbars).tobytes())
+    assert len(csu_store.BarStore(path)) == 1
+    store.append(make_state(1), obstime=2.0)
+    assert len(store) == 2
+    assert store.get_state(1).pos[0] == 101.0
+    assert os.path.getsize(os.path.join(path, 'pos.f8')) == \
+           2 * csu_bars.nbars * 8
+
+def test_rejects_bad_samples(tmp_path):
+    store = csu_store.BarStore(str(tmp_path / 'store'))
+    with pytest.raises(ValueError):
+        store.extend([np.nan], np.zeros((1, csu_bars.nbars)))
+    with pytest.raises(ValueError):
+        store.extend([1.0, 2.0], np.zeros((1, csu_bars.nbars)))
@@ -0,0 +1,58 @@
+"""Unit tests for csu_transforms.py"""
+import shutil
+
+import numpy as np
+
+from plugins import csu_bars, csu_calibration, csu_transforms
+
+
+def make_state(offset=0.0):
+    return csu_bars.BarState.from_arrays(np.tile([100.0, 110.0], 46) + offset)
+
+def test_cached_bar_geometry(tmp_path):
+    transforms = csu_calibration.get_store().get_transforms('20170502')
+    bars = make_state()
+    csu_transforms.geometry_cache.clear()
+    geometry = csu_transforms.cached_bar_geometry(transforms, bars)
+    for arr, expected in zip(geometry, csu_transforms.bar_geometry(
+            transforms, bars)):
+        assert np.array_equal(arr, expected)
+        assert not arr.flags.writeable
+
+    # another state with the same positions, and the same transforms
+    # loaded by another store, share the entry
+    path = str(tmp_path / 'csu_calibration')
+    shutil.copytree(csu_calibration.default_path, path)
+    other = csu_calibration.CalibrationStore(path).get_transforms('20170502')
+    assert other is not transforms
+    same = csu_bars.BarState(bars.data.copy())
+    assert csu_transforms.cached_bar_geometry(other, same) is geometry
+
+    assert csu_transforms.cached_bar_geometry(
+        transforms, make_state(1.0)) is not geometry
+    assert csu_transforms.cached_bar_geometry(
+        transforms, bars, draw_height=0.3) is not geometry
+    assert csu_transforms.cached_bar_geometry(
+        csu_calibration.get_store().get_transforms('20170414'),
+        bars) is not geometry
+
+def test_box_index():
+    rng = np.random.default_rng(24)
+    lo = rng.uniform(0, 1000, (200, 2))
+    bounds = np.hstack([lo, lo + rng.uniform(1, 80, (200, 2))])
+    index = csu_transforms.BoxIndex(bounds)
+    assert len(index) == 200
+    for x1, y1 in rng.uniform(-100, 1000, (50, 2)):
+        x2, y2 = x1 + 150, y1 + 100
+        expected = ((bounds[:,0] <= x2) & (bounds[:,2] >= x1) &
+                    (bounds[:,1] <= y2) & (bounds[:,3] >= y1))
+        assert np.array_equal(index.query(x1, y1, x2, y2), expected)
+    assert not np.any(index.query(2000, 2000, 2100, 2100))
+
+def test_cached_bar_index():
+    transforms = csu_calibration.get_store().get_transforms('20170502')
+    bars = make_state()
+    index = csu_transforms.cached_bar_index(transforms, bars)
+    assert csu_transforms.cached_bar_index(transforms, bars) is index
+    assert len(index) == csu_bars.nbars
+    assert np.all(index.query(-1e4, -1e4, 1e4, 1e4))
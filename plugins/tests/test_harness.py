@@ -0,0 +1,38 @@
+"""Tests of the plugin harness itself"""
+import sys
+
+import ginga.gw.GwHelp as GwHelp
+from ginga.gw import Widgets
+
+from plugins.tests import harness
+
+
+def test_patched():
+    class Target(object):
+        value = 1
+
+    with harness.patched(Target, 'value', 2):
+        assert Target.value == 2
+    assert Target.value == 1
+    with harness.patched(Target, 'other', 3):
+        assert Target.other == 3
+    assert not hasattr(Target, 'other')
+
+def test_close_undoes_the_fakes():
+    had_file_selection = hasattr(GwHelp, 'FileSelection')
+    with harness.Harness() as h:
+        h.add_channel('Image')
+        plugin = h.start_local_plugin('Image', 'MultiBars')
+        module = sys.modules[type(plugin).__module__]
+        assert module.Widgets is harness.fake_widgets
+        assert module.FileSelection is harness.FakeFileSelection
+        # a second start does not patch again
+        h.stop_local_plugin('Image', 'MultiBars')
+        h.start_local_plugin('Image', 'MultiBars')
+
+    assert hasattr(GwHelp, 'FileSelection') == had_file_selection
+    if had_file_selection:
+        assert module.Widgets is Widgets
+        assert module.FileSelection is GwHelp.FileSelection
+    else:
+        assert 'plugins.MultiBars' not in sys.modules
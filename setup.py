@@ -9,6 +9,10 @@ myglobalplugin=plugins:setup_myglobalplugin
 mylocalplugin=plugins:setup_mylocalplugin
 MultiBars=plugins:setup_MultiBars
 CSU_initializer=plugins:setup_CSU_initializer
+
+[console_scripts]
+csu_batch=plugins.csu_batch:main
+csu_control=plugins.csu_control:main
 """
 
 setup(
@@ -22,6 +26,6 @@ setup(
     install_requires = ["ginga>=2.6.1"],
     packages = find_packages(),
     include_package_data = True,
-    package_data = {},
+    package_data = {'plugins': ['data/csu_calibration/*']},
     entry_points = entry_points,
 )
@@ -0,0 +1,122 @@
+"""
+This program compares the 'fast' (parabolic) and 'accurate' (LevMar)
+bar edge estimators for speed and agreement.
+
+By default it runs on a synthetic mask image with known edges; pass the
+name of a FITS mask image to run on real data instead.
+
+    $ python util/bench_edges.py [-n repeats] [mask_image.fits]
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from scipy import ndimage
+
+# the plugins package is in the repository root, one level up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plugins import csu_edges
+
+
+def synthetic_frame(seed=0, shape=(2048, 2048), noise=20.):
+    """
+    Return a mask image with an open slit in every band plus the true
+    (46, 2) rising/falling edge positions.
+    """
+    rng = np.random.default_rng(seed)
+    bands = csu_edges.slit_bands()
+    centers = rng.uniform(400, shape[1]-400, len(bands))
+    widths = rng.uniform(4, 12, len(bands))
+    truth = np.column_stack([centers - widths/2, centers + widths/2])
+
+    # pixel i covers [i, i+1); fill it by the fraction that is open
+    lo = np.arange(shape[1])
+    data = np.zeros(shape)
+    for (y1, y2), (x1, x2) in zip(bands, truth):
+        frac = np.minimum(lo + 1, x2) - np.maximum(lo, x1)
+        data[y1:y2] = 2000. * np.clip(frac, 0., 1.)
+    data = ndimage.gaussian_filter(data, (0, 1.2))
+    data += rng.normal(0, noise, shape)
+    # pixel i covers [i, i+1) so its center is i + 0.5
+    return data.astype(np.float32), truth - 0.5
+
+def time_method(data, method, repeats):
+    times = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        result = csu_edges.measure_edges(data, method=method)
+        times.append(time.perf_counter() - t0)
+    return result, np.array(times)
+
+def main(options):
+    truth = None
+    if options.mask_image is not None:
+        from astropy.io import fits
+        with fits.open(options.mask_image) as hdul:
+            data = hdul[0].data.astype(np.float32)
+    else:
+        data, truth = synthetic_frame(seed=options.seed)
+
+    results = {}
+    for method in ('fast', 'accurate'):
+        result, times = time_method(data, method, options.repeats)
+        results[method] = result
+        print("{:>8s}: {:8.1f} ms median, {:8.1f} ms min, {:2d}/46 slits".format(
+            method, 1e3*np.median(times), 1e3*np.min(times),
+            int(np.sum(result.valid))))
+
+    # the filtering is shared; time the estimators on their own as well
+    stack = csu_edges.extract_bands(data, csu_edges.slit_bands())
+    profiles, noise = csu_edges.band_profiles(stack, return_noise=True)
+    for method, func, kwargs in (
+            ('fast', csu_edges.fit_edges_parabolic, dict(noise=noise)),
+            ('accurate', csu_edges.fit_edges_levmar, {})):
+        t0 = time.perf_counter()
+        for i in range(options.repeats):
+            func(profiles, **kwargs)
+        dt = (time.perf_counter() - t0) / options.repeats
+        print("{:>8s}: {:8.3f} ms per frame in the estimator alone".format(
+            method, 1e3*dt))
+
+    fast, accurate = results['fast'], results['accurate']
+    both = fast.valid & accurate.valid
+    diff = np.concatenate([fast.x1[both] - accurate.x1[both],
+                           fast.x2[both] - accurate.x2[both]])
+    if len(diff) > 0:
+        print("fast - accurate: median {:+.3f} pix, rms {:.3f} pix, "
+              "max |diff| {:.3f} pix".format(
+                  np.median(diff), np.sqrt(np.mean(diff**2)),
+                  np.max(np.abs(diff))))
+        err = np.concatenate([fast.x1_err[both], fast.x2_err[both]])
+        print("fast median quoted uncertainty {:.3f} pix".format(
+            np.median(err)))
+
+    if truth is not None:
+        for method, result in results.items():
+            ok = result.valid
+            resid = np.concatenate([result.x1[ok] - truth[ok, 0],
+                                    result.x2[ok] - truth[ok, 1]])
+            print("{:>8s} - truth: rms {:.3f} pix, max |diff| {:.3f} pix".format(
+                method, np.sqrt(np.mean(resid**2)), np.max(np.abs(resid))))
+            # the quoted errors should match the residuals; this is how
+            # the interp_error of fit_edges_parabolic is calibrated
+            err = np.concatenate([result.x1_err[ok], result.x2_err[ok]])
+            print("{:>8s} (x - truth) / x_err: rms {:.2f}, "
+                  "{:.0f}% within 1 sigma".format(
+                      method, np.sqrt(np.mean((resid / err)**2)),
+                      100 * np.mean(np.abs(resid) <= err)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the CSU bar edge estimators")
+    parser.add_argument("-n", "--repeats", dest="repeats", type=int,
+                        default=5, help="Number of timing runs per method")
+    parser.add_argument("--seed", dest="seed", type=int, default=0,
+                        help="Seed for the synthetic image")
+    parser.add_argument("mask_image", nargs='?', default=None,
+                        help="FITS mask image to use instead of a synthetic one")
+    options = parser.parse_args(sys.argv[1:])
+    main(options)
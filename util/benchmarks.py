@@ -0,0 +1,304 @@
+"""
+This program times the hot paths of the CSU plugins and keeps a record
+of the results so that they can be compared across commits.
+
+    $ python util/benchmarks.py                  # run and record
+    $ python util/benchmarks.py --compare HEAD~5 # run, compare to a commit
+    $ python util/benchmarks.py --list           # show recorded runs
+
+Each run is appended as one JSON line to the results file (default
+``bench_results.jsonl``), tagged with the current git commit.  With
+``--compare`` any benchmark that got slower by more than ``--threshold``
+against the last recorded run of that commit is reported and the program
+exits with status 1.
+
+The plugin benchmarks run the plugins in the headless `plugins.tests.harness`,
+which records how many objects are added and how many redraws are
+requested, so a change in draw counts shows up next to a change in time.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import argparse
+import subprocess
+
+import numpy as np
+from astropy.io import fits
+
+# the plugins package is in the repository root, one level up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plugins import csu_bars, csu_calibration, csu_multibars, csu_store
+from plugins import csu_raster, csu_transforms
+from plugins.tests.harness import Harness
+
+
+def timeit(func, min_time=0.2, repeat=5):
+    """
+    Return the per-call times of ``func`` over ``repeat`` rounds, each
+    long enough to take at least ``min_time`` seconds.
+    """
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for i in range(number):
+            func()
+        dt = time.perf_counter() - t0
+        if dt >= min_time or number >= 1e6:
+            break
+        number *= 10
+    times = [dt / number]
+    for i in range(repeat - 1):
+        t0 = time.perf_counter()
+        for i in range(number):
+            func()
+        times.append((time.perf_counter() - t0) / number)
+    return np.array(times)
+
+def make_bars(seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(100, 180, 46)
+    bars = np.empty(92)
+    bars[0::2] = centers - 0.35
+    bars[1::2] = centers + 0.35
+    return dict(zip(range(1, 93), bars))
+
+def write_csu_bar_state(filename, bars):
+    with open(filename, 'w') as out_f:
+        for b in range(1, 93):
+            out_f.write('{:d},{:.3f},{:d}\n'.format(b, bars[b], 0))
+
+def write_multibars_file(filename, bars):
+    # six lines per slit, the bar positions in the third column of the
+    # first and fourth lines
+    with open(filename, 'w') as out_f:
+        for j in range(46):
+            for k in range(6):
+                b = 2*j + (1 if k == 0 else 2)
+                pos = bars[b] if k in (0, 3) else 0.0
+                out_f.write('{:d} slit{:02d} {:.3f} 0.0\n'.format(b, j+1, pos))
+
+def run_benchmarks(tmpdir, quick=False):
+    """Run the benchmarks, writing their files in ``tmpdir``."""
+    results = {}
+
+    def record(name, times, **extra):
+        results[name] = dict(median=float(np.median(times)),
+                             min=float(np.min(times)), **extra)
+        print("{:40s} {:12.3f} us {}".format(
+            name, 1e6*np.median(times),
+            ' '.join(['{}={}'.format(k, v) for k, v in extra.items()])))
+
+    min_time = 0.05 if quick else 0.2
+    store = csu_calibration.get_store()
+    epoch = store.latest_epoch().name
+    points = np.array(store.get_points(epoch))
+    pixels, physical = points[:,0:2], points[:,2:4]
+    transforms = store.get_transforms(epoch)
+
+    record('fit_transforms', timeit(
+        lambda: csu_transforms.fit_all(pixels, physical), min_time=min_time))
+
+    sizes = [1, 100, 10**4] if quick else [1, 10, 100, 10**3, 10**4,
+                                           10**5, 10**6]
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        pts = rng.uniform(0, 2048, (n, 2))
+        record('pixel_to_physical[{:d}]'.format(n), timeit(
+            lambda: csu_transforms.apply_transform(
+                transforms.Apixel_to_physical, pts), min_time=min_time))
+        record('physical_to_pixel[{:d}]'.format(n), timeit(
+            lambda: csu_transforms.apply_transform(
+                transforms.Aphysical_to_pixel, pts), min_time=min_time))
+
+    bars = make_bars()
+    state_file = os.path.join(tmpdir, 'csu_bar_state')
+    write_csu_bar_state(state_file, bars)
+    record('parse_csu_bar_state', timeit(
+        lambda: csu_bars.parse_csu_bar_state(state_file), min_time=min_time))
+
+    header = fits.Header()
+    for b in range(1, 93):
+        header['B{:02d}POS'.format(b)] = bars[b]
+    record('parse_header', timeit(
+        lambda: csu_bars.parse_header(header), min_time=min_time))
+    record('load_bar_state[file, cached]', timeit(
+        lambda: csu_bars.load_bar_state(state_file), min_time=min_time))
+    record('load_bar_state[header, cached]', timeit(
+        lambda: csu_bars.load_bar_state(header), min_time=min_time))
+
+    bar_file = os.path.join(tmpdir, 'bars.txt')
+    write_multibars_file(bar_file, bars)
+    record('read_multibars_file', timeit(
+        lambda: csu_multibars.read_rectangles(bar_file), min_time=min_time))
+
+    bar_state = csu_bars.as_bar_state(bars)
+    record('bar_geometry', timeit(
+        lambda: csu_transforms.bar_geometry(transforms, bar_state),
+        min_time=min_time))
+    record('bar_geometry[cached]', timeit(
+        lambda: csu_transforms.cached_bar_geometry(transforms, bar_state),
+        min_time=min_time))
+    barnos, polygons, labels = csu_transforms.bar_geometry(transforms,
+                                                           bar_state)
+    record('coverage_labels[2048x2048]', timeit(
+        lambda: csu_raster.coverage_labels(polygons, (2048, 2048), step=1),
+        min_time=min_time))
+    record('coverage_mask[cached]', timeit(
+        lambda: csu_raster.coverage_mask(transforms, bar_state),
+        min_time=min_time))
+
+    # a year of samples five minutes apart, queried for one bar over a
+    # month from a freshly opened store
+    nsamples = 10**4 if quick else 10**5
+    times = 1.5e9 + 300. * np.arange(nsamples)
+    store_path = os.path.join(tmpdir, 'csu_store')
+    csu_store.BarStore(store_path).extend(
+        times, np.tile(csu_bars.as_bar_state(bars).pos, (nsamples, 1)),
+        unique=False)
+    record('bar_store.bar_series[{:d}, month]'.format(nsamples), timeit(
+        lambda: csu_store.BarStore(store_path).bar_series(
+            37, start=times[-1] - 30*86400.), min_time=min_time))
+    record('bar_store.append', timeit(
+        lambda: csu_store.get_store(store_path).append(bar_state, obstime=2e9,
+                                                       unique=False),
+        min_time=min_time))
+
+    run_plugin_benchmarks(record, bars, tmpdir, min_time)
+
+    return results
+
+def run_plugin_benchmarks(record, bars, tmpdir, min_time):
+    bar_file = os.path.join(tmpdir, 'bars.txt')
+    harness = Harness()
+    harness.add_channel('Image')
+    mb = harness.start_local_plugin('Image', 'MultiBars')
+    harness.recorder.reset()
+    mb.overlaybars(bar_file)
+    counts = dict(harness.recorder.counts)
+    record('MultiBars.overlaybars', timeit(
+        lambda: mb.overlaybars(bar_file), min_time=min_time),
+        adds=counts['add'], redraws=counts['redraw'])
+    harness.stop_local_plugin('Image', 'MultiBars')
+
+    # full overlay from scratch
+    plugin = harness.start_local_plugin('Image', 'CSU_initializer')
+    harness.recorder.reset()
+    plugin.overlaybars(bars)
+    counts = dict(harness.recorder.counts)
+
+    def full_overlay():
+        plugin.clear_canvas()
+        plugin.overlaybars(bars)
+    record('CSU_initializer.overlaybars[full]',
+           timeit(full_overlay, min_time=min_time),
+           adds=counts['add'], redraws=counts['redraw'])
+
+    # update of an existing overlay with a few bars moved
+    moved = [dict(bars), dict(bars)]
+    for b in (5, 6, 40, 41):
+        moved[1][b] += 1.0
+    plugin.clear_canvas()
+    plugin.overlaybars(moved[0])
+    harness.recorder.reset()
+    plugin.overlaybars(moved[1])
+    counts = dict(harness.recorder.counts)
+    toggle = [0]
+
+    def update_overlay():
+        toggle[0] ^= 1
+        plugin.overlaybars(moved[toggle[0]])
+    record('CSU_initializer.overlaybars[4 moved]',
+           timeit(update_overlay, min_time=min_time),
+           adds=counts.get('add', 0), redraws=counts['redraw'])
+    harness.close()
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def load_records(filename):
+    records = []
+    if os.path.exists(filename):
+        with open(filename, 'r') as in_f:
+            for line in in_f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+def compare(results, reference, threshold):
+    """Print a comparison; returns the names of regressed benchmarks."""
+    regressed = []
+    for name, res in results.items():
+        if name not in reference['results']:
+            continue
+        ref = reference['results'][name]['median']
+        ratio = res['median'] / ref if ref > 0 else np.inf
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = '  <-- REGRESSION'
+            regressed.append(name)
+        print("{:40s} {:12.3f} us -> {:12.3f} us  x{:.2f}{}".format(
+            name, 1e6*ref, 1e6*res['median'], ratio, flag))
+    return regressed
+
+def main(options):
+    records = load_records(options.results)
+    if options.list:
+        for rec in records:
+            print("{}  {}  {}  {:d} benchmarks".format(
+                rec['time'], rec['commit'], rec['host'],
+                len(rec['results'])))
+        return 0
+
+    with tempfile.TemporaryDirectory(prefix='csu_bench') as tmpdir:
+        results = run_benchmarks(tmpdir, quick=options.quick)
+    record = dict(commit=git_commit(), host=socket.gethostname(),
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  results=results)
+    if not options.no_save:
+        with open(options.results, 'a') as out_f:
+            out_f.write(json.dumps(record) + '\n')
+
+    if options.compare is not None:
+        commit = options.compare
+        if commit not in [rec['commit'] for rec in records]:
+            try:
+                commit = subprocess.check_output(
+                    ['git', 'rev-parse', '--short', commit]).decode().strip()
+            except (OSError, subprocess.CalledProcessError):
+                pass
+        refs = [rec for rec in records if rec['commit'] == commit]
+        if len(refs) == 0:
+            print("No recorded run for '{}'".format(options.compare))
+            return 1
+        print("\nCompared to {} ({})".format(refs[-1]['commit'],
+                                             refs[-1]['time']))
+        if compare(results, refs[-1], options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the CSU plugin hot paths")
+    parser.add_argument("--results", default='bench_results.jsonl',
+                        help="File of recorded runs (default %(default)s)")
+    parser.add_argument("--compare", default=None, metavar="COMMIT",
+                        help="Compare against the recorded run of COMMIT")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Slowdown counted as a regression (default %(default)s)")
+    parser.add_argument("--quick", action='store_true', default=False,
+                        help="Fewer sizes and shorter timing runs")
+    parser.add_argument("--no-save", action='store_true', default=False,
+                        help="Do not record this run")
+    parser.add_argument("--list", action='store_true', default=False,
+                        help="List recorded runs and exit")
+    options = parser.parse_args(sys.argv[1:])
+    sys.exit(main(options))